@@ -0,0 +1,345 @@
+"""
+Benchmarks for the game's hot paths, runnable on a headless machine.
+
+Every scenario is timed over many iterations and reported as throughput
+and latency percentiles. Results are compared with a baseline file, scaled
+by how fast this machine runs a fixed calibration workload compared with the
+one that saved it: any scenario whose median or p99 is slower than that by
+more than the tolerance (plus NOISE_FLOOR_MS, so sub-millisecond scenarios
+don't fail on jitter) fails the run, and so does a missing baseline (unless
+--no-baseline is given). Per-frame scenarios also fail when their p99 is over
+a tick.
+
+    python benchmark.py                  # run and compare with the baseline
+    python benchmark.py --save-baseline  # store these results as the baseline
+    python benchmark.py --no-baseline    # only check the budgets
+    python benchmark.py -k update        # only scenarios named like "update"
+"""
+
+import os
+
+# No display or sound card needed (set before pygame starts SDL)
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import argparse
+import json
+import random
+import time
+from itertools import cycle
+
+import numpy as np
+from pgzero.screen import Screen
+from pygame import display as pygame_display
+
+import game
+
+# Where results are compared and saved by default
+BASELINE_PATH = os.path.join(game.GAME_DIR, "benchmark_baseline.json")
+# A scenario fails when its median is this many times the baseline's...
+DEFAULT_TOLERANCE = 1.5
+# ...or its p99 this many times (the tail is noisier than the median)
+DEFAULT_TAIL_TOLERANCE = 2.0
+# Milliseconds allowed on top of the tolerances (scheduler and cache jitter)
+NOISE_FLOOR_MS = 0.5
+# Baseline entry of the calibration workload, which scales the others
+CALIBRATION = "calibration"
+# Seconds each scenario runs for (after warming up), and iteration limits
+TIME_BUDGET = 1.0
+WARMUP_ITERATIONS = 3
+MIN_ITERATIONS = 5
+MAX_ITERATIONS = 10_000
+
+# Hero inputs of the update and draw scenarios: walk around in squares
+HERO_PATH = (
+    [game.INPUT_RIGHT] * 30
+    + [game.INPUT_DOWN] * 30
+    + [game.INPUT_LEFT] * 30
+    + [game.INPUT_UP] * 30
+)
+
+
+class Scenario:
+    """One benchmark: run() is timed, prepare() runs untimed before it.
+
+    A scenario with a budget (seconds) also fails when its p99 is over it,
+    whatever the baseline says: a frame that only makes the budget on median
+    still stutters.
+    """
+
+    def __init__(self, name, setup, budget=None):
+        self.name = name
+        # Builds the state lazily, so filtered-out scenarios cost nothing
+        self.setup = setup
+        self.budget = budget
+
+    def measure(self, time_budget=TIME_BUDGET):
+        """Seconds taken by each timed iteration."""
+        run, prepare = self.setup()
+        for _ in range(WARMUP_ITERATIONS):
+            prepare()
+            run()
+        samples = []
+        clock = time.perf_counter
+        deadline = clock() + time_budget
+        while len(samples) < MAX_ITERATIONS and (
+            len(samples) < MIN_ITERATIONS or clock() < deadline
+        ):
+            prepare()
+            started = clock()
+            run()
+            samples.append(clock() - started)
+        return np.array(samples)
+
+
+def nothing():
+    """Default prepare step."""
+
+
+def playing_session(columns, rows, enemy_count):
+    """Seeded session on a columns x rows map whose hero can't die."""
+    rng = random.Random(1)
+    session = game.GameSession(seed=1)
+    session.start(game.create_grid(rng, columns, rows), enemy_count, seed=1)
+    session.hero.health = 10**9
+    return session
+
+
+def create_grid_setup(columns, rows):
+    rng = random.Random(1)
+    return (lambda: game.create_grid(rng, columns, rows)), nothing
+
+
+def generate_caves_setup(columns, rows):
+    rng = random.Random(1)
+    return (lambda: game.generate_caves(columns, rows, rng)), nothing
+
+
+def spawn_coin_setup(occupied):
+    rng = random.Random(1)
+    grid = game.create_grid(rng, 200, 200)
+    exclude = {
+        (rng.randrange(grid.columns), rng.randrange(grid.rows)) for _ in range(occupied)
+    }
+    return (lambda: game.spawn_coin(grid, exclude, rng)), nothing
+
+
+def update_setup(columns, rows, enemy_count):
+    session = playing_session(columns, rows, enemy_count)
+    inputs = cycle(HERO_PATH)
+    return (lambda: session.step(game.TICK, next(inputs))), nothing
+
+
+def snapshot_setup(columns, rows, enemy_count, restore):
+    """Snapshot (or restore) a session after a few ticks."""
+    session = playing_session(columns, rows, enemy_count)
+    for inputs in HERO_PATH[:20]:
+        session.step(game.TICK, inputs)
+    if restore:
+        data = session.snapshot()
+        return (lambda: session.restore(data)), nothing
+    return session.snapshot, nothing
+
+
+def draw_setup(enemy_count, dirty):
+    """Draw one frame after each (untimed) tick."""
+    if pygame_display.get_surface() is None:
+        game.screen = Screen(pygame_display.set_mode((game.WIDTH, game.HEIGHT)))
+        game.load_sprites()
+    session = playing_session(100, 100, enemy_count)
+    game.game_session = session
+    game.game_camera = None
+    inputs = cycle(HERO_PATH)
+    renderer = game.DirtyRenderer() if dirty else None
+
+    def prepare():
+        session.step(game.TICK, next(inputs))
+
+    return (lambda: game.draw_game(renderer)), prepare
+
+
+def calibration_setup():
+    """Fixed mix of Python and NumPy work, to compare machine speeds."""
+    values = np.random.default_rng(1).random(200_000)
+
+    def run():
+        total = 0
+        for i in range(20_000):
+            total += i * i
+        np.sort(values)
+        return total
+
+    return run, nothing
+
+
+def scenarios():
+    """Every benchmark scenario, in the order they run."""
+    for columns, rows in ((20, 15), (200, 150), (1000, 750)):
+        yield Scenario(
+            f"create_grid[{columns}x{rows}]",
+            lambda c=columns, r=rows: create_grid_setup(c, r),
+        )
+    yield Scenario(
+        "generate_caves[2000x2000]",
+        lambda: generate_caves_setup(2000, 2000),
+        budget=game.CAVE_TIME_BUDGET,
+    )
+    for occupied in (10, 1000, 10_000):
+        yield Scenario(
+            f"spawn_coin[{occupied} occupied]",
+            lambda n=occupied: spawn_coin_setup(n),
+        )
+    for enemy_count, columns, rows in (
+        (10, 20, 15),
+        (1000, 200, 200),
+        (10_000, 500, 500),
+    ):
+        yield Scenario(
+            f"update[{enemy_count} enemies]",
+            lambda n=enemy_count, c=columns, r=rows: update_setup(c, r, n),
+            budget=game.TICK,
+        )
+    for restore in (False, True):
+        name = "restore" if restore else "snapshot"
+        yield Scenario(
+            f"{name}[1000x1000, 10000 enemies]",
+            lambda r=restore: snapshot_setup(1000, 1000, 10_000, r),
+        )
+    for enemy_count in (10, 1000):
+        for dirty in (False, True):
+            mode = "dirty" if dirty else "full"
+            yield Scenario(
+                f"draw_game[{enemy_count} enemies, {mode}]",
+                lambda n=enemy_count, d=dirty: draw_setup(n, d),
+                budget=game.TICK,
+            )
+
+
+def summarize(samples):
+    """Throughput and latency percentiles (ms) of timed iterations."""
+    p50, p95, p99 = np.percentile(samples, (50, 95, 99)) * 1000.0
+    return {
+        "iterations": len(samples),
+        "ops_per_s": float(len(samples) / samples.sum()),
+        "p50_ms": float(p50),
+        "p95_ms": float(p95),
+        "p99_ms": float(p99),
+    }
+
+
+def load_baseline(path):
+    """Results stored by --save-baseline (None if there are none)."""
+    try:
+        with open(path) as baseline_file:
+            return json.load(baseline_file)
+    except FileNotFoundError:
+        return None
+
+
+def compare(result, stored, speed, tolerance, tail_tolerance):
+    """Text for the "vs baseline" column, and whether it is a regression.
+
+    speed is this machine's calibration time over the baseline's: the
+    stored times are scaled by it before comparing.
+    """
+    median = stored["p50_ms"] * speed
+    tail = stored["p99_ms"] * speed
+    text = f"x{result['p50_ms'] / median:.2f} (p99 x{result['p99_ms'] / tail:.2f})"
+    regressed = (
+        result["p50_ms"] > median * tolerance + NOISE_FLOOR_MS
+        or result["p99_ms"] > tail * tail_tolerance + NOISE_FLOOR_MS
+    )
+    if regressed:
+        text += "  REGRESSION"
+    return text, regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-k", dest="pattern", default="", help="name filter")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument(
+        "--no-baseline",
+        action="store_true",
+        help="don't fail on scenarios the baseline doesn't have",
+    )
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--tail-tolerance", type=float, default=DEFAULT_TAIL_TOLERANCE)
+    parser.add_argument("--time", type=float, default=TIME_BUDGET)
+    args = parser.parse_args(argv)
+
+    baseline = load_baseline(args.baseline)
+    if baseline is None:
+        if not (args.no_baseline or args.save_baseline):
+            print(
+                f"no baseline at {args.baseline}: run with --save-baseline to "
+                "create it, or --no-baseline to only check the budgets"
+            )
+            return 1
+        baseline = {}
+    missing = []
+    calibration = summarize(Scenario(CALIBRATION, calibration_setup).measure(args.time))
+    results = {CALIBRATION: calibration}
+    regressions = []
+    speed = 1.0
+    if CALIBRATION in baseline:
+        speed = calibration["p50_ms"] / baseline[CALIBRATION]["p50_ms"]
+        print(f"this machine takes x{speed:.2f} the baseline's time to calibrate")
+    print(
+        f"{'scenario':<36} {'ops/s':>10} {'p50 ms':>9} {'p95 ms':>9} "
+        f"{'p99 ms':>9}  vs baseline"
+    )
+    for scenario in scenarios():
+        if args.pattern not in scenario.name:
+            continue
+        result = summarize(scenario.measure(args.time))
+        results[scenario.name] = result
+        comparison = "(no baseline)"
+        if scenario.name in baseline:
+            comparison, regressed = compare(
+                result,
+                baseline[scenario.name],
+                speed,
+                args.tolerance,
+                args.tail_tolerance,
+            )
+            if regressed:
+                regressions.append(scenario.name)
+        else:
+            missing.append(scenario.name)
+        if scenario.budget is not None and result["p99_ms"] > scenario.budget * 1000:
+            comparison += f"  OVER BUDGET ({scenario.budget * 1000:.1f} ms)"
+            regressions.append(scenario.name)
+        print(
+            f"{scenario.name:<36} {result['ops_per_s']:>10.1f} "
+            f"{result['p50_ms']:>9.3f} {result['p95_ms']:>9.3f} "
+            f"{result['p99_ms']:>9.3f}  {comparison}"
+        )
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+        print(f"baseline saved to {args.baseline}")
+        return 0
+    failed = False
+    if regressions:
+        print(
+            f"FAILED: {len(set(regressions))} scenario(s) over budget or slower "
+            f"than the baseline (median x{args.tolerance}, p99 "
+            f"x{args.tail_tolerance}, + {NOISE_FLOOR_MS} ms): "
+            + ", ".join(dict.fromkeys(regressions))
+        )
+        failed = True
+    if missing and not args.no_baseline:
+        print(
+            f"FAILED: {len(missing)} scenario(s) missing from {args.baseline} "
+            "(--save-baseline adds them): " + ", ".join(missing)
+        )
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
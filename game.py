@@ -3,9 +3,31 @@ Roguelike game using PgZero.
 A top-down roguelike with sprite animations, enemies, and sound effects.
 """
 
+import argparse
+import hashlib
+import heapq
+import json
 import math
+import mmap
+import os
 import random
-from pygame import Rect
+import struct
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict
+from itertools import compress
+import numpy as np
+from pgzero import loaders, ptext
+from pgzero.constants import keys
+from pgzero.screen import Screen
+from pygame import SRCALPHA, Rect, Surface
+from pygame import display as pygame_display, draw as pygame_draw
+from pygame import error as pygame_error, image as pygame_image
+from pygame import mixer as pygame_mixer
 
 # Window configuration (PgZero uses WIDTH, HEIGHT)
 WIDTH = 800
@@ -16,6 +38,115 @@ CELL_SIZE = 40
 COLUMNS = WIDTH // CELL_SIZE
 ROWS = HEIGHT // CELL_SIZE
 
+# Colors
+BACKGROUND_COLOR = (25, 30, 45)
+OBSTACLE_COLOR = (60, 60, 70)
+FLOOR_BORDER_COLOR = (45, 45, 60)
+
+# Flow field: how many steps the search from the hero covers, at least (see
+# flow_field_range())
+FLOW_FIELD_RANGE = 32
+
+# Swarms with fewer enemies than this run their AI one enemy at a time:
+# below it, NumPy's per-call overhead costs more than the work itself
+SCALAR_SWARM_SIZE = 64
+
+# Spatial hash of sleeping enemies: cells per side of each bucket searched
+# when a hero enters a cell
+SLEEP_BUCKET_CELLS = 8
+
+# Field of view: results kept (least recently used are dropped first), how
+# far the hero sees and the fog drawn over the cells it can't see
+FOV_CACHE_SIZE = 4096
+HERO_SIGHT_RADIUS = 7
+FOG_COLOR = (0, 0, 0, 190)
+
+# Grid layer cache: cells per side of each pre-rendered block
+GRID_BLOCK_CELLS = 16
+# Rendered blocks kept around (least recently drawn are dropped first)
+GRID_LAYER_MAX_BLOCKS = 16
+
+# Whole screen (area of full-screen layers like the fog)
+SCREEN_RECT = Rect(0, 0, WIDTH, HEIGHT)
+# Screen area repainted when the HUD text changes (dirty rendering)
+HUD_RECT = Rect(0, 0, WIDTH // 2, 40)
+# Screen area of the profiler overlay (top right, toggled with F3)
+PROFILER_RECT = Rect(WIDTH - 300, 0, 300, 170)
+
+# Rendered text surfaces kept around (least recently used are dropped first)
+TEXT_CACHE_SIZE = 64
+
+# Sprite atlas: width of the packed surface, image folder and disk cache
+ATLAS_WIDTH = 512
+# Folder with game.py and its assets. Under pgzrun, __file__ is replaced by
+# pgzero's own, but pgzero has already pointed loaders.root at this folder.
+if os.path.isabs(loaders.root):
+    GAME_DIR = loaders.root
+else:
+    GAME_DIR = os.path.dirname(os.path.abspath(__file__))
+IMAGES_DIR = os.path.join(GAME_DIR, "images")
+IMAGE_EXTENSIONS = (".png", ".gif", ".jpg", ".jpeg", ".bmp")
+ATLAS_CACHE_DIR = os.path.join(GAME_DIR, "cache")
+# Bump when the cache layout changes, so old caches are rebuilt
+ATLAS_CACHE_FORMAT = 1
+
+# Frame profiler: phases timed in update() and draw(), frames kept in its
+# ring buffer, frames between overlay refreshes and where F4 writes the CSV
+PROFILE_PHASES = ("input", "ai", "movement", "collision", "grid", "entities", "hud")
+PROFILER_FRAMES = 600
+PROFILER_REFRESH = 30
+PROFILE_CSV_PATH = os.path.join(GAME_DIR, "profile.csv")
+
+# Game recordings: file signature, format version (bump when the layout
+# changes) and where the last game played is saved
+REPLAY_MAGIC = b"RGLR"
+REPLAY_FORMAT = 5
+REPLAY_PATH = os.path.join(GAME_DIR, "last_game.replay")
+# Game snapshots: file signature and format version (bump when the layout
+# changes)
+SNAPSHOT_MAGIC = b"RGLS"
+SNAPSHOT_FORMAT = 3
+# How the world of a recording (or snapshot) is rebuilt: generated by start()
+# from the seed, a ChunkedGrid from its parameters, or a Grid from its cells
+WORLD_GENERATED = 0
+WORLD_CHUNKED = 1
+WORLD_STORED = 2
+
+# Sound effects loaded up front (names of files in sounds/)
+SOUND_NAMES = ("button_click", "step", "coin", "hit", "game_over")
+# Mixer channels shared by all effects, and voices each effect may hold
+SOUND_CHANNELS = 16
+MAX_VOICES_PER_SOUND = 3
+# Repeats of an effect closer than this many seconds play only once
+SOUND_COALESCE_TIME = 0.05
+# Background music: track name and where its files are
+MUSIC_NAME = "background"
+MUSIC_DIR = os.path.join(GAME_DIR, "music")
+MUSIC_EXTENSIONS = (".ogg", ".mp3", ".oga")
+
+# Startup: seconds from launching the game's process to its first frame (the
+# menu), checked by "python game.py startup"; starting Python and importing
+# NumPy and pygame take most of it. Assets load after it (AssetLoader)
+STARTUP_FRAME_BUDGET = 0.5
+# Lines the process timed by "startup" prints at each milestone
+FIRST_FRAME_LINE = "first frame"
+ASSETS_LOADED_LINE = "assets loaded"
+
+# Chunked worlds: cells per side of each chunk and chunks kept in memory
+CHUNK_CELLS = 32
+MAX_LOADED_CHUNKS = 256
+# Share of obstacle cells in generated chunks (about what create_grid makes)
+WORLD_OBSTACLE_DENSITY = 0.08
+# Coins in chunked worlds appear within this many cells of the hero
+COIN_SPAWN_RADIUS = 12
+COIN_SPAWN_TRIES = 32
+
+# Fixed simulation rate: every tick advances the game by TICK seconds
+SIMULATION_RATE = 60
+TICK = 1.0 / SIMULATION_RATE
+# Most ticks run to catch up in one frame; slower frames drop the rest
+MAX_TICKS_PER_FRAME = 5
+
 # Directions (constants)
 DIRECTION_DOWN = 0
 DIRECTION_LEFT = 1
@@ -115,6 +246,97 @@ SPRITE_ENEMY_MOVING_UP = [
     "enemy_move_4",
 ]
 
+# Every image the game draws; animations store indices into this list
+SPRITE_NAMES = list(
+    dict.fromkeys(
+        SPRITE_HERO_IDLE_DOWN
+        + SPRITE_HERO_IDLE_LEFT
+        + SPRITE_HERO_IDLE_RIGHT
+        + SPRITE_HERO_IDLE_UP
+        + SPRITE_HERO_MOVING_DOWN
+        + SPRITE_HERO_MOVING_LEFT
+        + SPRITE_HERO_MOVING_RIGHT
+        + SPRITE_HERO_MOVING_UP
+        + SPRITE_ENEMY_IDLE_DOWN
+        + SPRITE_ENEMY_IDLE_LEFT
+        + SPRITE_ENEMY_IDLE_RIGHT
+        + SPRITE_ENEMY_IDLE_UP
+        + SPRITE_ENEMY_MOVING_DOWN
+        + SPRITE_ENEMY_MOVING_LEFT
+        + SPRITE_ENEMY_MOVING_RIGHT
+        + SPRITE_ENEMY_MOVING_UP
+        + ["coin"]
+    )
+)
+SPRITE_INDEX = {name: index for index, name in enumerate(SPRITE_NAMES)}
+SPRITE_COIN = SPRITE_INDEX["coin"]
+
+# Input flags (bitmask given to GameSession.step)
+INPUT_UP = 1
+INPUT_DOWN = 2
+INPUT_LEFT = 4
+INPUT_RIGHT = 8
+
+# Damage an enemy deals on contact
+ENEMY_DAMAGE = 5
+# Cells around its start an enemy patrols, and how close it notices the hero
+ENEMY_RADIUS = 4
+# Enemies patrol a step every PATROL_PERIOD seconds plus up to PATROL_JITTER
+# (drawn per enemy), from a random point of that period, so the steps and
+# wake-ups of a big swarm spread over many ticks instead of bunching up
+PATROL_PERIOD = 1.0
+PATROL_JITTER = 0.25
+# Seconds the hero can't be hurt again after a hit
+HERO_DAMAGE_COOLDOWN = 0.45
+# Obstacles placed by create_grid() per cell (25 on the default map)
+OBSTACLE_DENSITY = 25 / (COLUMNS * ROWS)
+# GameSession attributes that tune a game (stored in recordings), and their
+# defaults
+BALANCE_SETTINGS = (
+    "enemy_damage",
+    "enemy_radius",
+    "damage_cooldown",
+    "obstacle_density",
+)
+DEFAULT_BALANCE = (ENEMY_DAMAGE, ENEMY_RADIUS, HERO_DAMAGE_COOLDOWN, OBSTACLE_DENSITY)
+# Cave maps: share of walls before smoothing and cellular automaton passes
+CAVE_WALL_CHANCE = 0.45
+CAVE_SMOOTHING_PASSES = 4
+# Seconds generate_caves() may take for a 2000x2000 map (see benchmark.py)
+CAVE_TIME_BUDGET = 1.0
+
+# Hero sprites indexed by direction
+HERO_IDLE_FRAMES = [
+    SPRITE_HERO_IDLE_DOWN,
+    SPRITE_HERO_IDLE_LEFT,
+    SPRITE_HERO_IDLE_RIGHT,
+    SPRITE_HERO_IDLE_UP,
+]
+HERO_MOVING_FRAMES = [
+    SPRITE_HERO_MOVING_DOWN,
+    SPRITE_HERO_MOVING_LEFT,
+    SPRITE_HERO_MOVING_RIGHT,
+    SPRITE_HERO_MOVING_UP,
+]
+
+# Enemy sprites indexed by direction
+ENEMY_IDLE_FRAMES = [
+    SPRITE_ENEMY_IDLE_DOWN,
+    SPRITE_ENEMY_IDLE_LEFT,
+    SPRITE_ENEMY_IDLE_RIGHT,
+    SPRITE_ENEMY_IDLE_UP,
+]
+ENEMY_MOVING_FRAMES = [
+    SPRITE_ENEMY_MOVING_DOWN,
+    SPRITE_ENEMY_MOVING_LEFT,
+    SPRITE_ENEMY_MOVING_RIGHT,
+    SPRITE_ENEMY_MOVING_UP,
+]
+
+# Seconds each animation frame stays on screen
+IDLE_FRAME_TIME = 0.4
+MOVING_FRAME_TIME = 0.12
+
 # Game states (constants)
 STATE_MENU = 0
 STATE_PLAYING = 1
@@ -122,49 +344,260 @@ STATE_GAME_OVER = 2
 
 # Global game variables (lowercase per PEP8)
 game_state = STATE_MENU
-game_grid = []
-game_hero = None
-game_enemies = []
+# Current GameSession (grid, hero, enemies and coin)
+game_session = None
 music_enabled = True
 sounds_enabled = True
 # Global volume multiplier (0.0 to 1.0). Set to 0.5 to reduce overall sound by half.
 GLOBAL_VOLUME = 0.25
-# Coin on the map (grid coordinates) or None
-game_coin = None
+# Fraction of a tick between the last two simulated states (for drawing)
+render_alpha = 1.0
+# Pre-rendered grid (created lazily on first draw)
+grid_layer = None
+# View over the world, following the hero
+game_camera = None
+# Repaint only what changed between frames instead of the whole screen
+dirty_rendering = False
+# Renderer keeping track of the changed areas (created lazily)
+dirty_renderer = None
+# Darken the cells the hero can't see
+fog_of_war = True
+# Fog surfaces over the world (created lazily)
+fog_layer = None
+# Packed sprite frames (loaded once, before the first frame when possible)
+sprite_atlas = None
+# Rendered text surfaces (created lazily)
+text_cache = None
+# Composed menu and game over screens, by what they depend on
+screen_layers = {}
+# Loaded sound effects and their voices (created lazily)
+sound_manager = None
+# Per-phase frame timings (None while profiling is off, toggled with F3)
+frame_profiler = None
+# Background loading of sprites, sounds and music (None: load on first use)
+asset_loader = None
+# Music track loaded in the mixer, and the one to play once assets are loaded
+loaded_music = None
+pending_music = None
+
+
+class SoundManager:
+    """Sound effects loaded once, with a few voices (channels) per effect.
+
+    A sound that fails to load is remembered as missing and never retried.
+    Volume is applied to every sound when it changes, not on each play.
+    An effect replayed within coalesce_time seconds is skipped, and one
+    already playing on max_voices channels takes over its oldest voice.
+    """
+
+    def __init__(
+        self,
+        volume=GLOBAL_VOLUME,
+        max_voices=MAX_VOICES_PER_SOUND,
+        coalesce_time=SOUND_COALESCE_TIME,
+        clock=time.perf_counter,
+    ):
+        self.volume = volume
+        self.max_voices = max_voices
+        self.coalesce_time = coalesce_time
+        self.clock = clock
+        # Sound by name (None if it couldn't be loaded)
+        self.sounds = {}
+        # Channels last given to each sound, oldest first
+        self.voices = {}
+        # When each sound last started playing
+        self.last_played = {}
+
+    def load(self, name):
+        """Sound called name, loading it on first use (None if missing)."""
+        try:
+            return self.sounds[name]
+        except KeyError:
+            pass
+        try:
+            sound = loaders.sounds.load(name)
+            sound.set_volume(self.volume)
+        except Exception:
+            sound = None
+        self.sounds[name] = sound
+        return sound
+
+    def preload(self, names=SOUND_NAMES):
+        """Load names now, so the first play doesn't hit the disk."""
+        if pygame_mixer.get_init():
+            channels = pygame_mixer.get_num_channels()
+            pygame_mixer.set_num_channels(max(channels, SOUND_CHANNELS))
+        for name in names:
+            self.load(name)
+
+    def set_volume(self, volume):
+        """Change the volume of every loaded sound."""
+        if volume == self.volume:
+            return
+        self.volume = volume
+        for sound in self.sounds.values():
+            if sound is not None:
+                sound.set_volume(volume)
+
+    def play(self, name):
+        """Play the sound called name, within its voice limit."""
+        sound = self.load(name)
+        if sound is None:
+            return
+        now = self.clock()
+        last = self.last_played.get(name)
+        if last is not None and now - last < self.coalesce_time:
+            return
+        self.last_played[name] = now
+        # Forget channels that finished or were taken by another sound
+        voices = [
+            channel
+            for channel in self.voices.get(name, ())
+            if channel.get_busy() and channel.get_sound() is sound
+        ]
+        try:
+            if len(voices) >= self.max_voices:
+                channel = voices.pop(0)
+                channel.play(sound)
+            else:
+                channel = sound.play()
+        except pygame_error:
+            channel = None
+        if channel is not None:
+            voices.append(channel)
+        self.voices[name] = voices
+
+
+class AssetLoader:
+    """Sprites, sounds and music loaded on a background thread.
+
+    The menu is drawn while it runs, showing progress(). Surfaces are only
+    converted for the display on the main thread: load_sprites() waits for
+    the atlas (if it's still loading) and converts it there. Nothing it
+    loads is required: what is missing falls back as with lazy loading.
+    """
+
+    def __init__(self, sounds, sound_names=SOUND_NAMES, music_name=MUSIC_NAME):
+        self.sounds = sounds
+        self.music_name = music_name
+        self.steps = [self.load_atlas]
+        self.steps += [lambda name=name: sounds.load(name) for name in sound_names]
+        self.steps.append(self.load_music)
+        self.done = 0
+        # Atlas not converted yet, set (with atlas_loaded) by the first step
+        self.atlas = None
+        self.atlas_loaded = threading.Event()
+        # Music track loaded in the mixer (None if missing or no mixer)
+        self.music = None
+        self.thread = threading.Thread(target=self.run, name="assets", daemon=True)
+
+    def start(self):
+        """Start loading in the background; returns self."""
+        self.thread.start()
+        return self
+
+    def run(self):
+        for step in self.steps:
+            try:
+                step()
+            except Exception:
+                pass
+            self.done += 1
+        self.atlas_loaded.set()
+
+    def load_atlas(self):
+        try:
+            self.atlas = load_sprite_atlas(SPRITE_NAMES, convert=False)
+        finally:
+            self.atlas_loaded.set()
+
+    def load_music(self):
+        if not pygame_mixer.get_init():
+            return
+        path = find_file(MUSIC_DIR, self.music_name, MUSIC_EXTENSIONS)
+        if path is not None:
+            pygame_mixer.music.load(path)
+            self.music = self.music_name
+
+    def progress(self):
+        """Fraction of the assets loaded so far."""
+        return self.done / len(self.steps)
+
+    def ready(self):
+        """True once everything has been loaded (or failed to)."""
+        return self.done == len(self.steps)
+
+
+def start_loading_assets():
+    """Load sprites, sounds and music in the background (see AssetLoader)."""
+    global asset_loader
+    sounds = load_sounds()
+    # Only reserves the mixer channels: the sounds load in the background
+    sounds.preload(())
+    asset_loader = AssetLoader(sounds).start()
+
+
+def finish_loading_assets():
+    """Take over what the loader finished: the sprites and pending music."""
+    global loaded_music, pending_music
+    if asset_loader is None or not asset_loader.ready():
+        return
+    if sprite_atlas is None:
+        load_sprites()
+    if asset_loader.music is not None and loaded_music is None:
+        loaded_music = asset_loader.music
+    if pending_music is not None:
+        name, pending_music = pending_music, None
+        play_music(name)
+
+
+def load_sounds():
+    """Return the shared SoundManager, creating it on first use."""
+    global sound_manager
+    if sound_manager is None:
+        sound_manager = SoundManager()
+    return sound_manager
 
 
 def play_sound(name):
     """Play sound effect safely (doesn't break if missing)."""
     if not sounds_enabled:
         return
-    try:
-        snd = getattr(sounds, name, None)
-        if snd:
-            try:
-                snd.set_volume(GLOBAL_VOLUME)
-            except Exception:
-                pass
-            snd.play()
-    except Exception:
-        pass
+    manager = load_sounds()
+    manager.set_volume(GLOBAL_VOLUME)
+    manager.play(name)
 
 
 def play_music(name):
-    """Play background music safely."""
+    """Play background music safely.
+
+    While assets are loading in the background, the music starts once they
+    are loaded (see finish_loading_assets()) instead of loading it here.
+    """
+    global loaded_music, pending_music
     if not music_enabled:
         return
+    if asset_loader is not None and not asset_loader.ready():
+        pending_music = name
+        return
     try:
         try:
             music.set_volume(GLOBAL_VOLUME)
         except Exception:
             pass
-        music.play(name)
+        if name == loaded_music:
+            pygame_mixer.music.play(-1)
+        else:
+            music.play(name)
+            loaded_music = name
     except Exception:
         pass
 
 
 def stop_music():
     """Stop background music safely."""
+    global pending_music
+    pending_music = None
     try:
         music.stop()
     except Exception:
@@ -172,505 +605,3498 @@ def stop_music():
 
 
 class Animation:
-    """Handles sprite animation with multiple frames cycling continuously."""
+    """Animation clip: frames cycling continuously, speed seconds each.
+
+    Clips are shared by every entity of a sprite set (see HERO_CLIPS and
+    ENEMY_CLIPS); entities only keep which clip plays and for how long.
+    Frames are SPRITE_NAMES indices (see sprite_indices()).
+    """
+
+    __slots__ = ("frames", "speed", "cycle")
 
     def __init__(self, frames, speed=0.18):
         self.frames = frames or []
         self.speed = speed
-        self.time = 0.0
-        self.index = 0
+        # Seconds for a whole loop (elapsed times can wrap around it)
+        self.cycle = speed * max(1, len(self.frames))
 
-    def update(self, dt):
-        """Update animation frame based on elapsed time."""
+    def frame_index(self, elapsed):
+        """Position in frames after elapsed seconds of playing."""
         if len(self.frames) < 2:
-            return
-        self.time += dt
-        while self.time >= self.speed:
-            self.time -= self.speed
-            self.index = (self.index + 1) % len(self.frames)
+            return 0
+        return int(elapsed // self.speed) % len(self.frames)
 
-    def current_frame(self):
-        """Get current frame image name."""
+    def frame_at(self, elapsed):
+        """Frame shown after elapsed seconds (None if the clip is empty)."""
         if not self.frames:
             return None
-        return self.frames[self.index]
+        return self.frames[self.frame_index(elapsed)]
 
 
-class Character:
-    """Base class for all game characters."""
+def sprite_indices(names):
+    """Turn a list of image names into SPRITE_NAMES indices."""
+    return [SPRITE_INDEX[name] for name in names]
 
-    def __init__(
-        self,
-        grid_x,
-        grid_y,
-        idle_frames_by_direction,
-        moving_frames_by_direction,
-        speed=3.0,
-    ):
-        self.grid_x = grid_x
-        self.grid_y = grid_y
-        self.x = grid_x * CELL_SIZE + CELL_SIZE // 2
-        self.y = grid_y * CELL_SIZE + CELL_SIZE // 2
-        self.target_x = self.x
-        self.target_y = self.y
-        self.speed = speed
-        self.is_moving = False
-        self.direction = DIRECTION_DOWN
 
-        # Create animations for each direction
-        # Each direction has its own animation with multiple frames
-        self.idle_animations = {
-            DIRECTION_DOWN: Animation(
-                idle_frames_by_direction[DIRECTION_DOWN], speed=0.4
-            ),
-            DIRECTION_LEFT: Animation(
-                idle_frames_by_direction[DIRECTION_LEFT], speed=0.4
-            ),
-            DIRECTION_RIGHT: Animation(
-                idle_frames_by_direction[DIRECTION_RIGHT], speed=0.4
-            ),
-            DIRECTION_UP: Animation(idle_frames_by_direction[DIRECTION_UP], speed=0.4),
-        }
-        self.moving_animations = {
-            DIRECTION_DOWN: Animation(
-                moving_frames_by_direction[DIRECTION_DOWN], speed=0.12
-            ),
-            DIRECTION_LEFT: Animation(
-                moving_frames_by_direction[DIRECTION_LEFT], speed=0.12
-            ),
-            DIRECTION_RIGHT: Animation(
-                moving_frames_by_direction[DIRECTION_RIGHT], speed=0.12
-            ),
-            DIRECTION_UP: Animation(
-                moving_frames_by_direction[DIRECTION_UP], speed=0.12
-            ),
-        }
+def animation_clips(idle_frames, moving_frames):
+    """Clips of a sprite set, indexed by slot (is_moving * 4 + direction)."""
+    return [
+        Animation(sprite_indices(names), IDLE_FRAME_TIME) for names in idle_frames
+    ] + [Animation(sprite_indices(names), MOVING_FRAME_TIME) for names in moving_frames]
 
-    def move_to_cell(self, new_x, new_y):
-        """Move character to a new grid cell."""
-        if not self.is_moving:
-            self.grid_x = new_x
-            self.grid_y = new_y
-            self.target_x = new_x * CELL_SIZE + CELL_SIZE // 2
-            self.target_y = new_y * CELL_SIZE + CELL_SIZE // 2
-            self.is_moving = True
 
-    def update_position(self, dt):
-        """Update character position and animation."""
-        # Update animation for current direction
-        anim_dict = self.moving_animations if self.is_moving else self.idle_animations
-        current_anim = anim_dict.get(self.direction)
-        if current_anim:
-            current_anim.update(dt)
+# Shared animation clips of each sprite set
+HERO_CLIPS = animation_clips(HERO_IDLE_FRAMES, HERO_MOVING_FRAMES)
+ENEMY_CLIPS = animation_clips(ENEMY_IDLE_FRAMES, ENEMY_MOVING_FRAMES)
 
-        # Smooth movement interpolation
-        dx = self.target_x - self.x
-        dy = self.target_y - self.y
-        dist = math.hypot(dx, dy)
-        if dist == 0:
-            self.is_moving = False
-            return
-        if dist <= self.speed:
-            self.x = self.target_x
-            self.y = self.target_y
-            self.is_moving = False
-        else:
-            self.x += (dx / dist) * self.speed
-            self.y += (dy / dist) * self.speed
 
-    def draw_on_screen(self):
-        """Draw character on screen with sprite animation."""
-        # Get current animation for direction
-        anim_dict = self.moving_animations if self.is_moving else self.idle_animations
-        current_anim = anim_dict.get(self.direction)
-        frame_name = None
-        if current_anim:
-            frame_name = current_anim.current_frame()
-
-        # Try to draw using Actor if image exists
-        if frame_name:
-            try:
-                Actor(frame_name, (self.x, self.y)).draw()
-                return
-            except Exception:
-                pass
+def find_file(directory, name, extensions=IMAGE_EXTENSIONS):
+    """Path of the file called name (an image by default), or None."""
+    for extension in extensions:
+        path = os.path.join(directory, name + extension)
+        if os.path.isfile(path):
+            return path
+    return None
 
-        # Fallback: draw simple animated shape
-        radius = int(CELL_SIZE / 2.6)
-        frame_idx = current_anim.index if current_anim else 0
-        # Animate size based on frame (real animation effect)
-        size_variation = (frame_idx % 3) * 2
-        radius_animated = radius + size_variation
-        screen.draw.filled_circle(
-            (int(self.x), int(self.y)), radius_animated, (200, 200, 200)
-        )
-        # Animated eyes
-        eye_offset = (frame_idx % 2) * 2 - 1
-        screen.draw.filled_circle(
-            (int(self.x - 6 + eye_offset), int(self.y - 6)), 3, "white"
-        )
-        screen.draw.filled_circle(
-            (int(self.x + 6 + eye_offset), int(self.y - 6)), 3, "white"
-        )
 
+def pack_sprites(images, width=ATLAS_WIDTH):
+    """Pack images (None for missing ones) in rows of one surface.
 
-class Hero(Character):
-    """Player-controlled hero character."""
+    Returns the atlas surface and the rect of each image in it (None for
+    missing images). Tallest images go first so rows waste little space.
+    """
+    order = sorted(
+        (i for i, image in enumerate(images) if image is not None),
+        key=lambda i: -images[i].get_height(),
+    )
+    rects = [None] * len(images)
+    x = y = row_height = 0
+    for i in order:
+        w, h = images[i].get_size()
+        if x + w > width and x > 0:
+            x = 0
+            y += row_height
+            row_height = 0
+        rects[i] = Rect(x, y, w, h)
+        x += w
+        row_height = max(row_height, h)
+    atlas = Surface((width, max(1, y + row_height)), SRCALPHA, 32)
+    atlas.fill((0, 0, 0, 0))
+    atlas.blits([(images[i], rects[i]) for i in order], False)
+    return atlas, rects
 
-    def __init__(self, grid_x, grid_y):
-        idle_frames = [
-            SPRITE_HERO_IDLE_DOWN,
-            SPRITE_HERO_IDLE_LEFT,
-            SPRITE_HERO_IDLE_RIGHT,
-            SPRITE_HERO_IDLE_UP,
-        ]
-        moving_frames = [
-            SPRITE_HERO_MOVING_DOWN,
-            SPRITE_HERO_MOVING_LEFT,
-            SPRITE_HERO_MOVING_RIGHT,
-            SPRITE_HERO_MOVING_UP,
-        ]
-        super().__init__(grid_x, grid_y, idle_frames, moving_frames, speed=4.0)
-        self.health = 100
-        # Collected coins count
-        self.coins = 0
-        # Damage cooldown timer (seconds). When >0 hero is invulnerable to further hits
-        self.damage_timer = 0.0
-        # Minimal delay between enemy damages (seconds)
-        self.damage_cooldown = 0.45
 
-    def process_input(self, grid):
-        """Process player input for movement."""
-        if self.is_moving:
-            return
+class SpriteAtlas:
+    """Sprite frames packed in one surface, with a frame rect table.
 
-        new_x, new_y = self.grid_x, self.grid_y
-        if keyboard.up or keyboard.w:
-            new_y = max(0, self.grid_y - 1)
-            self.direction = DIRECTION_UP
-        elif keyboard.down or keyboard.s:
-            new_y = min(ROWS - 1, self.grid_y + 1)
-            self.direction = DIRECTION_DOWN
-        elif keyboard.left or keyboard.a:
-            new_x = max(0, self.grid_x - 1)
-            self.direction = DIRECTION_LEFT
-        elif keyboard.right or keyboard.d:
-            new_x = min(COLUMNS - 1, self.grid_x + 1)
-            self.direction = DIRECTION_RIGHT
+    Frames are SPRITE_NAMES indices. Missing images have no rect: draw()
+    returns False for them so callers can draw a fallback shape.
+    """
 
-        # Move if position changed and cell is not obstacle
-        if (new_x, new_y) != (self.grid_x, self.grid_y) and not grid[new_y][new_x]:
-            self.move_to_cell(new_x, new_y)
-            play_sound("step")
+    def __init__(self, surface, rects):
+        self.surface = surface
+        self.rects = rects
+        self.frames = [surface.subsurface(rect) if rect else None for rect in rects]
+        # Offsets that center a frame on a point (like Actor's center anchor)
+        self.anchors = [(rect.w / 2, rect.h / 2) if rect else None for rect in rects]
 
+    def converted(self):
+        """Same atlas with its surface converted for the display (if any)."""
+        if pygame_display.get_surface() is None:
+            return self
+        return SpriteAtlas(self.surface.convert_alpha(), self.rects)
 
-class Enemy(Character):
-    """Enemy character with simple AI."""
+    def draw(self, surface, frame, x, y):
+        """Blit frame centered at (x, y); False if the image is missing."""
+        image = self.frames[frame]
+        if image is None:
+            return False
+        anchor_x, anchor_y = self.anchors[frame]
+        surface.blit(image, (x - anchor_x, y - anchor_y))
+        return True
 
-    def __init__(self, grid_x, grid_y, radius=3):
-        idle_frames = [
-            SPRITE_ENEMY_IDLE_DOWN,
-            SPRITE_ENEMY_IDLE_LEFT,
-            SPRITE_ENEMY_IDLE_RIGHT,
-            SPRITE_ENEMY_IDLE_UP,
-        ]
-        moving_frames = [
-            SPRITE_ENEMY_MOVING_DOWN,
-            SPRITE_ENEMY_MOVING_LEFT,
-            SPRITE_ENEMY_MOVING_RIGHT,
-            SPRITE_ENEMY_MOVING_UP,
-        ]
-        super().__init__(grid_x, grid_y, idle_frames, moving_frames, speed=2.0)
-        self.start_position = (grid_x, grid_y)
-        self.radius = radius
-        self.timer = 0.0
-
-    def update_ai(self, dt, grid, hero):
-        """Update enemy AI and movement."""
-        self.timer += dt
-        # If hero is nearby, try to approach
-        distance = abs(self.grid_x - hero.grid_x) + abs(self.grid_y - hero.grid_y)
-        if distance <= self.radius and not self.is_moving:
-            dx = hero.grid_x - self.grid_x
-            dy = hero.grid_y - self.grid_y
-            if abs(dx) > abs(dy):
-                new_x = self.grid_x + (1 if dx > 0 else -1)
-                new_y = self.grid_y
-                self.direction = DIRECTION_RIGHT if dx > 0 else DIRECTION_LEFT
-            else:
-                new_x = self.grid_x
-                new_y = self.grid_y + (1 if dy > 0 else -1)
-                self.direction = DIRECTION_DOWN if dy > 0 else DIRECTION_UP
-            if 0 <= new_x < COLUMNS and 0 <= new_y < ROWS and not grid[new_y][new_x]:
-                self.move_to_cell(new_x, new_y)
-            return
 
-        # Random patrol within territory
-        if self.timer >= 1.0 and not self.is_moving:
-            self.timer = 0.0
-            directions = [(1, 0), (-1, 0), (0, 1), (0, -1)]
-            random.shuffle(directions)
-            for dx, dy in directions:
-                new_x = self.grid_x + dx
-                new_y = self.grid_y + dy
-                dist_from_start = abs(new_x - self.start_position[0]) + abs(
-                    new_y - self.start_position[1]
-                )
-                if (
-                    0 <= new_x < COLUMNS
-                    and 0 <= new_y < ROWS
-                    and not grid[new_y][new_x]
-                    and dist_from_start <= self.radius
-                ):
-                    # Set direction based on movement
-                    if dx > 0:
-                        self.direction = DIRECTION_RIGHT
-                    elif dx < 0:
-                        self.direction = DIRECTION_LEFT
-                    elif dy > 0:
-                        self.direction = DIRECTION_DOWN
-                    elif dy < 0:
-                        self.direction = DIRECTION_UP
-                    self.move_to_cell(new_x, new_y)
-                    break
+def load_sprite_atlas(
+    names, image_dir=IMAGES_DIR, cache_dir=ATLAS_CACHE_DIR, convert=None
+):
+    """Build the atlas of names, reusing the one cached on disk if up to date.
 
+    The cache is an atlas PNG plus a JSON manifest with the frame rects and
+    the size and modification time of every source image. Any change in the
+    names or the sources rebuilds it. Surfaces are converted for the display
+    if convert (default: if there is a display); see SpriteAtlas.converted().
+    """
+    paths = [find_file(image_dir, name) for name in names]
+    sources = []
+    for path in paths:
+        if path is None:
+            sources.append(None)
+        else:
+            stat = os.stat(path)
+            sources.append([stat.st_size, stat.st_mtime_ns])
+    manifest_path = os.path.join(cache_dir, "sprites.json")
+    atlas_path = os.path.join(cache_dir, "sprites.png")
+    if convert is None:
+        convert = pygame_display.get_surface() is not None
+    try:
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        if (
+            manifest["format"] == ATLAS_CACHE_FORMAT
+            and manifest["names"] == list(names)
+            and manifest["sources"] == sources
+        ):
+            surface = pygame_image.load(atlas_path)
+            if convert:
+                surface = surface.convert_alpha()
+            rects = [Rect(rect) if rect else None for rect in manifest["rects"]]
+            return SpriteAtlas(surface, rects)
+    except (OSError, ValueError, KeyError, pygame_error):
+        pass
+    images = []
+    for path in paths:
+        image = pygame_image.load(path) if path else None
+        if image is not None and convert:
+            image = image.convert_alpha()
+        images.append(image)
+    surface, rects = pack_sprites(images)
+    manifest = {
+        "format": ATLAS_CACHE_FORMAT,
+        "names": list(names),
+        "sources": sources,
+        "rects": [list(rect) if rect else None for rect in rects],
+    }
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        pygame_image.save(surface, atlas_path)
+        # Written last, so a half-written cache is never trusted
+        with open(manifest_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+    except (OSError, pygame_error):
+        pass
+    return SpriteAtlas(surface, rects)
 
-def create_grid():
-    """Create game grid with random obstacles."""
-    g = [[False for _ in range(COLUMNS)] for _ in range(ROWS)]
-    # Create some random obstacles
-    for _ in range(25):
-        x = random.randint(0, COLUMNS - 1)
-        y = random.randint(0, ROWS - 1)
-        g[y][x] = True
-    return g
 
+def load_sprites():
+    """Return the shared sprite atlas, loading it on first use.
 
-def spawn_coin(grid, exclude_positions=None):
-    """Spawn a coin on a random free cell not in exclude_positions.
+    If the AssetLoader is on it, waits for its atlas instead of loading
+    another one.
+    """
+    global sprite_atlas
+    if sprite_atlas is None:
+        if asset_loader is not None:
+            asset_loader.atlas_loaded.wait()
+        if asset_loader is not None and asset_loader.atlas is not None:
+            sprite_atlas = asset_loader.atlas.converted()
+        else:
+            sprite_atlas = load_sprite_atlas(SPRITE_NAMES)
+    return sprite_atlas
 
-    exclude_positions: iterable of (x,y) tuples to avoid (hero/enemies).
-    Returns (x,y) or None if no free cell found.
+
+class TextCache:
+    """Rendered text surfaces keyed by text, font size and color.
+
+    At most max_entries surfaces are kept; the least recently used are
+    dropped first.
     """
-    if exclude_positions is None:
-        exclude_positions = set()
-    else:
-        exclude_positions = set(exclude_positions)
 
-    free_cells = []
-    for y in range(ROWS):
-        for x in range(COLUMNS):
-            if not grid[y][x] and (x, y) not in exclude_positions:
-                free_cells.append((x, y))
-    if not free_cells:
-        return None
-    return random.choice(free_cells)
+    def __init__(self, max_entries=TEXT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.surfaces = OrderedDict()
 
+    def get(self, text, fontsize, color):
+        """Surface with text rendered, from the cache when possible."""
+        key = (text, fontsize, color)
+        surf = self.surfaces.get(key)
+        if surf is None:
+            surf = ptext.getsurf(text, fontsize=fontsize, color=color, cache=False)
+            self.surfaces[key] = surf
+            if len(self.surfaces) > self.max_entries:
+                self.surfaces.popitem(last=False)
+        else:
+            self.surfaces.move_to_end(key)
+        return surf
 
-def start_game():
-    """Start a new game."""
-    global game_state, game_grid, game_hero, game_enemies
-    game_state = STATE_PLAYING
-    game_grid = create_grid()
-    # Create hero in free position
-    hero_x, hero_y = 2, 2
-    while game_grid[hero_y][hero_x]:
-        hero_x = random.randint(0, COLUMNS - 1)
-        hero_y = random.randint(0, ROWS - 1)
-    game_hero = Hero(hero_x, hero_y)
-    # Create enemies
-    game_enemies = []
-    for _ in range(4):
-        enemy_x = random.randint(5, COLUMNS - 1)
-        enemy_y = random.randint(5, ROWS - 1)
-        while game_grid[enemy_y][enemy_x]:
-            enemy_x = random.randint(5, COLUMNS - 1)
-            enemy_y = random.randint(5, ROWS - 1)
-        game_enemies.append(Enemy(enemy_x, enemy_y, radius=4))
-    # Spawn a coin somewhere not occupied by hero or enemies
-    global game_coin
-    exclude = {(game_hero.grid_x, game_hero.grid_y)}
-    for e in game_enemies:
-        exclude.add((e.grid_x, e.grid_y))
-    game_coin = spawn_coin(game_grid, exclude_positions=exclude)
-    # Play music if enabled
-    if music_enabled:
-        play_music("background")
+    def draw(self, surface, text, fontsize, color, topleft=None, center=None):
+        """Blit text at topleft, or centered at center (like screen.draw.text)."""
+        surf = self.get(text, fontsize, color)
+        if center is not None:
+            x = int(round(center[0] - 0.5 * surf.get_width()))
+            y = int(round(center[1] - 0.5 * surf.get_height()))
+        else:
+            x, y = topleft
+        surface.blit(surf, (x, y))
 
 
-def update(dt):
-    """PgZero update function called each frame."""
-    global game_state
-    if game_state == STATE_MENU:
-        return
-    if game_state == STATE_PLAYING:
-        # Update hero
-        if game_hero:
-            # decrement damage timer
-            if getattr(game_hero, "damage_timer", 0.0) > 0.0:
-                game_hero.damage_timer = max(0.0, game_hero.damage_timer - dt)
-            game_hero.process_input(game_grid)
-            game_hero.update_position(dt)
-            # Check coin pickup
-            global game_coin
-            if game_coin and (game_hero.grid_x, game_hero.grid_y) == game_coin:
-                game_hero.coins = getattr(game_hero, "coins", 0) + 1
-                play_sound("coin")
-                # Respawn coin avoiding hero and enemies
-                exclude = {(game_hero.grid_x, game_hero.grid_y)}
-                for e in game_enemies:
-                    exclude.add((e.grid_x, e.grid_y))
-                game_coin = spawn_coin(game_grid, exclude_positions=exclude)
-        # Update enemies
-        for enemy in game_enemies:
-            enemy.update_ai(dt, game_grid, game_hero)
-            enemy.update_position(dt)
-            # Simple collision: same grid cell causes damage
-            if enemy.grid_x == game_hero.grid_x and enemy.grid_y == game_hero.grid_y:
-                # Only apply damage if cooldown expired
-                if getattr(game_hero, "damage_timer", 0.0) <= 0.0:
-                    game_hero.health -= 5
-                    game_hero.damage_timer = getattr(game_hero, "damage_cooldown", 0.45)
-                    play_sound("hit")
-                    if game_hero.health <= 0:
-                        game_hero.health = 0
-                        game_state = STATE_GAME_OVER
-                        play_sound("game_over")
-    elif game_state == STATE_GAME_OVER:
-        # Return to menu with space key
-        if keyboard.space:
-            game_state = STATE_MENU
-            stop_music()
+def draw_text(surface, text, fontsize, color, topleft=None, center=None):
+    """Draw text through the shared TextCache."""
+    global text_cache
+    if text_cache is None:
+        text_cache = TextCache()
+    text_cache.draw(surface, text, fontsize, color, topleft, center)
 
 
-def draw():
-    """PgZero draw function called each frame."""
-    screen.fill((25, 30, 45))
-    if game_state == STATE_MENU:
-        draw_menu()
-    elif game_state == STATE_PLAYING:
-        draw_game()
-    else:
-        draw_game()
-        draw_game_over()
+class FrameProfiler:
+    """Time spent in each phase of the last frames, in a fixed-size ring buffer.
 
+    Every frame is one row: seconds per PROFILE_PHASES phase, the whole
+    frame interval and the enemy counts. lap(phase) adds the time since the
+    previous lap (or mark()) to phase, so a phase run by several ticks adds
+    up. Callers keep a None profiler when profiling is off.
+    """
 
-def draw_grid():
-    """Draw the game grid."""
-    for y in range(ROWS):
-        for x in range(COLUMNS):
-            r = Rect(x * CELL_SIZE, y * CELL_SIZE, CELL_SIZE, CELL_SIZE)
-            if game_grid[y][x]:
-                screen.draw.filled_rect(r, (60, 60, 70))
-            else:
-                screen.draw.rect(r, (45, 45, 60))
+    COLUMNS = PROFILE_PHASES + ("frame", "enemies", "awake")
 
+    def __init__(self, capacity=PROFILER_FRAMES, clock=time.perf_counter):
+        self.capacity = capacity
+        self.clock = clock
+        self.column = {name: i for i, name in enumerate(self.COLUMNS)}
+        self.samples = np.zeros((capacity, len(self.COLUMNS)))
+        # Frames started so far; the current row is frames % capacity
+        self.frames = 0
+        self.row = self.samples[0]
+        self.frame_start = None
+        self.last = clock()
+        # Overlay lines and the frame count they were computed at
+        self.lines = None
+        self.summarized = 0
 
-def draw_game():
-    """Draw the game screen."""
-    # Draw grid
-    draw_grid()
-    # Draw coin on the map
-    if game_coin:
-        cx, cy = game_coin
-        px = cx * CELL_SIZE + CELL_SIZE // 2
-        py = cy * CELL_SIZE + CELL_SIZE // 2
-        try:
-            Actor("coin", (px, py)).draw()
-        except Exception:
-            # fallback: simple yellow circle
-            screen.draw.filled_circle((px, py), CELL_SIZE // 4, (220, 200, 40))
-    # Draw characters
-    if game_hero:
-        game_hero.draw_on_screen()
-    for enemy in game_enemies:
-        enemy.draw_on_screen()
-    # Draw HUD
-    if game_hero:
-        screen.draw.text(
-            f"HEALTH: {game_hero.health}  COINS: {getattr(game_hero, 'coins', 0)}",
-            (10, 10),
-            fontsize=28,
-            color="white",
-        )
+    def begin_frame(self, enemies=None):
+        """Close the current frame and start a new row."""
+        now = self.clock()
+        if self.frame_start is not None:
+            self.row[self.column["frame"]] = now - self.frame_start
+            if enemies is not None:
+                self.row[self.column["enemies"]] = len(enemies)
+                self.row[self.column["awake"]] = len(enemies.awake_rows)
+            self.frames += 1
+            self.row = self.samples[self.frames % self.capacity]
+            self.row[:] = 0.0
+        self.frame_start = now
+        self.last = now
 
+    def mark(self):
+        """Start timing from now (time since the last lap isn't counted)."""
+        self.last = self.clock()
 
-def draw_menu():
-    """Draw the main menu."""
-    screen.draw.text(
-        "SIMPLE ROGUELIKE",
-        center=(WIDTH / 2, 120),
-        fontsize=56,
-        color="white",
-    )
-    # Buttons: start, music/sounds, exit
-    top = 240
-    width = 260
-    height = 56
-    left = WIDTH // 2 - width // 2
+    def lap(self, phase):
+        """Add the time since the last lap or mark() to phase."""
+        now = self.clock()
+        self.row[self.column[phase]] += now - self.last
+        self.last = now
 
-    # Start button
-    btn_start = Rect(left, top, width, height)
-    screen.draw.filled_rect(btn_start, (70, 130, 70))
-    screen.draw.text(
-        "START GAME",
-        center=btn_start.center,
-        fontsize=34,
-        color="white",
-    )
+    def overlay(self):
+        """summary() as a tuple, recomputed every PROFILER_REFRESH frames."""
+        if self.lines is None or self.frames - self.summarized >= PROFILER_REFRESH:
+            self.lines = tuple(self.summary())
+            self.summarized = self.frames
+        return self.lines
 
-    # Music/Sounds toggle button
-    btn_music = Rect(left, top + 90, width, height)
-    music_color = (120, 100, 60) if music_enabled else (80, 80, 80)
-    screen.draw.filled_rect(btn_music, music_color)
-    music_text = "MUSIC/SOUNDS: ON" if music_enabled else "MUSIC/SOUNDS: OFF"
-    screen.draw.text(music_text, center=btn_music.center, fontsize=24, color="white")
+    def recorded(self):
+        """Rows of the finished frames still in the buffer, oldest first."""
+        if self.frames < self.capacity:
+            return self.samples[: self.frames].copy()
+        start = self.frames % self.capacity
+        return np.concatenate((self.samples[start + 1 :], self.samples[:start]))
 
-    # Exit button
-    btn_exit = Rect(left, top + 180, width, height)
-    screen.draw.filled_rect(btn_exit, (150, 50, 50))
-    screen.draw.text("EXIT", center=btn_exit.center, fontsize=34, color="white")
+    def summary(self):
+        """Overlay lines: frame time percentiles, phases and enemy counts."""
+        rows = self.recorded()
+        if len(rows) == 0:
+            return ["profiling..."]
+        ms = rows[:, : len(PROFILE_PHASES) + 1] * 1000.0
+        p50, p95, p99 = np.percentile(ms[:, -1], (50, 95, 99))
+        lines = [f"frame ms  p50 {p50:.1f}  p95 {p95:.1f}  p99 {p99:.1f}"]
+        phase_p95 = np.percentile(ms[:, :-1], 95, axis=0)
+        for name, mean, p95 in zip(PROFILE_PHASES, ms[:, :-1].mean(axis=0), phase_p95):
+            lines.append(f"{name:<10} {mean:6.2f}  p95 {p95:6.2f}")
+        enemies, awake = rows[-1, -2:]
+        lines.append(f"enemies {int(enemies)}  awake {int(awake)}")
+        return lines
 
+    def write_csv(self, path=PROFILE_CSV_PATH):
+        """Write the recorded frames to path (times in milliseconds)."""
+        rows = self.recorded()
+        first = self.frames - len(rows)
+        header = ["frame_number"] + [f"{name}_ms" for name in self.COLUMNS[:-2]]
+        with open(path, "w") as csv_file:
+            csv_file.write(",".join(header + ["enemies", "awake"]) + "\n")
+            for number, row in enumerate(rows.tolist(), first):
+                times = [f"{value * 1000.0:.4f}" for value in row[:-2]]
+                counts = [str(int(value)) for value in row[-2:]]
+                csv_file.write(",".join([str(number)] + times + counts) + "\n")
 
-def draw_game_over():
-    """Draw the game over screen."""
-    # Dark overlay
-    screen.draw.filled_rect(Rect(0, 0, WIDTH, HEIGHT), (0, 0, 0, 120))
-    screen.draw.text(
-        "GAME OVER",
-        center=(WIDTH / 2, HEIGHT // 2 - 30),
-        fontsize=56,
-        color="red",
-    )
-    screen.draw.text(
-        "Press SPACE to return to menu",
-        center=(WIDTH / 2, HEIGHT // 2 + 30),
-        fontsize=22,
-        color="white",
-    )
 
+# Byte table that turns blocked cells (1) into 0 and free cells (0) into 1
+FREE_CELLS_TABLE = bytes([1] + [0] * 255)
 
-def on_mouse_down(pos):
-    """Handle mouse clicks on menu."""
-    global music_enabled, sounds_enabled
-    if game_state != STATE_MENU:
-        return
-    top = 240
-    width = 260
-    height = 56
-    left = WIDTH // 2 - width // 2
-    # Start button
-    if Rect(left, top, width, height).collidepoint(pos):
-        play_sound("button_click")
-        start_game()
-    # Music/Sounds toggle button
-    elif Rect(left, top + 90, width, height).collidepoint(pos):
-        music_enabled = not music_enabled
-        sounds_enabled = music_enabled
-        if music_enabled:
-            play_music("background")
-        else:
-            stop_music()
+
+class Grid:
+    """Compact grid of obstacles, one byte per cell (1 = blocked).
+
+    Cells are stored row by row in a bytearray, so a 1000x1000 map takes
+    1 MB. version changes on every edit, letting caches know when to rebuild.
+    """
+
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = rows
+        self.cells = bytearray(columns * rows)
+        self.version = 0
+
+    def in_bounds(self, x, y):
+        """Check if (x, y) is inside the grid."""
+        return 0 <= x < self.columns and 0 <= y < self.rows
+
+    def is_blocked(self, x, y):
+        """Check if the cell at (x, y) is an obstacle."""
+        return self.cells[y * self.columns + x] != 0
+
+    def set_blocked(self, x, y, blocked=True):
+        """Mark a single cell as obstacle (or free)."""
+        self.cells[y * self.columns + x] = 1 if blocked else 0
+        self.version += 1
+
+    def fill_rect(self, x, y, width, height, blocked=True):
+        """Mark a rectangle of cells, clipped to the grid, in one pass per row."""
+        left = max(0, x)
+        right = min(self.columns, x + width)
+        if left >= right:
+            return
+        row_bytes = bytes([1 if blocked else 0]) * (right - left)
+        for row in range(max(0, y), min(self.rows, y + height)):
+            start = row * self.columns + left
+            self.cells[start : start + len(row_bytes)] = row_bytes
+        self.version += 1
+
+    def count_free(self):
+        """Count cells that are not obstacles."""
+        return self.cells.count(0)
+
+    def row(self, y, first_x=0, last_x=None):
+        """Return the cells of row y (from first_x to last_x) as bytes."""
+        start = y * self.columns
+        if last_x is None:
+            last_x = self.columns
+        return self.cells[start + first_x : start + last_x]
+
+    def window(self, left, top, width, height):
+        """Cells of a width x height rectangle as bytes, row by row.
+
+        Cells outside the grid read as blocked.
+        """
+        out = bytearray(b"\x01") * (width * height)
+        first_x = max(0, left)
+        last_x = min(self.columns, left + width)
+        if first_x < last_x:
+            for y in range(max(0, top), min(self.rows, top + height)):
+                start = (y - top) * width + first_x - left
+                out[start : start + last_x - first_x] = self.row(y, first_x, last_x)
+        return out
+
+    def blocked_mask(self, xs, ys):
+        """Boolean array telling which (xs, ys) cells are blocked or outside."""
+        inside = (xs >= 0) & (xs < self.columns) & (ys >= 0) & (ys < self.rows)
+        cells = np.frombuffer(self.cells, dtype=np.uint8)
+        return ~inside | (cells[np.where(inside, ys * self.columns + xs, 0)] != 0)
+
+    def index(self, x, y):
+        """Flat index of the cell (x, y)."""
+        return y * self.columns + x
+
+    def position(self, index):
+        """Cell (x, y) of a flat index."""
+        y, x = divmod(index, self.columns)
+        return x, y
+
+    def free_indices(self, exclude_positions=()):
+        """Flat indices of free cells, skipping exclude_positions.
+
+        The scan runs in C (translate + compress) instead of a Python loop
+        over every cell.
+        """
+        free = bytearray(self.cells.translate(FREE_CELLS_TABLE))
+        for x, y in exclude_positions:
+            if self.in_bounds(x, y):
+                free[y * self.columns + x] = 0
+        return list(compress(range(len(free)), free))
+
+
+class ChunkedGrid:
+    """Very large grid generated lazily in square chunks.
+
+    Offers the same queries as Grid, but a chunk is only generated when one
+    of its cells is read. Generation is seeded per chunk, so evicted chunks
+    come back identical. At most max_chunks generated chunks stay loaded
+    (least recently used are evicted); edited chunks are kept apart and
+    never evicted.
+    """
+
+    def __init__(
+        self,
+        columns,
+        rows,
+        seed=0,
+        density=WORLD_OBSTACLE_DENSITY,
+        max_chunks=MAX_LOADED_CHUNKS,
+    ):
+        self.columns = columns
+        self.rows = rows
+        self.seed = seed
+        self.density = density
+        self.max_chunks = max_chunks
+        self.version = 0
+        # Random byte -> cell value table giving the obstacle density
+        threshold = round(256 * density)
+        self.obstacle_table = bytes(
+            [1 if value < threshold else 0 for value in range(256)]
+        )
+        self.chunks = OrderedDict()
+        self.edited = {}
+
+    # Same helpers as Grid (they only rely on columns, rows and row())
+    in_bounds = Grid.in_bounds
+    index = Grid.index
+    position = Grid.position
+    window = Grid.window
+
+    def generate_chunk(self, chunk_x, chunk_y):
+        """Create the cells of one chunk from its own random seed."""
+        rng = random.Random((self.seed * 1_000_003 + chunk_x) * 1_000_033 + chunk_y)
+        cells = rng.randbytes(CHUNK_CELLS * CHUNK_CELLS)
+        return bytearray(cells.translate(self.obstacle_table))
+
+    def chunk(self, chunk_x, chunk_y):
+        """Cells of a chunk, generating it (and evicting old ones) as needed."""
+        key = (chunk_x, chunk_y)
+        cells = self.edited.get(key)
+        if cells is not None:
+            return cells
+        cells = self.chunks.get(key)
+        if cells is None:
+            cells = self.generate_chunk(chunk_x, chunk_y)
+            self.chunks[key] = cells
+            if len(self.chunks) > self.max_chunks:
+                self.chunks.popitem(last=False)
+        else:
+            self.chunks.move_to_end(key)
+        return cells
+
+    def edit_chunk(self, chunk_x, chunk_y):
+        """Cells of a chunk about to be edited (no longer evictable)."""
+        key = (chunk_x, chunk_y)
+        if key not in self.edited:
+            self.edited[key] = self.chunk(chunk_x, chunk_y)
+            self.chunks.pop(key, None)
+        return self.edited[key]
+
+    def is_blocked(self, x, y):
+        """Check if the cell at (x, y) is an obstacle."""
+        cells = self.chunk(x // CHUNK_CELLS, y // CHUNK_CELLS)
+        return cells[(y % CHUNK_CELLS) * CHUNK_CELLS + x % CHUNK_CELLS] != 0
+
+    def set_blocked(self, x, y, blocked=True):
+        """Mark a single cell as obstacle (or free)."""
+        cells = self.edit_chunk(x // CHUNK_CELLS, y // CHUNK_CELLS)
+        cells[(y % CHUNK_CELLS) * CHUNK_CELLS + x % CHUNK_CELLS] = 1 if blocked else 0
+        self.version += 1
+
+    def fill_rect(self, x, y, width, height, blocked=True):
+        """Mark a rectangle of cells, clipped to the grid, chunk by chunk."""
+        left = max(0, x)
+        right = min(self.columns, x + width)
+        value = bytes([1 if blocked else 0])
+        for row in range(max(0, y), min(self.rows, y + height)):
+            column = left
+            while column < right:
+                chunk_x = column // CHUNK_CELLS
+                end = min(right, (chunk_x + 1) * CHUNK_CELLS)
+                cells = self.edit_chunk(chunk_x, row // CHUNK_CELLS)
+                start = (row % CHUNK_CELLS) * CHUNK_CELLS + column % CHUNK_CELLS
+                cells[start : start + end - column] = value * (end - column)
+                column = end
+        self.version += 1
+
+    def row(self, y, first_x=0, last_x=None):
+        """Return the cells of row y (from first_x to last_x) as bytes."""
+        if last_x is None:
+            last_x = self.columns
+        out = bytearray()
+        offset = (y % CHUNK_CELLS) * CHUNK_CELLS
+        column = first_x
+        while column < last_x:
+            chunk_x = column // CHUNK_CELLS
+            end = min(last_x, (chunk_x + 1) * CHUNK_CELLS)
+            cells = self.chunk(chunk_x, y // CHUNK_CELLS)
+            start = offset + column % CHUNK_CELLS
+            out += cells[start : start + end - column]
+            column = end
+        return out
+
+    def chunk_cells(self, xs, ys):
+        """Where NumPy arrays of cells (x inside the grid, any y) are stored.
+
+        Returns the (chunk_x, chunk_y) of each chunk involved, then for every
+        cell the index of its chunk in that list and its offset inside it.
+        """
+        stride = self.columns // CHUNK_CELLS + 1
+        keys, which = np.unique(
+            (ys // CHUNK_CELLS) * stride + xs // CHUNK_CELLS, return_inverse=True
+        )
+        chunks = [divmod(key, stride)[::-1] for key in keys.tolist()]
+        offsets = (ys % CHUNK_CELLS) * CHUNK_CELLS + xs % CHUNK_CELLS
+        return chunks, which.reshape(xs.shape), offsets
+
+    def blocked_mask(self, xs, ys):
+        """Boolean array telling which (xs, ys) cells are blocked or outside.
+
+        Each chunk involved is read once; the cells are then looked up in
+        their bytes, joined into one NumPy array.
+        """
+        inside = (xs >= 0) & (xs < self.columns) & (ys >= 0) & (ys < self.rows)
+        blocked = ~inside
+        if inside.any():
+            chunks, which, offsets = self.chunk_cells(xs[inside], ys[inside])
+            cells = b"".join([self.chunk(*key) for key in chunks])
+            cells = np.frombuffer(cells, np.uint8)
+            blocked[inside] = cells[which * CHUNK_CELLS * CHUNK_CELLS + offsets] != 0
+        return blocked
+
+
+class OccupancyIndex:
+    """Entities standing on each cell, kept up to date as they move.
+
+    Characters (heroes) are tracked one by one, in a dict from flat index
+    to the characters on that cell. Enemies are only counted per cell, in
+    NumPy arrays that a whole tick of enemy moves updates at once
+    (move_enemies()). A Grid has one count per cell; a ChunkedGrid only has
+    counts for the chunks holding enemies, so storage doesn't grow with the
+    size of the world.
+    """
+
+    def __init__(self, grid):
+        self.grid = grid
+        # flat index -> list of characters on that cell
+        self.cells = {}
+        # Enemies on each flat index (Grid), or (chunk_x, chunk_y) -> enemies
+        # on each cell of that chunk (ChunkedGrid)
+        self.enemy_counts = None
+        self.chunk_counts = {}
+        if not isinstance(grid, ChunkedGrid):
+            self.enemy_counts = np.zeros(grid.columns * grid.rows, np.int32)
+
+    def add(self, entity, x, y):
+        """Start tracking entity at (x, y)."""
+        index = self.grid.index(x, y)
+        self.cells.setdefault(index, []).append(entity)
+
+    def remove(self, entity, x, y):
+        """Stop tracking entity at (x, y)."""
+        index = self.grid.index(x, y)
+        entities = self.cells[index]
+        entities.remove(entity)
+        if not entities:
+            del self.cells[index]
+
+    def move(self, entity, old_x, old_y, new_x, new_y):
+        """Move entity from (old_x, old_y) to (new_x, new_y)."""
+        self.remove(entity, old_x, old_y)
+        self.add(entity, new_x, new_y)
+
+    def add_enemies(self, indices):
+        """Count an enemy on each flat index of a NumPy array."""
+        self.count_enemies(indices, 1)
+
+    def move_enemies(self, old_indices, new_indices):
+        """Move an enemy from each of old_indices to the matching new index."""
+        self.count_enemies(old_indices, -1)
+        self.count_enemies(new_indices, 1)
+
+    def count_enemies(self, indices, delta):
+        """Add delta to the enemy count of each flat index (repeats add up)."""
+        if self.enemy_counts is not None:
+            np.add.at(self.enemy_counts, indices, delta)
+            return
+        if len(indices) == 0:
+            return
+        chunks, which, counts = self.chunk_enemy_counts(indices)
+        np.add.at(counts, which, delta)
+        size = CHUNK_CELLS * CHUNK_CELLS
+        for i, key in enumerate(chunks):
+            chunk_counts = counts[i * size : (i + 1) * size]
+            if chunk_counts.any():
+                self.chunk_counts[key] = chunk_counts.copy()
+            else:
+                self.chunk_counts.pop(key, None)
+
+    def chunk_enemy_counts(self, indices):
+        """Enemy counts of the chunks holding flat indices, as one array.
+
+        Returns the (chunk_x, chunk_y) of those chunks, the position of each
+        index in the array and the array (a copy, zeros for empty chunks).
+        """
+        columns = self.grid.columns
+        chunks, which, offsets = self.grid.chunk_cells(
+            indices % columns, indices // columns
+        )
+        empty = np.zeros(CHUNK_CELLS * CHUNK_CELLS, np.int32)
+        counts = np.concatenate(
+            [self.chunk_counts.get(key, empty) for key in chunks] + [empty[:0]]
+        )
+        return chunks, which * len(empty) + offsets, counts
+
+    def enemy_count(self, x, y):
+        """Number of enemies standing on (x, y)."""
+        if self.enemy_counts is not None:
+            return int(self.enemy_counts[self.grid.index(x, y)])
+        counts = self.chunk_counts.get((x // CHUNK_CELLS, y // CHUNK_CELLS))
+        if counts is None:
+            return 0
+        return int(counts[(y % CHUNK_CELLS) * CHUNK_CELLS + x % CHUNK_CELLS])
+
+    def count(self, x, y):
+        """Number of characters and enemies standing on (x, y)."""
+        characters = len(self.cells.get(self.grid.index(x, y), ()))
+        return characters + self.enemy_count(x, y)
+
+    def enemies_at(self, indices):
+        """Number of enemies on each flat index of a NumPy array.
+
+        Indices outside the grid hold no enemy.
+        """
+        counts = self.enemy_counts
+        if counts is not None:
+            inside = (indices >= 0) & (indices < len(counts))
+            return np.where(inside, counts[np.where(inside, indices, 0)], 0)
+        if indices.size == 0:
+            return np.zeros(indices.shape, np.int32)
+        _, which, counts = self.chunk_enemy_counts(indices)
+        return counts[which]
+
+    def counts_at(self, indices):
+        """Number of characters and enemies on each flat index of a NumPy array."""
+        counts = self.enemies_at(indices)
+        if self.cells:
+            cells = np.fromiter(self.cells, np.int64, len(self.cells))
+            sizes = np.fromiter(map(len, self.cells.values()), np.int32, len(cells))
+            order = np.argsort(cells)
+            cells = cells[order]
+            sizes = sizes[order]
+            found = np.minimum(np.searchsorted(cells, indices), len(cells) - 1)
+            counts += np.where(cells[found] == indices, sizes[found], 0)
+        return counts
+
+    def occupied(self):
+        """Sorted flat indices of the cells holding a character or an enemy."""
+        if self.enemy_counts is not None:
+            enemies = np.flatnonzero(self.enemy_counts)
+        else:
+            parts = [np.zeros(0, np.int64)]
+            for (chunk_x, chunk_y), counts in self.chunk_counts.items():
+                offsets = np.flatnonzero(counts)
+                ys = chunk_y * CHUNK_CELLS + offsets // CHUNK_CELLS
+                xs = chunk_x * CHUNK_CELLS + offsets % CHUNK_CELLS
+                parts.append(ys * self.grid.columns + xs)
+            enemies = np.concatenate(parts)
+        characters = np.fromiter(self.cells, np.int64, len(self.cells))
+        return np.union1d(enemies, characters)
+
+
+class FreeCellIndex:
+    """Free cells not occupied by any entity, with O(1) random pick.
+
+    Cells live in a dense array (swap-remove on delete) plus a slot table
+    from flat index to array position. occupy()/vacate() must be called after
+    the OccupancyIndex is updated; the free cells are rebuilt only when the
+    grid version changes.
+    """
+
+    def __init__(self, grid, occupancy, rng=random):
+        self.grid = grid
+        self.occupancy = occupancy
+        # Random source for sample() (random.Random or the random module)
+        self.rng = rng
+        self.grid_version = None
+        self.cells = array("i")
+        self.slots = array("i")
+
+    def rebuild(self):
+        """Recompute the free cells from the grid and current occupants."""
+        grid = self.grid
+        self.grid_version = grid.version
+        # Built with NumPy, then kept as arrays for cheap single-cell edits
+        cells = spawn_points(grid).astype(np.int32)
+        slots = np.full(grid.columns * grid.rows, -1, np.int32)
+        slots[cells] = np.arange(len(cells), dtype=np.int32)
+        self.cells = array("i", cells.tobytes())
+        self.slots = array("i", slots.tobytes())
+        for index in self.occupancy.occupied().tolist():
+            self.discard(index)
+
+    def restore(self, cells):
+        """Take cells (flat indices, in order) as the free cells of the grid."""
+        grid = self.grid
+        self.grid_version = grid.version
+        slots = np.full(grid.columns * grid.rows, -1, np.int32)
+        slots[cells] = np.arange(len(cells), dtype=np.int32)
+        self.cells = array("i", cells.astype(np.int32).tobytes())
+        self.slots = array("i", slots.tobytes())
+
+    def add(self, index):
+        """Add a flat index to the free cells (no-op if already there)."""
+        if self.slots[index] < 0:
+            self.slots[index] = len(self.cells)
+            self.cells.append(index)
+
+    def discard(self, index):
+        """Remove a flat index from the free cells (no-op if absent)."""
+        slot = self.slots[index]
+        if slot < 0:
+            return
+        last = self.cells.pop()
+        if last != index:
+            self.cells[slot] = last
+            self.slots[last] = slot
+        self.slots[index] = -1
+
+    def occupy(self, x, y):
+        """Record an entity entering (x, y)."""
+        if self.grid_version == self.grid.version:
+            self.discard(self.grid.index(x, y))
+
+    def vacate(self, x, y):
+        """Record an entity leaving (x, y)."""
+        if (
+            self.grid_version == self.grid.version
+            and self.occupancy.count(x, y) == 0
+            and not self.grid.is_blocked(x, y)
+        ):
+            self.add(self.grid.index(x, y))
+
+    def occupy_many(self, indices):
+        """Record entities entering the flat indices of a NumPy array.
+
+        The removed cells' slots are filled by the last free cells, as
+        discard() does one at a time, in a few array operations.
+        """
+        if self.grid_version != self.grid.version:
+            return
+        slots = np.frombuffer(self.slots, np.int32)
+        indices = np.unique(indices)
+        indices = indices[slots[indices] >= 0]
+        if len(indices) == 0:
+            return
+        cells = np.frombuffer(self.cells, np.int32)
+        size = len(cells) - len(indices)
+        holes = slots[indices]
+        slots[indices] = -1
+        tail = cells[size:]
+        kept = tail[slots[tail] >= 0]
+        holes = np.sort(holes[holes < size])
+        cells[holes] = kept
+        slots[kept] = holes
+        # The arrays can't shrink while NumPy views of them exist
+        del slots, cells, tail
+        del self.cells[size:]
+
+    def vacate_many(self, indices):
+        """Record entities leaving the flat indices of a NumPy array."""
+        if self.grid_version != self.grid.version:
+            return
+        indices = np.unique(indices)
+        slots = np.frombuffer(self.slots, np.int32)
+        blocked = np.frombuffer(self.grid.cells, np.uint8)[indices] != 0
+        free = (slots[indices] < 0) & ~blocked
+        free &= self.occupancy.counts_at(indices) == 0
+        indices = indices[free]
+        slots[indices] = np.arange(len(self.cells), len(self.cells) + len(indices))
+        del slots
+        self.cells.frombytes(indices.astype(np.int32).tobytes())
+
+    def sample(self):
+        """Random free, unoccupied cell (x, y), or None if there is none."""
+        if self.grid_version != self.grid.version:
+            self.rebuild()
+        if not self.cells:
+            return None
+        return self.grid.position(self.rng.choice(self.cells))
+
+
+class NearbyCellSampler:
+    """Free-cell picker for worlds too big to index every free cell.
+
+    Same interface as FreeCellIndex, but sample() only looks within radius
+    cells of center (any object with grid_x and grid_y, like the hero).
+    """
+
+    def __init__(self, grid, occupancy, center, radius=COIN_SPAWN_RADIUS, rng=random):
+        self.grid = grid
+        self.occupancy = occupancy
+        self.center = center
+        self.radius = radius
+        self.rng = rng
+
+    def occupy(self, x, y):
+        """Nothing to track: occupancy is checked when sampling."""
+
+    def vacate(self, x, y):
+        """Nothing to track: occupancy is checked when sampling."""
+
+    def occupy_many(self, indices):
+        """Nothing to track: occupancy is checked when sampling."""
+
+    def vacate_many(self, indices):
+        """Nothing to track: occupancy is checked when sampling."""
+
+    def is_free(self, x, y):
+        """Check if (x, y) is inside the grid, not blocked and unoccupied."""
+        return (
+            self.grid.in_bounds(x, y)
+            and not self.grid.is_blocked(x, y)
+            and self.occupancy.count(x, y) == 0
+        )
+
+    def sample(self):
+        """Random free, unoccupied cell (x, y) near center, or None."""
+        center_x = self.center.grid_x
+        center_y = self.center.grid_y
+        radius = self.radius
+        # A few random guesses are usually enough on a mostly open map
+        for _ in range(COIN_SPAWN_TRIES):
+            x = center_x + self.rng.randint(-radius, radius)
+            y = center_y + self.rng.randint(-radius, radius)
+            if self.is_free(x, y):
+                return (x, y)
+        candidates = [
+            (x, y)
+            for y in range(center_y - radius, center_y + radius + 1)
+            for x in range(center_x - radius, center_x + radius + 1)
+            if self.is_free(x, y)
+        ]
+        return self.rng.choice(candidates) if candidates else None
+
+
+def flow_field_range(max_radius):
+    """Steps a flow field covers for enemies noticing the hero within max_radius.
+
+    Paths around obstacles are longer than the radius: twice it will do,
+    and never less than FLOW_FIELD_RANGE.
+    """
+    return max(FLOW_FIELD_RANGE, 2 * max_radius)
+
+
+class FlowField:
+    """Breadth-first distance map from one cell, shared by every enemy.
+
+    It is rebuilt only when the origin cell or the grid changes. Enemies then
+    choose their next step in O(1) by reading their neighbours' distances.
+    The search stops after max_distance steps, so it only needs the square
+    window of cells around the origin that those steps can reach. Its cost
+    and memory don't depend on the map size.
+    """
+
+    HORIZONTAL_FIRST = ((1, 0), (-1, 0), (0, 1), (0, -1))
+    VERTICAL_FIRST = ((0, 1), (0, -1), (1, 0), (-1, 0))
+
+    def __init__(self, grid, max_distance=FLOW_FIELD_RANGE):
+        self.grid = grid
+        self.max_distance = max_distance
+        self.grid_version = None
+        self.origin = None
+        # Window of cells around the origin covered by the search
+        self.size = 2 * max_distance + 1
+        self.left = 0
+        self.top = 0
+        # Steps to the origin for each window index (-1 = not reached)
+        self.distances = array("i", [-1]) * (self.size * self.size)
+        self.visited = []
+
+    def update(self, x, y):
+        """Recompute the distances from (x, y) if the origin or grid changed."""
+        grid = self.grid
+        if (x, y) == self.origin and grid.version == self.grid_version:
+            return
+        self.origin = (x, y)
+        self.grid_version = grid.version
+        distances = self.distances
+        # Only reset the cells reached by the previous search
+        for index in self.visited:
+            distances[index] = -1
+        size = self.size
+        self.left = x - self.max_distance
+        self.top = y - self.max_distance
+        # Cells outside the grid read as blocked, so the window edges hold
+        blocked = grid.window(self.left, self.top, size, size)
+        start = (y - self.top) * size + (x - self.left)
+        distances[start] = 0
+        visited = [start]
+        head = 0
+        while head < len(visited):
+            index = visited[head]
+            head += 1
+            distance = distances[index] + 1
+            if distance > self.max_distance:
+                break
+            for neighbour in (index - size, index + size, index - 1, index + 1):
+                if distances[neighbour] < 0 and not blocked[neighbour]:
+                    distances[neighbour] = distance
+                    visited.append(neighbour)
+        self.visited = visited
+
+    def distance(self, x, y):
+        """Steps from (x, y) to the origin, or -1 if not reached."""
+        column = x - self.left
+        row = y - self.top
+        if not (0 <= column < self.size and 0 <= row < self.size):
+            return -1
+        return self.distances[row * self.size + column]
+
+    def distances_at(self, xs, ys):
+        """Steps to the origin for NumPy arrays of cells (-1 if not reached)."""
+        columns = xs - self.left
+        rows = ys - self.top
+        inside = (columns >= 0) & (columns < self.size) & (rows >= 0)
+        inside &= rows < self.size
+        distances = np.frombuffer(self.distances, dtype=np.int32)
+        found = distances[np.where(inside, rows * self.size + columns, 0)]
+        return np.where(inside, found, -1)
+
+
+def flow_distances(fields, which, xs, ys):
+    """distances_at() of fields[which] for each cell of NumPy arrays.
+
+    The distance arrays of several fields are read as one, so cells chasing
+    different heroes cost the same few array operations.
+    """
+    if len(fields) == 1:
+        return fields[0].distances_at(xs, ys)
+    lefts = np.array([field.left for field in fields])[which]
+    tops = np.array([field.top for field in fields])[which]
+    sizes = np.array([field.size for field in fields])
+    starts = np.concatenate(([0], np.cumsum(sizes * sizes)[:-1]))[which]
+    sizes = sizes[which]
+    columns = xs - lefts
+    rows = ys - tops
+    inside = (columns >= 0) & (columns < sizes) & (rows >= 0) & (rows < sizes)
+    distances = np.concatenate(
+        [np.frombuffer(field.distances, dtype=np.int32) for field in fields]
+    )
+    found = distances[np.where(inside, starts + rows * sizes + columns, 0)]
+    return np.where(inside, found, -1)
+
+
+# Octant transforms (xx, xy, yx, yy) used by shadowcasting
+FOV_OCTANTS = (
+    (1, 0, 0, 1),
+    (0, 1, 1, 0),
+    (0, -1, 1, 0),
+    (-1, 0, 0, 1),
+    (-1, 0, 0, -1),
+    (0, -1, -1, 0),
+    (0, 1, -1, 0),
+    (1, 0, 0, -1),
+)
+
+
+def shadowcast(window, radius):
+    """Cells seen from the center of a (2 * radius + 1) square window.
+
+    window holds the cells row by row (nonzero = blocks sight). Returns a
+    bytearray of the same layout with 1 for every visible cell (walls
+    included), using recursive shadowcasting over the eight octants.
+    """
+    width = 2 * radius + 1
+    visible = bytearray(width * width)
+    visible[radius * width + radius] = 1
+    radius_sq = radius * radius
+
+    def cast(row, start, end, xx, xy, yx, yy):
+        if start < end:
+            return
+        new_start = start
+        for j in range(row, radius + 1):
+            dy = -j
+            blocked = False
+            for dx in range(-j, 1):
+                left = (dx - 0.5) / (dy + 0.5)
+                right = (dx + 0.5) / (dy - 0.5)
+                if start < right:
+                    continue
+                if end > left:
+                    break
+                cell = (radius + dx * yx + dy * yy) * width + radius + dx * xx + dy * xy
+                if dx * dx + dy * dy <= radius_sq:
+                    visible[cell] = 1
+                if blocked:
+                    if window[cell]:
+                        new_start = right
+                        continue
+                    blocked = False
+                    start = new_start
+                elif window[cell] and j < radius:
+                    blocked = True
+                    cast(j + 1, start, left, xx, xy, yx, yy)
+                    new_start = right
+            if blocked:
+                break
+
+    for xx, xy, yx, yy in FOV_OCTANTS:
+        cast(1, 1.0, 0.0, xx, xy, yx, yy)
+    return visible
+
+
+class FieldOfView:
+    """Cells seen from a cell within a radius, cached per (x, y, radius).
+
+    Views are computed by shadowcast() on the grid window around the cell
+    and stored as (2 * radius + 1) square boolean arrays. At most
+    max_entries are kept (least recently used are dropped first) and all
+    are dropped when the grid changes, so repeated queries from the same
+    cell (every enemy checking the hero) cost a dictionary lookup.
+    """
+
+    def __init__(self, grid, max_entries=FOV_CACHE_SIZE):
+        self.grid = grid
+        self.grid_version = grid.version
+        self.max_entries = max_entries
+        self.views = OrderedDict()
+
+    def view(self, x, y, radius):
+        """Boolean array of the cells seen from (x, y), centered on it."""
+        if self.grid_version != self.grid.version:
+            self.grid_version = self.grid.version
+            self.views.clear()
+        key = (x, y, radius)
+        view = self.views.get(key)
+        if view is None:
+            width = 2 * radius + 1
+            window = self.grid.window(x - radius, y - radius, width, width)
+            visible = shadowcast(window, radius)
+            view = np.frombuffer(visible, np.uint8).reshape(width, width) != 0
+            self.views[key] = view
+            if len(self.views) > self.max_entries:
+                self.views.popitem(last=False)
+        else:
+            self.views.move_to_end(key)
+        return view
+
+    def sees(self, x, y, radius, xs, ys):
+        """Mask of the cells (xs, ys) seen from (x, y) within radius."""
+        view = self.view(x, y, radius)
+        column = xs - x + radius
+        row = ys - y + radius
+        width = 2 * radius + 1
+        inside = (column >= 0) & (column < width) & (row >= 0) & (row < width)
+        return inside & view[np.where(inside, row, 0), np.where(inside, column, 0)]
+
+    def sees_from(self, origins, which, radius, xs, ys):
+        """sees() of each cell (xs, ys) from the (x, y) origins[which].
+
+        The views of every origin are stacked, so the cells of all of them
+        are looked up at once.
+        """
+        views = np.stack([self.view(x, y, radius) for x, y in origins])
+        origins = np.array(origins, np.int64)
+        column = xs - origins[which, 0] + radius
+        row = ys - origins[which, 1] + radius
+        width = 2 * radius + 1
+        inside = (column >= 0) & (column < width) & (row >= 0) & (row < width)
+        return (
+            inside & views[which, np.where(inside, row, 0), np.where(inside, column, 0)]
+        )
+
+    def sees_cell(self, x, y, radius, cell_x, cell_y):
+        """True if (cell_x, cell_y) is seen from (x, y) within radius."""
+        column = cell_x - x + radius
+        row = cell_y - y + radius
+        width = 2 * radius + 1
+        if not (0 <= column < width and 0 <= row < width):
+            return False
+        return bool(self.view(x, y, radius)[row, column])
+
+
+class FogLayer:
+    """Darkens the screen outside the cells the hero can see.
+
+    The fog over the hero's view window is rendered once per (grid, cell,
+    radius, grid version); the rest of the screen gets plain fog.
+    """
+
+    def __init__(self, color=FOG_COLOR):
+        self.full = Surface((WIDTH, HEIGHT), SRCALPHA)
+        self.full.fill(color)
+        self.color = color
+        self.grid = None
+        self.key = None
+        self.window = None
+
+    def render(self, view):
+        """Fog surface over a view window, clear on the visible cells."""
+        width = view.shape[0]
+        layer = Surface((width * CELL_SIZE, width * CELL_SIZE), SRCALPHA)
+        layer.fill(self.color)
+        for row, column in zip(*np.nonzero(view)):
+            layer.fill(
+                (0, 0, 0, 0),
+                Rect(column * CELL_SIZE, row * CELL_SIZE, CELL_SIZE, CELL_SIZE),
+            )
+        return layer
+
+    def draw(self, surface, fov, x, y, radius, camera):
+        """Fog everything but what (x, y) sees, for the given camera."""
+        grid = fov.grid
+        key = (x, y, radius, grid.version)
+        if grid is not self.grid or key != self.key:
+            self.grid = grid
+            self.key = key
+            self.window = self.render(fov.view(x, y, radius))
+        area = Rect(
+            (x - radius) * CELL_SIZE - camera.left,
+            (y - radius) * CELL_SIZE - camera.top,
+            self.window.get_width(),
+            self.window.get_height(),
+        )
+        surface.blit(self.window, area)
+        screen_rect = surface.get_rect()
+        # Plain fog around the window: above, below, left and right of it
+        for rect in (
+            Rect(0, 0, WIDTH, area.top),
+            Rect(0, area.bottom, WIDTH, HEIGHT - area.bottom),
+            Rect(0, area.top, area.left, area.height),
+            Rect(area.right, area.top, WIDTH - area.right, area.height),
+        ):
+            rect = rect.clip(screen_rect)
+            if rect.width > 0 and rect.height > 0:
+                surface.blit(self.full, rect, Rect((0, 0), rect.size))
+
+
+class GridLayer:
+    """Offscreen cache of the grid, rendered once and blitted every frame.
+
+    The grid is split in square blocks of GRID_BLOCK_CELLS cells so big maps
+    don't need one huge surface. Blocks are rendered on first use and kept
+    until the grid changes; at most max_blocks stay cached (least recently
+    drawn are dropped first).
+    """
+
+    def __init__(self, max_blocks=GRID_LAYER_MAX_BLOCKS):
+        self.grid = None
+        self.grid_version = None
+        self.max_blocks = max_blocks
+        self.blocks = OrderedDict()
+        self.floor_tile = Surface((CELL_SIZE, CELL_SIZE))
+        self.floor_tile.fill(BACKGROUND_COLOR)
+        pygame_draw.rect(
+            self.floor_tile, FLOOR_BORDER_COLOR, self.floor_tile.get_rect(), 1
+        )
+        self.obstacle_tile = Surface((CELL_SIZE, CELL_SIZE))
+        self.obstacle_tile.fill(OBSTACLE_COLOR)
+
+    def invalidate(self):
+        """Drop every rendered block (call when the grid changes)."""
+        self.blocks = OrderedDict()
+
+    def render_block(self, grid, block_x, block_y):
+        """Render one block of cells to a new surface."""
+        first_x = block_x * GRID_BLOCK_CELLS
+        first_y = block_y * GRID_BLOCK_CELLS
+        last_x = min(first_x + GRID_BLOCK_CELLS, grid.columns)
+        last_y = min(first_y + GRID_BLOCK_CELLS, grid.rows)
+        block = Surface(
+            ((last_x - first_x) * CELL_SIZE, (last_y - first_y) * CELL_SIZE)
+        )
+        tiles = []
+        for y in range(first_y, last_y):
+            py = (y - first_y) * CELL_SIZE
+            for i, blocked in enumerate(grid.row(y, first_x, last_x)):
+                tile = self.obstacle_tile if blocked else self.floor_tile
+                tiles.append((tile, (i * CELL_SIZE, py)))
+        block.blits(tiles, False)
+        return block
+
+    def draw(self, surface, grid, left=0, top=0):
+        """Blit the blocks covering the view whose top-left pixel is (left, top)."""
+        if grid is not self.grid or grid.version != self.grid_version:
+            self.grid = grid
+            self.grid_version = grid.version
+            self.invalidate()
+        block_size = GRID_BLOCK_CELLS * CELL_SIZE
+        first_x = max(0, left // block_size)
+        first_y = max(0, top // block_size)
+        last_x = min(
+            -(-grid.columns // GRID_BLOCK_CELLS),
+            -(-(left + surface.get_width()) // block_size),
+        )
+        last_y = min(
+            -(-grid.rows // GRID_BLOCK_CELLS),
+            -(-(top + surface.get_height()) // block_size),
+        )
+        visible = []
+        for block_y in range(first_y, last_y):
+            for block_x in range(first_x, last_x):
+                key = (block_x, block_y)
+                block = self.blocks.get(key)
+                if block is None:
+                    block = self.render_block(grid, block_x, block_y)
+                    self.blocks[key] = block
+                    if len(self.blocks) > self.max_blocks:
+                        self.blocks.popitem(last=False)
+                else:
+                    self.blocks.move_to_end(key)
+                position = (block_x * block_size - left, block_y * block_size - top)
+                visible.append((block, position))
+        surface.blits(visible, False)
+
+
+class DirtyRenderer:
+    """Repaints only the screen areas that changed since the last frame.
+
+    Sprites are (key, signature, rect, paint, args) tuples, in drawing
+    order: key identifies a sprite between frames, signature changes when
+    its look changes, rect is the screen area it covers and paint(*args)
+    draws it. Changed areas get the background and the sprites over them
+    redrawn, clipped to the area. Any change of view repaints everything.
+    This saves drawing only: pgzero still flips the whole display.
+    """
+
+    def __init__(self):
+        self.view = None
+        self.sprites = {}
+
+    def invalidate(self):
+        """Force a full repaint on the next draw."""
+        self.view = None
+
+    def draw(self, surface, view, background, sprites):
+        """Update surface; view is anything that changes with the background."""
+        previous = self.sprites
+        self.sprites = {key: (signature, rect) for key, signature, rect, *_ in sprites}
+        if view != self.view:
+            self.view = view
+            background()
+            for *_, paint, args in sprites:
+                paint(*args)
+            return
+        dirty = []
+        for key, (signature, rect) in self.sprites.items():
+            old = previous.get(key)
+            if old is None:
+                dirty.append(rect)
+            elif old[0] != signature:
+                if rect.colliderect(old[1]):
+                    dirty.append(rect.union(old[1]))
+                else:
+                    dirty.append(rect)
+                    dirty.append(old[1])
+        for key, (signature, rect) in previous.items():
+            if key not in self.sprites:
+                dirty.append(rect)
+        for area in dirty:
+            surface.set_clip(area)
+            background()
+            for _, _, rect, paint, args in sprites:
+                if rect.colliderect(area):
+                    paint(*args)
+        surface.set_clip(None)
+
+
+def sprite_rect(x, y):
+    """Screen area covered by a sprite centered at (x, y) (one cell, padded)."""
+    rect = Rect(0, 0, CELL_SIZE + 4, CELL_SIZE + 4)
+    rect.center = (int(x), int(y))
+    return rect
+
+
+class Camera:
+    """Viewport over the world, following a point and clamped to the map."""
+
+    def __init__(self, width=WIDTH, height=HEIGHT):
+        self.width = width
+        self.height = height
+        self.left = 0
+        self.top = 0
+
+    def follow(self, x, y, grid):
+        """Center the view on pixel (x, y) without showing outside the grid."""
+        max_left = max(0, grid.columns * CELL_SIZE - self.width)
+        max_top = max(0, grid.rows * CELL_SIZE - self.height)
+        self.left = min(max(int(x) - self.width // 2, 0), max_left)
+        self.top = min(max(int(y) - self.height // 2, 0), max_top)
+
+    def is_visible(self, x, y, margin=CELL_SIZE):
+        """Check if world pixel (x, y) is on screen (with a margin)."""
+        return (
+            self.left - margin <= x < self.left + self.width + margin
+            and self.top - margin <= y < self.top + self.height + margin
+        )
+
+
+def draw_fallback_shape(x, y, frame_idx):
+    """Draw a simple animated shape for a character without sprite image."""
+    radius = int(CELL_SIZE / 2.6)
+    # Animate size based on frame (real animation effect)
+    size_variation = (frame_idx % 3) * 2
+    radius_animated = radius + size_variation
+    screen.draw.filled_circle((int(x), int(y)), radius_animated, (200, 200, 200))
+    # Animated eyes
+    eye_offset = (frame_idx % 2) * 2 - 1
+    screen.draw.filled_circle((int(x - 6 + eye_offset), int(y - 6)), 3, "white")
+    screen.draw.filled_circle((int(x + 6 + eye_offset), int(y - 6)), 3, "white")
+
+
+class Character:
+    """Base class for all game characters.
+
+    clips are the shared clips of its sprite set (see animation_clips()); a
+    character only keeps the slot playing and the seconds it has played.
+    """
+
+    __slots__ = (
+        "grid_x",
+        "grid_y",
+        "x",
+        "y",
+        "prev_x",
+        "prev_y",
+        "target_x",
+        "target_y",
+        "speed",
+        "is_moving",
+        "direction",
+        "cell_listener",
+        "clips",
+        "clip",
+        "anim_time",
+    )
+
+    def __init__(self, grid_x, grid_y, clips, speed=3.0):
+        self.grid_x = grid_x
+        self.grid_y = grid_y
+        self.x = grid_x * CELL_SIZE + CELL_SIZE // 2
+        self.y = grid_y * CELL_SIZE + CELL_SIZE // 2
+        # Position at the start of the current tick (for interpolated drawing)
+        self.prev_x = self.x
+        self.prev_y = self.y
+        self.target_x = self.x
+        self.target_y = self.y
+        # Pixels moved per simulation tick
+        self.speed = speed
+        self.is_moving = False
+        self.direction = DIRECTION_DOWN
+        # Object told about cell changes (entity_moved), e.g. the GameSession
+        self.cell_listener = None
+        # Playing animation: slot in clips and seconds since it started
+        self.clips = clips
+        self.clip = self.animation_slot()
+        self.anim_time = 0.0
+
+    def animation_slot(self):
+        """Clip slot for the current direction and movement state."""
+        return self.is_moving * 4 + self.direction
+
+    def move_to_cell(self, new_x, new_y):
+        """Move character to a new grid cell."""
+        if not self.is_moving:
+            old_x, old_y = self.grid_x, self.grid_y
+            self.grid_x = new_x
+            self.grid_y = new_y
+            self.target_x = new_x * CELL_SIZE + CELL_SIZE // 2
+            self.target_y = new_y * CELL_SIZE + CELL_SIZE // 2
+            self.is_moving = True
+            if self.cell_listener is not None:
+                self.cell_listener.entity_moved(self, old_x, old_y)
+
+    def update_position(self, dt):
+        """Update character position and animation."""
+        # Play the clip for the current direction (restarting it on change)
+        slot = self.animation_slot()
+        if slot != self.clip:
+            self.clip = slot
+            self.anim_time = 0.0
+        self.anim_time = (self.anim_time + dt) % self.clips[slot].cycle
+
+        # Smooth movement interpolation
+        dx = self.target_x - self.x
+        dy = self.target_y - self.y
+        dist = math.hypot(dx, dy)
+        if dist == 0:
+            self.is_moving = False
+            return
+        if dist <= self.speed:
+            self.x = self.target_x
+            self.y = self.target_y
+            self.is_moving = False
+        else:
+            self.x += (dx / dist) * self.speed
+            self.y += (dy / dist) * self.speed
+
+    def screen_position(self, alpha=1.0, camera=None):
+        """Position to draw at, or None if off the camera's view.
+
+        alpha blends between the previous and current tick positions; with a
+        camera, the position is shifted to the view.
+        """
+        x = self.prev_x + (self.x - self.prev_x) * alpha
+        y = self.prev_y + (self.y - self.prev_y) * alpha
+        if camera is not None:
+            if not camera.is_visible(x, y):
+                return None
+            x -= camera.left
+            y -= camera.top
+        return (x, y)
+
+    def current_animation(self):
+        """Clip to show now and its frame position (0 if it just started)."""
+        slot = self.animation_slot()
+        clip = self.clips[slot]
+        if slot != self.clip:
+            return clip, 0
+        return clip, clip.frame_index(self.anim_time)
+
+    def draw_at(self, x, y):
+        """Draw the current animation frame centered at screen pixel (x, y)."""
+        clip, index = self.current_animation()
+        if clip.frames and load_sprites().draw(
+            screen.surface, clip.frames[index], x, y
+        ):
+            return
+
+        # Fallback: draw simple animated shape
+        draw_fallback_shape(x, y, index)
+
+
+class Hero(Character):
+    """Player-controlled hero character."""
+
+    __slots__ = ("health", "coins", "damage_timer", "damage_cooldown")
+
+    def __init__(self, grid_x, grid_y):
+        super().__init__(grid_x, grid_y, HERO_CLIPS, speed=4.0)
+        self.health = 100
+        # Collected coins count
+        self.coins = 0
+        # Damage cooldown timer (seconds). When >0 hero is invulnerable to further hits
+        self.damage_timer = 0.0
+        # Minimal delay between enemy damages (seconds)
+        self.damage_cooldown = HERO_DAMAGE_COOLDOWN
+
+    def process_input(self, grid, inputs):
+        """Process player input (INPUT_* flags) for movement.
+
+        Returns True if the hero started moving to a new cell.
+        """
+        if self.is_moving:
+            return False
+
+        new_x, new_y = self.grid_x, self.grid_y
+        if inputs & INPUT_UP:
+            new_y = max(0, self.grid_y - 1)
+            self.direction = DIRECTION_UP
+        elif inputs & INPUT_DOWN:
+            new_y = min(grid.rows - 1, self.grid_y + 1)
+            self.direction = DIRECTION_DOWN
+        elif inputs & INPUT_LEFT:
+            new_x = max(0, self.grid_x - 1)
+            self.direction = DIRECTION_LEFT
+        elif inputs & INPUT_RIGHT:
+            new_x = min(grid.columns - 1, self.grid_x + 1)
+            self.direction = DIRECTION_RIGHT
+
+        # Move if position changed and cell is not obstacle
+        if (new_x, new_y) != (self.grid_x, self.grid_y) and not grid.is_blocked(
+            new_x, new_y
+        ):
+            self.move_to_cell(new_x, new_y)
+            return True
+        return False
+
+
+class EnemySwarm:
+    """All enemies stored as a struct of NumPy arrays.
+
+    Each field (position, target, timer, radius, direction, ...) is one
+    contiguous array indexed by enemy number, so AI, movement and hero
+    contact run as batched array operations instead of a Python loop.
+
+    Swarms smaller than SCALAR_SWARM_SIZE run the same AI one enemy at a
+    time (think_each(), move_each()), with the same results.
+
+    Idle enemies (not moving, hero out of reach, waiting for their next
+    patrol step) are put to sleep. A heap of wake-up times brings them back
+    for the next patrol, and the hero entering their radius wakes them
+    early: sleepers are kept in a spatial hash, so only those in the
+    buckets around the hero's new cell are checked. Each tick only
+    processes awake enemies (previous positions, kept for interpolated
+    drawing, are only refreshed for the enemies that moved). While asleep an
+    enemy's timer and idle animation are frozen; they catch up on waking.
+
+    The AI takes a sequence of heroes (one in a local game, more on a
+    server): each enemy chases the closest one it notices, down that
+    hero's flow field.
+    """
+
+    # Steps in (dx, dy) order used by the batched AI: right, left, down, up
+    STEPS_X = np.array([1, -1, 0, 0])
+    STEPS_Y = np.array([0, 0, 1, -1])
+    STEP_DIRECTIONS = np.array(
+        [DIRECTION_RIGHT, DIRECTION_LEFT, DIRECTION_DOWN, DIRECTION_UP]
+    )
+    # Same step orders as FlowField's: larger axis gap first
+    HORIZONTAL_FIRST = np.array([0, 1, 2, 3])
+    VERTICAL_FIRST = np.array([2, 3, 0, 1])
+    # The same as Python values, for the scalar AI
+    STEPS_X_LIST = STEPS_X.tolist()
+    STEPS_Y_LIST = STEPS_Y.tolist()
+    STEP_DIRECTIONS_BY_STEP = {
+        (dx, dy): direction
+        for dx, dy, direction in zip(
+            STEPS_X_LIST, STEPS_Y_LIST, STEP_DIRECTIONS.tolist()
+        )
+    }
+
+    # Animation slot = is_moving * 4 + direction, as in ENEMY_CLIPS
+    FRAMES = [clip.frames for clip in ENEMY_CLIPS]
+    FRAME_COUNTS = np.array([max(1, len(clip.frames)) for clip in ENEMY_CLIPS])
+    FRAME_TIMES = np.array([clip.speed for clip in ENEMY_CLIPS])
+    CYCLE_TIMES = np.array([clip.cycle for clip in ENEMY_CLIPS])
+    CYCLE_TIMES_LIST = CYCLE_TIMES.tolist()
+
+    FIELDS = {
+        "grid_x": (np.int32, ()),
+        "grid_y": (np.int32, ()),
+        "x": (np.float64, ()),
+        "y": (np.float64, ()),
+        "prev_x": (np.float64, ()),
+        "prev_y": (np.float64, ()),
+        "target_x": (np.float64, ()),
+        "target_y": (np.float64, ()),
+        "start_x": (np.int32, ()),
+        "start_y": (np.int32, ()),
+        "radius": (np.int32, ()),
+        "speed": (np.float64, ()),
+        "timer": (np.float64, ()),
+        "patrol_period": (np.float64, ()),
+        "direction": (np.int8, ()),
+        "is_moving": (np.bool_, ()),
+        "anim_slot": (np.int8, ()),
+        "anim_time": (np.float64, ()),
+        "awake": (np.bool_, ()),
+        "slept_at": (np.float64, ()),
+        "wake_at": (np.float64, ()),
+    }
+
+    def __init__(self, capacity=16, rng=None):
+        self.count = 0
+        for name, (dtype, shape) in self.FIELDS.items():
+            setattr(self, name, np.zeros((capacity,) + shape, dtype))
+        # Patrol randomness (default: seeded from the random module)
+        if rng is None:
+            rng = np.random.default_rng(random.getrandbits(64))
+        self.rng = rng
+        # Object told about each tick's cell changes at once (enemies_moved),
+        # e.g. the GameSession
+        self.cell_listener = None
+        # OccupancyIndex used to avoid stepping onto other enemies (optional)
+        self.occupancy = None
+        # FieldOfView: enemies only notice a hero they can see (optional)
+        self.sight = None
+        # Scheduler: simulated seconds, awake enemies and heap of wake-ups
+        self.clock = 0.0
+        self.awake_rows = np.zeros(0, np.intp)
+        self.schedule = []
+        self.max_radius = 0
+        # Hero cells when sleeping enemies were last woken around them
+        self.hero_cells = ()
+        # (bucket_x, bucket_y) -> sleeping rows in that bucket
+        self.sleepers = {}
+        # Rows moved last tick: the others' previous positions are current
+        self.moved_rows = np.zeros(0, np.intp)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield Enemy(self, index)
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.count:
+            raise IndexError("enemy index out of range")
+        return Enemy(self, index)
+
+    def grow(self):
+        """Double the capacity of every field."""
+        for name in self.FIELDS:
+            old = getattr(self, name)
+            new = np.zeros((len(old) * 2,) + old.shape[1:], old.dtype)
+            new[: len(old)] = old
+            setattr(self, name, new)
+
+    def add(self, grid_x, grid_y, radius=3, speed=2.0):
+        """Add an enemy at a grid cell and return its index."""
+        if self.count == len(self.grid_x):
+            self.grow()
+        i = self.count
+        self.count += 1
+        self.grid_x[i] = self.start_x[i] = grid_x
+        self.grid_y[i] = self.start_y[i] = grid_y
+        self.x[i] = self.prev_x[i] = self.target_x[i] = (
+            grid_x * CELL_SIZE + CELL_SIZE // 2
+        )
+        self.y[i] = self.prev_y[i] = self.target_y[i] = (
+            grid_y * CELL_SIZE + CELL_SIZE // 2
+        )
+        self.radius[i] = radius
+        self.speed[i] = speed
+        self.patrol_period[i] = PATROL_PERIOD + PATROL_JITTER * self.rng.random()
+        self.timer[i] = self.patrol_period[i] * self.rng.random()
+        self.direction[i] = DIRECTION_DOWN
+        self.is_moving[i] = False
+        # Idle slot of its direction (see animation_slots)
+        self.anim_slot[i] = self.direction[i]
+        self.anim_time[i] = 0.0
+        self.awake[i] = True
+        self.awake_rows = np.append(self.awake_rows, i)
+        self.max_radius = max(self.max_radius, radius)
+        return i
+
+    def think(self, dt, grid, heroes, flow_fields):
+        """Wake, chase and patrol (before move()); returns the awake rows.
+
+        flow_fields[h] is the FlowField followed towards heroes[h].
+        """
+        if self.count == 0:
+            return self.awake_rows
+        moved = self.moved_rows
+        self.prev_x[moved] = self.x[moved]
+        self.prev_y[moved] = self.y[moved]
+        previous_clock = self.clock
+        self.clock += dt
+        self.wake_due(previous_clock)
+        self.wake_near_heroes(heroes, previous_clock)
+        rows = self.awake_rows
+        if len(rows) == 0:
+            return rows
+        self.timer[rows] += dt
+        if self.count < SCALAR_SWARM_SIZE:
+            self.think_each(rows.tolist(), grid, heroes, flow_fields)
+            return rows
+        is_moving = self.is_moving[rows]
+        # If a hero is nearby, follow the flow field towards the closest
+        target = self.nearest_hero(rows, heroes)
+        near = target >= 0
+        # Otherwise random patrol within territory once per patrol period
+        due = self.timer[rows] >= self.patrol_period[rows]
+        patrolling = rows[~near & ~is_moving & due]
+        self.timer[patrolling] = 0.0
+        chasing = near & ~is_moving
+        if chasing.any():
+            self.chase(rows[chasing], target[chasing], grid, flow_fields, heroes)
+        if len(patrolling):
+            self.patrol(patrolling, grid)
+        return rows
+
+    def think_each(self, rows, grid, heroes, flow_fields):
+        """Chase and patrol of think(), one row (a list of them) at a time."""
+        chasing = []
+        patrolling = []
+        for i in rows:
+            if self.is_moving[i]:
+                continue
+            h = self.nearest_hero_of(i, heroes)
+            if h >= 0:
+                chasing.append((i, h))
+            elif self.timer[i] >= self.patrol_period[i]:
+                self.timer[i] = 0.0
+                patrolling.append(i)
+        if chasing:
+            self.chase_each(chasing, grid, flow_fields, heroes)
+        if patrolling:
+            self.patrol_each(patrolling, grid)
+
+    def move(self, rows, dt, heroes):
+        """Animate and move rows, then put the idle ones to sleep."""
+        self.moved_rows = rows
+        if len(rows) == 0:
+            return
+        if self.count < SCALAR_SWARM_SIZE:
+            self.move_each(rows.tolist(), dt, heroes)
+            return
+        self.update_animations(rows, dt)
+        self.update_positions(rows)
+        self.sleep_idle(rows, heroes)
+
+    def near_hero(self, rows, hero):
+        """Mask of rows whose radius reaches the hero (and that see it).
+
+        Sight is checked from the hero's cell: one cached view covers
+        every enemy.
+        """
+        xs = self.grid_x[rows]
+        ys = self.grid_y[rows]
+        distance = np.abs(hero.grid_x - xs) + np.abs(hero.grid_y - ys)
+        near = distance <= self.radius[rows]
+        if self.sight is not None and near.any():
+            near &= self.sight.sees(hero.grid_x, hero.grid_y, self.max_radius, xs, ys)
+        return near
+
+    def nearest_hero(self, rows, heroes):
+        """Index in heroes of the closest hero each row notices (-1: none).
+
+        Distances to every hero are one (heroes x rows) array; sight is only
+        checked for the rows within reach of each hero.
+        """
+        nearest = np.full(len(rows), -1, np.intp)
+        if len(heroes) == 1:
+            nearest[self.near_hero(rows, heroes[0])] = 0
+            return nearest
+        if not heroes or len(rows) == 0:
+            return nearest
+        xs = self.grid_x[rows]
+        ys = self.grid_y[rows]
+        hero_xs = np.array([hero.grid_x for hero in heroes], np.int64)
+        hero_ys = np.array([hero.grid_y for hero in heroes], np.int64)
+        distance = np.abs(hero_xs[:, None] - xs) + np.abs(hero_ys[:, None] - ys)
+        near = distance <= self.radius[rows]
+        if self.sight is not None and near.any():
+            # Sight of every (hero, row) pair within reach, in one lookup
+            reaching = np.flatnonzero(near.any(axis=1))
+            which, reached = np.nonzero(near[reaching])
+            near[reaching[which], reached] = self.sight.sees_from(
+                [(heroes[h].grid_x, heroes[h].grid_y) for h in reaching.tolist()],
+                which,
+                self.max_radius,
+                xs[reached],
+                ys[reached],
+            )
+        # Ties go to the first hero
+        closest = np.argmin(np.where(near, distance, np.iinfo(np.int64).max), axis=0)
+        noticed = near.any(axis=0)
+        nearest[noticed] = closest[noticed]
+        return nearest
+
+    def nearest_hero_of(self, i, heroes):
+        """nearest_hero() of the single row i."""
+        x = int(self.grid_x[i])
+        y = int(self.grid_y[i])
+        nearest = -1
+        # Only strictly closer heroes win: ties go to the first
+        best = int(self.radius[i]) + 1
+        for h, hero in enumerate(heroes):
+            distance = abs(hero.grid_x - x) + abs(hero.grid_y - y)
+            if distance < best and (
+                self.sight is None
+                or self.sight.sees_cell(hero.grid_x, hero.grid_y, self.max_radius, x, y)
+            ):
+                nearest = h
+                best = distance
+        return nearest
+
+    def sleep_idle(self, rows, heroes):
+        """Put to sleep the rows that are only waiting for their next patrol."""
+        idle = (
+            ~self.is_moving[rows]
+            & (self.nearest_hero(rows, heroes) < 0)
+            & (self.timer[rows] < self.patrol_period[rows])
+        )
+        sleeping = rows[idle]
+        self.awake_rows = rows[~idle]
+        if len(sleeping) == 0:
+            return
+        deadlines = self.clock + (self.patrol_period[sleeping] - self.timer[sleeping])
+        self.awake[sleeping] = False
+        self.slept_at[sleeping] = self.clock
+        self.wake_at[sleeping] = deadlines
+        self.add_sleepers(sleeping)
+        for deadline, i in zip(deadlines.tolist(), sleeping.tolist()):
+            heapq.heappush(self.schedule, (deadline, i))
+
+    def wake(self, rows, clock):
+        """Wake sleeping rows, catching their timer and animation up to clock."""
+        rows = np.unique(rows[~self.awake[rows]])
+        if len(rows) == 0:
+            return
+        elapsed = clock - self.slept_at[rows]
+        self.timer[rows] += elapsed
+        self.update_animations(rows, elapsed)
+        self.awake[rows] = True
+        self.remove_sleepers(rows)
+        self.awake_rows = np.union1d(self.awake_rows, rows)
+
+    def wake_due(self, clock):
+        """Wake the enemies whose next patrol step is due this tick."""
+        due = []
+        while self.schedule and self.schedule[0][0] <= self.clock:
+            deadline, i = heapq.heappop(self.schedule)
+            # Skip entries left over from an enemy woken early
+            if not self.awake[i] and self.wake_at[i] == deadline:
+                due.append(i)
+        if due:
+            self.wake(np.array(due, np.intp), clock)
+
+    def wake_near_heroes(self, heroes, clock):
+        """Wake sleeping enemies once a hero enters their radius."""
+        hero_cells = tuple((hero.grid_x, hero.grid_y) for hero in heroes)
+        if hero_cells == self.hero_cells:
+            return
+        previous = set(self.hero_cells)
+        self.hero_cells = hero_cells
+        for hero, hero_cell in zip(heroes, hero_cells):
+            if hero_cell in previous:
+                continue
+            sleeping = self.sleepers_near(*hero_cell)
+            if len(sleeping):
+                self.wake(sleeping[self.near_hero(sleeping, hero)], clock)
+
+    def sleepers_near(self, x, y):
+        """Sleeping rows in the buckets within max_radius cells of (x, y)."""
+        radius = self.max_radius
+        found = []
+        for bucket_y in range(
+            (y - radius) // SLEEP_BUCKET_CELLS, (y + radius) // SLEEP_BUCKET_CELLS + 1
+        ):
+            for bucket_x in range(
+                (x - radius) // SLEEP_BUCKET_CELLS,
+                (x + radius) // SLEEP_BUCKET_CELLS + 1,
+            ):
+                found.extend(self.sleepers.get((bucket_x, bucket_y), ()))
+        return np.array(found, np.intp)
+
+    def sleeper_buckets(self, xs, ys):
+        """Bucket of each cell of NumPy arrays, as (bucket_x, bucket_y) tuples."""
+        return zip(
+            (xs // SLEEP_BUCKET_CELLS).tolist(), (ys // SLEEP_BUCKET_CELLS).tolist()
+        )
+
+    def add_sleepers(self, rows):
+        """Put rows that just fell asleep in the spatial hash."""
+        sleepers = self.sleepers
+        buckets = self.sleeper_buckets(self.grid_x[rows], self.grid_y[rows])
+        for i, bucket in zip(rows.tolist(), buckets):
+            sleepers.setdefault(bucket, set()).add(i)
+
+    def remove_sleepers(self, rows, xs=None, ys=None):
+        """Take rows that just woke up out of the spatial hash.
+
+        xs and ys are the cells they fell asleep on (default: their cells).
+        """
+        if xs is None:
+            xs = self.grid_x[rows]
+            ys = self.grid_y[rows]
+        sleepers = self.sleepers
+        for i, bucket in zip(rows.tolist(), self.sleeper_buckets(xs, ys)):
+            rows_in_bucket = sleepers[bucket]
+            rows_in_bucket.discard(i)
+            if not rows_in_bucket:
+                del sleepers[bucket]
+
+    def restored(self, old_xs=None, old_ys=None, old_asleep=None):
+        """Update the sleepers' spatial hash after the fields were overwritten.
+
+        Given the cells and sleeping mask of the rows before (a rollback),
+        only the rows whose bucket or sleep changed move in the hash;
+        otherwise it is rebuilt. Every previous position is refreshed on the
+        next tick, since the rows moved before the snapshot aren't stored.
+        """
+        asleep = ~self.awake[: self.count]
+        self.moved_rows = np.arange(self.count)
+        if old_asleep is None:
+            self.sleepers = {}
+            self.add_sleepers(np.flatnonzero(asleep))
+            return
+        changed = asleep != old_asleep
+        changed |= (self.grid_x[: self.count] // SLEEP_BUCKET_CELLS) != (
+            old_xs // SLEEP_BUCKET_CELLS
+        )
+        changed |= (self.grid_y[: self.count] // SLEEP_BUCKET_CELLS) != (
+            old_ys // SLEEP_BUCKET_CELLS
+        )
+        woken = np.flatnonzero(changed & old_asleep)
+        self.remove_sleepers(woken, old_xs[woken], old_ys[woken])
+        self.add_sleepers(np.flatnonzero(changed & asleep))
+
+    def taken(self, cells):
+        """Mask of flat cells already holding an enemy (heroes don't count)."""
+        if self.occupancy is None:
+            return np.zeros(cells.shape, np.bool_)
+        return self.occupancy.enemies_at(cells) > 0
+
+    def chase(self, rows, targets, grid, flow_fields, heroes):
+        """Step each row one cell down the flow field of heroes[target].
+
+        Rows chasing different heroes move in one batch, in row order.
+        """
+        chased = np.unique(targets)
+        fields = []
+        for h in chased.tolist():
+            flow_fields[h].update(heroes[h].grid_x, heroes[h].grid_y)
+            fields.append(flow_fields[h])
+        which = np.searchsorted(chased, targets)
+        hero_x = np.array([heroes[h].grid_x for h in chased.tolist()])[which]
+        hero_y = np.array([heroes[h].grid_y for h in chased.tolist()])[which]
+        x = self.grid_x[rows].astype(np.int64)
+        y = self.grid_y[rows].astype(np.int64)
+        own = flow_distances(fields, which, x, y)
+        new_x = x[:, None] + self.STEPS_X
+        new_y = y[:, None] + self.STEPS_Y
+        # Cells outside the grid are never reached by the flow field
+        distances = flow_distances(fields, which[:, None], new_x, new_y)
+        closer = distances == (own - 1)[:, None]
+        neighbour = new_y * grid.columns + new_x
+        closer &= (own > 0)[:, None] & ~self.taken(neighbour)
+        horizontal = np.abs(hero_x - x) > np.abs(hero_y - y)
+        order = np.where(
+            horizontal[:, None], self.HORIZONTAL_FIRST, self.VERTICAL_FIRST
+        )
+        self.take_first_step(
+            rows, np.take_along_axis(closer, order, axis=1), order, grid
+        )
+
+    def chase_each(self, chasing, grid, flow_fields, heroes):
+        """chase() of a list of (row, hero index), one at a time."""
+        for h in sorted({h for _, h in chasing}):
+            flow_fields[h].update(heroes[h].grid_x, heroes[h].grid_y)
+        moves = []
+        for i, h in chasing:
+            flow_field = flow_fields[h]
+            hero = heroes[h]
+            x = int(self.grid_x[i])
+            y = int(self.grid_y[i])
+            own = flow_field.distance(x, y)
+            if own <= 0:
+                continue
+            if abs(hero.grid_x - x) > abs(hero.grid_y - y):
+                order = FlowField.HORIZONTAL_FIRST
+            else:
+                order = FlowField.VERTICAL_FIRST
+            for dx, dy in order:
+                # Cells the flow field reached are inside the grid
+                if flow_field.distance(x + dx, y + dy) == own - 1 and not (
+                    self.taken_cell(x + dx, y + dy)
+                ):
+                    moves.append((i, dx, dy))
+                    break
+        self.take_steps(moves, grid)
+
+    def patrol_each(self, rows, grid):
+        """patrol() of a list of rows, one at a time (same random draws)."""
+        draws = self.rng.random((len(rows), 4)).tolist()
+        moves = []
+        for i, row_draws in zip(rows, draws):
+            x = int(self.grid_x[i])
+            y = int(self.grid_y[i])
+            start_x = int(self.start_x[i])
+            start_y = int(self.start_y[i])
+            radius = int(self.radius[i])
+            for step in sorted(range(4), key=row_draws.__getitem__):
+                new_x = x + self.STEPS_X_LIST[step]
+                new_y = y + self.STEPS_Y_LIST[step]
+                if (
+                    grid.in_bounds(new_x, new_y)
+                    and not grid.is_blocked(new_x, new_y)
+                    and not self.taken_cell(new_x, new_y)
+                    and abs(new_x - start_x) + abs(new_y - start_y) <= radius
+                ):
+                    moves.append((i, new_x - x, new_y - y))
+                    break
+        self.take_steps(moves, grid)
+
+    def taken_cell(self, x, y):
+        """taken() of the single cell (x, y), inside the grid."""
+        return self.occupancy is not None and self.occupancy.enemy_count(x, y) > 0
+
+    def take_steps(self, moves, grid):
+        """take_first_step() of a list of (row, dx, dy), one at a time."""
+        columns = grid.columns
+        targets = set()
+        old_cells = []
+        new_cells = []
+        for i, dx, dy in moves:
+            old_x = int(self.grid_x[i])
+            old_y = int(self.grid_y[i])
+            x = old_x + dx
+            y = old_y + dy
+            cell = y * columns + x
+            if cell in targets:
+                continue
+            targets.add(cell)
+            old_cells.append(old_y * columns + old_x)
+            new_cells.append(cell)
+            self.direction[i] = self.STEP_DIRECTIONS_BY_STEP[dx, dy]
+            self.grid_x[i] = x
+            self.grid_y[i] = y
+            self.target_x[i] = x * CELL_SIZE + CELL_SIZE // 2
+            self.target_y[i] = y * CELL_SIZE + CELL_SIZE // 2
+            self.is_moving[i] = True
+        if new_cells and self.cell_listener is not None:
+            self.cell_listener.enemies_moved(
+                np.array(old_cells, np.int64), np.array(new_cells, np.int64)
+            )
+
+    def move_each(self, rows, dt, heroes):
+        """move() of a list of rows, one at a time."""
+        self.moved_rows = np.array(rows, np.intp)
+        awake = []
+        sleeping = []
+        for i in rows:
+            # update_animations()
+            slot = int(self.is_moving[i]) * 4 + int(self.direction[i])
+            elapsed = float(self.anim_time[i]) if slot == self.anim_slot[i] else 0.0
+            self.anim_slot[i] = slot
+            self.anim_time[i] = (elapsed + dt) % self.CYCLE_TIMES_LIST[slot]
+            # update_positions()
+            x = float(self.x[i])
+            y = float(self.y[i])
+            target_x = float(self.target_x[i])
+            target_y = float(self.target_y[i])
+            dx = target_x - x
+            dy = target_y - y
+            dist = math.hypot(dx, dy)
+            speed = float(self.speed[i])
+            if dist <= speed:
+                self.is_moving[i] = False
+                self.x[i] = target_x
+                self.y[i] = target_y
+            else:
+                self.x[i] = x + (dx / dist) * speed
+                self.y[i] = y + (dy / dist) * speed
+            # sleep_idle()
+            if (
+                self.is_moving[i]
+                or self.timer[i] >= self.patrol_period[i]
+                or self.nearest_hero_of(i, heroes) >= 0
+            ):
+                awake.append(i)
+                continue
+            deadline = self.clock + float(self.patrol_period[i] - self.timer[i])
+            self.awake[i] = False
+            self.slept_at[i] = self.clock
+            self.wake_at[i] = deadline
+            heapq.heappush(self.schedule, (deadline, i))
+            sleeping.append(i)
+        self.awake_rows = np.array(awake, np.intp)
+        if sleeping:
+            self.add_sleepers(np.array(sleeping, np.intp))
+
+    def patrol(self, rows, grid):
+        """Move the given enemies to a random neighbour inside their territory."""
+        x = self.grid_x[rows].astype(np.int64)
+        y = self.grid_y[rows].astype(np.int64)
+        # Random order of the four steps for each enemy (batched shuffle)
+        order = np.argsort(self.rng.random((len(rows), 4)), axis=1)
+        new_x = x[:, None] + self.STEPS_X[order]
+        new_y = y[:, None] + self.STEPS_Y[order]
+        neighbour = new_y * grid.columns + new_x
+        free = ~grid.blocked_mask(new_x, new_y) & ~self.taken(neighbour)
+        dist_from_start = np.abs(new_x - self.start_x[rows, None]) + np.abs(
+            new_y - self.start_y[rows, None]
+        )
+        valid = free & (dist_from_start <= self.radius[rows, None])
+        self.take_first_step(rows, valid, order, grid)
+
+    def take_first_step(self, rows, valid, order, grid):
+        """Move each row along its first valid step (columns of order).
+
+        When several enemies pick the same cell only the first one moves.
+        The cell_listener gets the old and new flat cells of every move in
+        one call.
+        """
+        has_step = valid.any(axis=1)
+        rows = rows[has_step]
+        steps = order[has_step, np.argmax(valid[has_step], axis=1)]
+        targets = (self.grid_y[rows] + self.STEPS_Y[steps]) * grid.columns + (
+            self.grid_x[rows] + self.STEPS_X[steps]
+        )
+        _, first = np.unique(targets, return_index=True)
+        if len(first) < len(rows):
+            first.sort()
+            rows = rows[first]
+            steps = steps[first]
+        old_x = self.grid_x[rows]
+        old_y = self.grid_y[rows]
+        self.direction[rows] = self.STEP_DIRECTIONS[steps]
+        self.grid_x[rows] += self.STEPS_X[steps]
+        self.grid_y[rows] += self.STEPS_Y[steps]
+        self.target_x[rows] = self.grid_x[rows] * CELL_SIZE + CELL_SIZE // 2
+        self.target_y[rows] = self.grid_y[rows] * CELL_SIZE + CELL_SIZE // 2
+        self.is_moving[rows] = True
+        if self.cell_listener is not None:
+            columns = grid.columns
+            self.cell_listener.enemies_moved(
+                old_y.astype(np.int64) * columns + old_x,
+                self.grid_y[rows].astype(np.int64) * columns + self.grid_x[rows],
+            )
+
+    def animation_slots(self, rows=None):
+        """Current animation slot of the given rows (default: every enemy)."""
+        if rows is None:
+            rows = slice(0, self.count)
+        return self.is_moving[rows] * 4 + self.direction[rows]
+
+    def update_animations(self, rows, dt):
+        """Play the current clip of rows for dt more seconds (scalar or per row).
+
+        A row whose slot changed restarts its clip.
+        """
+        slots = self.animation_slots(rows)
+        elapsed = np.where(slots == self.anim_slot[rows], self.anim_time[rows], 0.0)
+        self.anim_slot[rows] = slots
+        self.anim_time[rows] = (elapsed + dt) % self.CYCLE_TIMES[slots]
+
+    def frame_indices(self, rows, slots):
+        """Frame position of rows in the clips of slots (0 for a new clip)."""
+        elapsed = np.where(slots == self.anim_slot[rows], self.anim_time[rows], 0.0)
+        frames = (elapsed // self.FRAME_TIMES[slots]).astype(np.int64)
+        return frames % self.FRAME_COUNTS[slots]
+
+    def update_positions(self, rows):
+        """Move the given enemies towards their target cell."""
+        x = self.x[rows]
+        y = self.y[rows]
+        dx = self.target_x[rows] - x
+        dy = self.target_y[rows] - y
+        dist = np.hypot(dx, dy)
+        speed = self.speed[rows]
+        arrived = dist <= speed
+        self.is_moving[rows[arrived]] = False
+        self.x[rows[arrived]] = self.target_x[rows[arrived]]
+        self.y[rows[arrived]] = self.target_y[rows[arrived]]
+        moving = ~arrived
+        self.x[rows[moving]] = x[moving] + (dx[moving] / dist[moving]) * speed[moving]
+        self.y[rows[moving]] = y[moving] + (dy[moving] / dist[moving]) * speed[moving]
+
+    def visible(self, alpha=1.0, camera=None):
+        """Rows to draw, as lists of rows, x, y, animation slot and frame.
+
+        alpha blends between the previous and current tick positions; with a
+        camera, only enemies inside the view are kept, shifted to the view.
+        """
+        n = self.count
+        prev_x = self.prev_x[:n]
+        prev_y = self.prev_y[:n]
+        xs = prev_x + (self.x[:n] - prev_x) * alpha
+        ys = prev_y + (self.y[:n] - prev_y) * alpha
+        rows = np.arange(n)
+        if camera is not None:
+            visible = (
+                (xs >= camera.left - CELL_SIZE)
+                & (xs < camera.left + camera.width + CELL_SIZE)
+                & (ys >= camera.top - CELL_SIZE)
+                & (ys < camera.top + camera.height + CELL_SIZE)
+            )
+            rows = rows[visible]
+            xs = xs[visible] - camera.left
+            ys = ys[visible] - camera.top
+        slots = self.animation_slots(rows)
+        frames = self.frame_indices(rows, slots)
+        return (
+            rows.tolist(),
+            xs.tolist(),
+            ys.tolist(),
+            slots.tolist(),
+            frames.tolist(),
+        )
+
+    def draw_sprite(self, i, x, y, slot, frame_idx):
+        """Draw enemy i centered at screen pixel (x, y)."""
+        frames = self.FRAMES[slot]
+        if not frames or not load_sprites().draw(
+            screen.surface, frames[frame_idx], x, y
+        ):
+            draw_fallback_shape(x, y, frame_idx)
+
+
+class Enemy:
+    """View of one enemy stored in an EnemySwarm."""
+
+    __slots__ = ("swarm", "index")
+
+    def __init__(self, swarm, index):
+        self.swarm = swarm
+        self.index = index
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, Enemy)
+            and other.swarm is self.swarm
+            and other.index == self.index
+        )
+
+    def __hash__(self):
+        return hash((id(self.swarm), self.index))
+
+    @property
+    def grid_x(self):
+        return int(self.swarm.grid_x[self.index])
+
+    @property
+    def grid_y(self):
+        return int(self.swarm.grid_y[self.index])
+
+    @property
+    def x(self):
+        return float(self.swarm.x[self.index])
+
+    @property
+    def y(self):
+        return float(self.swarm.y[self.index])
+
+    @property
+    def start_position(self):
+        return int(self.swarm.start_x[self.index]), int(self.swarm.start_y[self.index])
+
+    @property
+    def radius(self):
+        return int(self.swarm.radius[self.index])
+
+    @property
+    def timer(self):
+        return float(self.swarm.timer[self.index])
+
+    @property
+    def direction(self):
+        return int(self.swarm.direction[self.index])
+
+    @property
+    def is_moving(self):
+        return bool(self.swarm.is_moving[self.index])
+
+
+def create_grid(rng=random, columns=COLUMNS, rows=ROWS, density=OBSTACLE_DENSITY):
+    """Create game grid with random obstacles (drawn from rng).
+
+    About density obstacles per cell are placed (some may overlap), so
+    bigger grids get proportionally more (25 on the default map).
+    """
+    g = Grid(columns, rows)
+    # Create some random obstacles
+    for _ in range(round(density * columns * rows)):
+        x = rng.randint(0, columns - 1)
+        y = rng.randint(0, rows - 1)
+        g.set_blocked(x, y)
+    # Wall off any pocket the obstacles cut from the rest of the map
+    keep_largest_region(g)
+    return g
+
+
+def generate_caves(
+    columns,
+    rows,
+    rng=random,
+    wall_chance=CAVE_WALL_CHANCE,
+    passes=CAVE_SMOOTHING_PASSES,
+):
+    """Create a cave map: random walls smoothed by a cellular automaton.
+
+    Every step is a whole-array NumPy pass, so a 2000x2000 map takes well
+    under CAVE_TIME_BUDGET. Only the largest cave is kept open, so every
+    free cell can reach every other.
+    """
+    generator = np.random.default_rng(rng.getrandbits(64))
+    blocked = generator.random((rows, columns)) < wall_chance
+    for _ in range(passes):
+        # Walls among the 8 neighbours (outside the map counts as wall)
+        padded = np.pad(blocked, 1, constant_values=True).astype(np.uint8)
+        walls = np.zeros((rows, columns), np.uint8)
+        for dy in range(3):
+            for dx in range(3):
+                if dx != 1 or dy != 1:
+                    walls += padded[dy : dy + rows, dx : dx + columns]
+        blocked = (walls >= 5) | (blocked & (walls >= 4))
+    g = Grid(columns, rows)
+    g.cells[:] = blocked.astype(np.uint8).tobytes()
+    keep_largest_region(g)
+    return g
+
+
+def region_labels(free):
+    """Label the 4-connected regions of a 2D boolean mask of free cells.
+
+    Returns an int array of the same shape: free cells get the label of
+    their region, blocked cells -1. Cells are first grouped in horizontal
+    runs; runs touching across rows are then merged by a vectorized
+    union-find (hook each root to the smallest neighbouring root, then
+    jump pointers until every run points at its root).
+    """
+    left_free = np.zeros_like(free)
+    left_free[:, 1:] = free[:, :-1]
+    starts = free & ~left_free
+    run_ids = np.cumsum(starts.ravel()).reshape(free.shape) - 1
+    parent = np.arange(int(starts.sum()))
+    # One edge per stretch of cells free in both a row and the one below
+    both = free[:-1] & free[1:]
+    both_left = np.zeros_like(both)
+    both_left[:, 1:] = both[:, :-1]
+    ys, xs = np.nonzero(both & ~both_left)
+    a = run_ids[ys, xs]
+    b = run_ids[ys + 1, xs]
+    while len(a):
+        root_a = parent[a]
+        root_b = parent[b]
+        apart = root_a != root_b
+        a, b, root_a, root_b = a[apart], b[apart], root_a[apart], root_b[apart]
+        if len(a) == 0:
+            break
+        parent[np.maximum(root_a, root_b)] = np.minimum(root_a, root_b)
+        while True:
+            jumped = parent[parent]
+            if np.array_equal(jumped, parent):
+                break
+            parent = jumped
+    return np.where(free, parent[np.maximum(run_ids, 0)], -1)
+
+
+def keep_largest_region(grid):
+    """Block every free cell outside the grid's largest connected region."""
+    cells = np.frombuffer(grid.cells, np.uint8).reshape(grid.rows, grid.columns)
+    free = cells == 0
+    if not free.any():
+        return
+    labels = region_labels(free)
+    largest = np.argmax(np.bincount(labels[free]))
+    cut_off = free & (labels != largest)
+    if cut_off.any():
+        cells[cut_off] = 1
+        grid.version += 1
+
+
+def spawn_points(grid, min_x=0, min_y=0):
+    """Flat indices of the free cells with x >= min_x and y >= min_y.
+
+    Falls back to every free cell when that corner has none.
+    """
+    cells = np.frombuffer(grid.cells, np.uint8).reshape(grid.rows, grid.columns)
+    ys, xs = np.nonzero(cells[min_y:, min_x:] == 0)
+    if len(ys) == 0 and (min_x or min_y):
+        return spawn_points(grid)
+    return (ys + min_y) * grid.columns + (xs + min_x)
+
+
+def spawn_coin(grid, exclude_positions=None, rng=random):
+    """Spawn a coin on a random free cell not in exclude_positions.
+
+    exclude_positions: iterable of (x,y) tuples to avoid (hero/enemies).
+    Returns (x,y) or None if no free cell found.
+    """
+    free_cells = grid.free_indices(exclude_positions or ())
+    if not free_cells:
+        return None
+    return grid.position(rng.choice(free_cells))
+
+
+class GameSession:
+    """Game state (grid, hero, enemies, coin) that runs without a window.
+
+    step() only needs a time delta and INPUT_* flags, so the simulation can
+    run headless and faster than real time. Sounds go through the optional
+    audio callback, which receives the sound name.
+
+    advance() turns variable frame times into fixed TICK steps, so gameplay
+    doesn't depend on the frame rate and stays deterministic.
+
+    All randomness comes from rng, reseeded by start(), so a game is
+    reproduced by its seed plus the (dt, inputs) of every step (see
+    InputRecorder and replay()).
+    """
+
+    def __init__(self, audio=None, seed=None):
+        self.audio = audio
+        self.state = STATE_PLAYING
+        # Seed of the current game and the random stream it started
+        self.seed = seed
+        self.rng = random.Random(seed)
+        # World and its indexes (created by start())
+        self.grid = None
+        self.occupancy = None
+        self.free_cells = None
+        self.flow_field = None
+        self.sight = None
+        self.hero = None
+        self.enemies = EnemySwarm()
+        self.coin = None
+        # Frame time not yet simulated (always less than one tick)
+        self.accumulator = 0.0
+        # FrameProfiler timing each phase of step() (None: not profiled)
+        self.profiler = None
+        # InputRecorder logging every step (None: not recorded)
+        self.recorder = None
+        # Balance settings, used by the next start() (see BALANCE_SETTINGS)
+        self.enemy_damage = ENEMY_DAMAGE
+        self.enemy_radius = ENEMY_RADIUS
+        self.damage_cooldown = HERO_DAMAGE_COOLDOWN
+        self.obstacle_density = OBSTACLE_DENSITY
+        # Damage the hero has taken this game
+        self.damage_taken = 0
+        # Last grid packed by snapshot(): (grid, version, bits)
+        self.packed_grid = None
+
+    def balance_settings(self):
+        """Values of the BALANCE_SETTINGS attributes, in order."""
+        return tuple(getattr(self, name) for name in BALANCE_SETTINGS)
+
+    def play_sound(self, name):
+        """Forward a sound to the audio adapter, if any."""
+        if self.audio is not None:
+            self.audio(name)
+
+    def start(self, grid=None, enemy_count=4, seed=None, record=False):
+        """Create a new hero, enemies and coin on grid (default: a new one).
+
+        The game runs from seed (default: the next one drawn from the
+        session's stream). With record, every step is logged to a new
+        InputRecorder. A ChunkedGrid gets a NearbyCellSampler instead of a
+        FreeCellIndex, so the coin spawns near the hero without scanning the
+        whole world.
+        """
+        self.state = STATE_PLAYING
+        self.seed = seed if seed is not None else self.rng.getrandbits(64)
+        self.rng = rng = random.Random(self.seed)
+        self.recorder = None
+        if record:
+            self.recorder = InputRecorder(
+                self.seed, enemy_count, grid, self.balance_settings()
+            )
+        if grid is None:
+            grid = create_grid(rng, density=self.obstacle_density)
+        self.grid = grid
+        hero_cell, enemy_cells = self.spawn_cells(enemy_count)
+        self.hero = Hero(*hero_cell)
+        self.hero.damage_cooldown = self.damage_cooldown
+        self.damage_taken = 0
+        # Create enemies
+        self.enemies = EnemySwarm(rng=np.random.default_rng(rng.getrandbits(64)))
+        for enemy_x, enemy_y in enemy_cells:
+            self.enemies.add(enemy_x, enemy_y, radius=self.enemy_radius)
+        self.flow_field = FlowField(
+            self.grid, flow_field_range(self.enemies.max_radius)
+        )
+        self.sight = FieldOfView(self.grid)
+        self.enemies.sight = self.sight
+        # Track the cells taken by hero and enemies
+        self.occupancy = OccupancyIndex(self.grid)
+        if isinstance(self.grid, ChunkedGrid):
+            self.free_cells = NearbyCellSampler(
+                self.grid, self.occupancy, self.hero, rng=rng
+            )
+        else:
+            self.free_cells = FreeCellIndex(self.grid, self.occupancy, rng)
+        self.add_character(self.hero)
+        self.enemies.cell_listener = self
+        self.enemies.occupancy = self.occupancy
+        enemies = self.enemies
+        cells = (
+            enemies.grid_y[: enemies.count].astype(np.int64) * self.grid.columns
+            + enemies.grid_x[: enemies.count]
+        )
+        self.occupancy.add_enemies(cells)
+        self.free_cells.occupy_many(cells)
+        # Spawn a coin somewhere not occupied by hero or enemies
+        self.respawn_coin()
+
+    def spawn_cells(self, enemy_count):
+        """Free cells for the hero (at (2, 2) if free) and enemy_count enemies.
+
+        Enemies start at x and y of 5 or more when possible. On a Grid the
+        free cells are listed once and picked from, so nothing is retried
+        (and they are all reachable, see keep_largest_region()). A
+        ChunkedGrid is too big to list: random cells are tried until one is
+        free, which is quick since its worlds are mostly open.
+        """
+        grid = self.grid
+        rng = self.rng
+        if isinstance(grid, ChunkedGrid):
+            hero_x, hero_y = 2, 2
+            while grid.is_blocked(hero_x, hero_y):
+                hero_x = rng.randint(0, grid.columns - 1)
+                hero_y = rng.randint(0, grid.rows - 1)
+            enemy_cells = []
+            for _ in range(enemy_count):
+                enemy_x = rng.randint(5, grid.columns - 1)
+                enemy_y = rng.randint(5, grid.rows - 1)
+                while grid.is_blocked(enemy_x, enemy_y):
+                    enemy_x = rng.randint(5, grid.columns - 1)
+                    enemy_y = rng.randint(5, grid.rows - 1)
+                enemy_cells.append((enemy_x, enemy_y))
+            return (hero_x, hero_y), enemy_cells
+        points = spawn_points(grid)
+        if len(points) == 0:
+            raise ValueError("the grid has no free cell")
+        hero_cell = (2, 2)
+        if not grid.in_bounds(2, 2) or grid.is_blocked(2, 2):
+            hero_cell = grid.position(int(points[rng.randrange(len(points))]))
+        points = spawn_points(grid, 5, 5).tolist()
+        enemy_cells = [
+            grid.position(points[rng.randrange(len(points))])
+            for _ in range(enemy_count)
+        ]
+        return hero_cell, enemy_cells
+
+    def add_character(self, character):
+        """Start tracking the cell occupied by character."""
+        character.cell_listener = self
+        self.occupancy.add(character, character.grid_x, character.grid_y)
+        self.free_cells.occupy(character.grid_x, character.grid_y)
+
+    def remove_character(self, character):
+        """Stop tracking the cell occupied by character."""
+        character.cell_listener = None
+        self.occupancy.remove(character, character.grid_x, character.grid_y)
+        self.free_cells.vacate(character.grid_x, character.grid_y)
+
+    def entity_moved(self, entity, old_x, old_y):
+        """Keep the occupancy indexes in sync with Character.move_to_cell."""
+        self.occupancy.move(entity, old_x, old_y, entity.grid_x, entity.grid_y)
+        self.free_cells.vacate(old_x, old_y)
+        self.free_cells.occupy(entity.grid_x, entity.grid_y)
+
+    def enemies_moved(self, old_cells, new_cells):
+        """Keep the occupancy indexes in sync with a tick of enemy moves."""
+        self.occupancy.move_enemies(old_cells, new_cells)
+        self.free_cells.vacate_many(old_cells)
+        self.free_cells.occupy_many(new_cells)
+
+    def enemy_touching_hero(self):
+        """Check if an enemy stands on the hero's cell."""
+        hero = self.hero
+        return self.occupancy.enemy_count(hero.grid_x, hero.grid_y) > 0
+
+    def state_digest(self):
+        """Hash of the simulated state, to check that a replay matches."""
+        digest = hashlib.blake2b(digest_size=16)
+        hero = self.hero
+        values = (self.state, self.coin)
+        if hero is not None:
+            values += (
+                hero.grid_x,
+                hero.grid_y,
+                # Pixels may be int or float (snapshots restore floats)
+                float(hero.x),
+                float(hero.y),
+                hero.health,
+                hero.coins,
+                hero.damage_timer,
+            )
+        digest.update(repr(values).encode())
+        enemies = self.enemies
+        for name in EnemySwarm.FIELDS:
+            digest.update(getattr(enemies, name)[: enemies.count].tobytes())
+        return digest.digest()
+
+    def snapshot(self):
+        """Whole game state as bytes (see pack_snapshot())."""
+        return pack_snapshot(self)
+
+    def restore(self, data):
+        """Go back to the state saved by snapshot() (see unpack_snapshot())."""
+        unpack_snapshot(self, data)
+
+    def respawn_coin(self):
+        """Move the coin to a random cell free of hero and enemies."""
+        self.coin = self.free_cells.sample()
+
+    def advance(self, frame_dt, inputs=0):
+        """Run the fixed TICK steps covered by frame_dt.
+
+        At most MAX_TICKS_PER_FRAME ticks run per call; time beyond that is
+        dropped so a slow frame can't snowball. Returns the fraction of a
+        tick left over, to interpolate drawing between the last two states.
+        """
+        self.accumulator += frame_dt
+        ticks = 0
+        while self.accumulator >= TICK and ticks < MAX_TICKS_PER_FRAME:
+            self.step(TICK, inputs)
+            self.accumulator -= TICK
+            ticks += 1
+        if self.accumulator >= TICK:
+            self.accumulator = 0.0
+        return self.accumulator / TICK
+
+    def step(self, dt, inputs=0):
+        """Advance the simulation by dt seconds with the given INPUT_* flags.
+
+        Movement speeds are per call, so use advance() (or dt=TICK) for
+        frame-rate independent results.
+        """
+        if self.state != STATE_PLAYING:
+            return
+        if self.recorder is not None:
+            self.recorder.record(dt, inputs)
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.mark()
+        hero = self.hero
+        hero.prev_x = hero.x
+        hero.prev_y = hero.y
+        # decrement damage timer
+        if hero.damage_timer > 0.0:
+            hero.damage_timer = max(0.0, hero.damage_timer - dt)
+        if hero.process_input(self.grid, inputs):
+            self.play_sound("step")
+        if profiler is not None:
+            profiler.lap("input")
+        hero.update_position(dt)
+        if profiler is not None:
+            profiler.lap("movement")
+        # Check coin pickup
+        if self.coin and (hero.grid_x, hero.grid_y) == self.coin:
+            hero.coins += 1
+            self.play_sound("coin")
+            # Respawn coin avoiding hero and enemies
+            self.respawn_coin()
+        if profiler is not None:
+            profiler.lap("collision")
+        # Update enemies (one shared search from the hero's cell)
+        heroes = (hero,)
+        awake = self.enemies.think(dt, self.grid, heroes, (self.flow_field,))
+        if profiler is not None:
+            profiler.lap("ai")
+        self.enemies.move(awake, dt, heroes)
+        if profiler is not None:
+            profiler.lap("movement")
+        # Simple collision: same grid cell causes damage
+        if self.enemy_touching_hero() and hero.damage_timer <= 0.0:
+            # Only apply damage if cooldown expired
+            hero.health -= self.enemy_damage
+            self.damage_taken += self.enemy_damage
+            hero.damage_timer = hero.damage_cooldown
+            self.play_sound("hit")
+            if hero.health <= 0:
+                hero.health = 0
+                self.state = STATE_GAME_OVER
+                self.play_sound("game_over")
+        if profiler is not None:
+            profiler.lap("collision")
+
+
+class InputRecorder:
+    """The (dt, inputs) of every step of one game, to replay it exactly.
+
+    Steps are run-length encoded: holding the same keys for a second at
+    TICK is one run instead of 60 entries. A file holds the seed, enemy
+    count, balance settings and world of the game, the runs and the digest
+    of the final state (GameSession.state_digest()), zlib-compressed after a
+    small header.
+    """
+
+    HEADER = struct.Struct("<4sH")
+    GAME = struct.Struct("<QI16sBI")
+    SETTINGS = struct.Struct("<iidd")
+    CHUNKED = struct.Struct("<IIQd")
+    STORED = struct.Struct("<II")
+    RUN = struct.Struct("<dBI")
+
+    def __init__(self, seed, enemy_count, grid=None, settings=None):
+        self.seed = seed
+        self.enemy_count = enemy_count
+        # Values of BALANCE_SETTINGS the game was played with
+        if settings is None:
+            settings = DEFAULT_BALANCE
+        self.settings = tuple(settings)
+        # World at the start of the game (see WORLD_*)
+        if grid is None:
+            self.world = (WORLD_GENERATED,)
+        elif isinstance(grid, ChunkedGrid):
+            self.world = (
+                WORLD_CHUNKED,
+                grid.columns,
+                grid.rows,
+                grid.seed,
+                grid.density,
+            )
+        else:
+            self.world = (WORLD_STORED, grid.columns, grid.rows, bytes(grid.cells))
+        # [dt, inputs, repeat count] of consecutive identical steps
+        self.runs = []
+        # Digest of the final state (known once saved or loaded)
+        self.digest = bytes(16)
+
+    def record(self, dt, inputs):
+        """Log one step."""
+        runs = self.runs
+        if runs:
+            last = runs[-1]
+            if last[0] == dt and last[1] == inputs:
+                last[2] += 1
+                return
+        runs.append([dt, inputs, 1])
+
+    def steps(self):
+        """Number of steps recorded."""
+        return sum(run[2] for run in self.runs)
+
+    def make_grid(self):
+        """Fresh copy of the recorded world (None: generated by start())."""
+        kind = self.world[0]
+        if kind == WORLD_CHUNKED:
+            _, columns, rows, seed, density = self.world
+            return ChunkedGrid(columns, rows, seed, density)
+        if kind == WORLD_STORED:
+            _, columns, rows, cells = self.world
+            grid = Grid(columns, rows)
+            grid.cells[:] = cells
+            return grid
+        return None
+
+    def save(self, path, digest):
+        """Write the recording, ending in the given final state digest."""
+        self.digest = digest
+        kind = self.world[0]
+        parts = [
+            self.GAME.pack(self.seed, self.enemy_count, digest, kind, len(self.runs)),
+            self.SETTINGS.pack(*self.settings),
+        ]
+        if kind == WORLD_CHUNKED:
+            parts.append(self.CHUNKED.pack(*self.world[1:]))
+        elif kind == WORLD_STORED:
+            parts.append(self.STORED.pack(*self.world[1:3]))
+            parts.append(self.world[3])
+        parts.extend(self.RUN.pack(*run) for run in self.runs)
+        with open(path, "wb") as replay_file:
+            replay_file.write(self.HEADER.pack(REPLAY_MAGIC, REPLAY_FORMAT))
+            replay_file.write(zlib.compress(b"".join(parts)))
+
+    @classmethod
+    def load(cls, path):
+        """Read a recording written by save().
+
+        Raises ValueError if the file isn't a recording of this format.
+        """
+        with open(path, "rb") as replay_file:
+            data = replay_file.read()
+        magic, version = cls.HEADER.unpack_from(data)
+        if magic != REPLAY_MAGIC or version != REPLAY_FORMAT:
+            raise ValueError(f"{path} is not a format {REPLAY_FORMAT} recording")
+        try:
+            payload = zlib.decompress(data[cls.HEADER.size :])
+        except zlib.error as error:
+            raise ValueError(f"{path} is corrupted") from error
+        seed, enemy_count, digest, kind, run_count = cls.GAME.unpack_from(payload)
+        offset = cls.GAME.size
+        settings = cls.SETTINGS.unpack_from(payload, offset)
+        offset += cls.SETTINGS.size
+        recorder = cls(seed, enemy_count, settings=settings)
+        recorder.digest = digest
+        if kind == WORLD_CHUNKED:
+            recorder.world = (kind,) + cls.CHUNKED.unpack_from(payload, offset)
+            offset += cls.CHUNKED.size
+        elif kind == WORLD_STORED:
+            columns, rows = cls.STORED.unpack_from(payload, offset)
+            offset += cls.STORED.size
+            cells = payload[offset : offset + columns * rows]
+            recorder.world = (kind, columns, rows, cells)
+            offset += columns * rows
+        recorder.runs = [
+            list(run)
+            for run in cls.RUN.iter_unpack(
+                payload[offset : offset + run_count * cls.RUN.size]
+            )
+        ]
+        return recorder
+
+
+def replay(recorder):
+    """Re-run a recorded game headless, as fast as possible.
+
+    recorder is an InputRecorder or the path of a saved one. Returns the
+    finished GameSession and whether its final state matches the recording.
+    """
+    if not isinstance(recorder, InputRecorder):
+        recorder = InputRecorder.load(recorder)
+    session = GameSession()
+    for name, value in zip(BALANCE_SETTINGS, recorder.settings):
+        setattr(session, name, value)
+    session.start(recorder.make_grid(), recorder.enemy_count, recorder.seed)
+    step = session.step
+    for dt, inputs, count in recorder.runs:
+        for _ in range(count):
+            step(dt, inputs)
+    return session, session.state_digest() == recorder.digest
+
+
+def save_recording(session, path=REPLAY_PATH):
+    """Save the game recorded by session, if any (errors are ignored)."""
+    if session.recorder is None:
+        return
+    try:
+        session.recorder.save(path, session.state_digest())
+    except OSError:
+        pass
+
+
+# Snapshot layout: header, then session, hero, random streams, enemy swarm
+# scalars and world, then the arrays, each after its byte length (-1 when
+# absent): grid bitset, edited chunks, enemy records, awake rows, wake-up
+# heap, hero cells the enemies were woken around, free cells
+SNAPSHOT_HEADER = struct.Struct("<4sH")
+SNAPSHOT_SESSION = struct.Struct("<B?iiQdiiidd")
+SNAPSHOT_HERO = struct.Struct("<ii7d?bbdiidd")
+SNAPSHOT_RANDOM = struct.Struct("<625I?d")
+SNAPSHOT_GENERATOR = struct.Struct("<16s16s?I")
+SNAPSHOT_SWARM = struct.Struct("<IdI")
+SNAPSHOT_WORLD = struct.Struct("<BIIQd")
+SNAPSHOT_LENGTH = struct.Struct("<q")
+SNAPSHOT_ARRAYS = 7
+# One fixed-size record per enemy, a field of EnemySwarm.FIELDS each
+ENEMY_RECORD = np.dtype(
+    [(name, dtype) for name, (dtype, _) in EnemySwarm.FIELDS.items()]
+)
+SCHEDULE_RECORD = np.dtype([("deadline", np.float64), ("row", np.int64)])
+
+
+def pack_world(grid):
+    """Cells of grid as a bitset, and the (x, y) of edited chunks.
+
+    A Grid packs all its cells (no chunks). A ChunkedGrid is rebuilt from
+    its seed, so only the chunks edited since it was generated are packed.
+    """
+    if isinstance(grid, ChunkedGrid):
+        keys = sorted(grid.edited)
+        cells = b"".join(grid.edited[key] for key in keys)
+        chunks = np.array(keys, np.int32).tobytes()
+    else:
+        cells = grid.cells
+        chunks = None
+    return np.packbits(np.frombuffer(cells, np.uint8)).tobytes(), chunks
+
+
+def unpack_world(world, bits, chunks):
+    """New grid from the SNAPSHOT_WORLD values and pack_world() data."""
+    kind, columns, rows, seed, density = world
+    if kind == WORLD_CHUNKED:
+        grid = ChunkedGrid(columns, rows, seed, density)
+        keys = np.frombuffer(chunks, np.int32).reshape(-1, 2).tolist()
+        size = CHUNK_CELLS * CHUNK_CELLS
+        cells = np.unpackbits(np.frombuffer(bits, np.uint8), count=len(keys) * size)
+        for i, (chunk_x, chunk_y) in enumerate(keys):
+            grid.edited[chunk_x, chunk_y] = bytearray(
+                cells[i * size : (i + 1) * size].tobytes()
+            )
+    else:
+        grid = Grid(columns, rows)
+        cells = np.unpackbits(np.frombuffer(bits, np.uint8), count=columns * rows)
+        grid.cells = bytearray(cells.tobytes())
+    return grid
+
+
+def pack_snapshot(session):
+    """Pack the state of a started session into bytes.
+
+    The grid is a bitset and enemies are ENEMY_RECORD records, so a
+    1000x1000 map with 10k enemies packs in a few milliseconds. The bitset
+    is kept while the grid doesn't change, so taking a snapshot every tick
+    (for rollback) doesn't pack the map again. Indexes that only depend on
+    positions are not stored; unpack_snapshot() rebuilds them.
+    """
+    hero = session.hero
+    enemies = session.enemies
+    grid = session.grid
+    coin = session.coin or (0, 0)
+    parts = [
+        SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT),
+        SNAPSHOT_SESSION.pack(
+            session.state,
+            session.coin is not None,
+            coin[0],
+            coin[1],
+            session.seed or 0,
+            session.accumulator,
+            session.damage_taken,
+            session.enemy_damage,
+            session.enemy_radius,
+            session.damage_cooldown,
+            session.obstacle_density,
+        ),
+        SNAPSHOT_HERO.pack(
+            hero.grid_x,
+            hero.grid_y,
+            hero.x,
+            hero.y,
+            hero.prev_x,
+            hero.prev_y,
+            hero.target_x,
+            hero.target_y,
+            hero.speed,
+            hero.is_moving,
+            hero.direction,
+            hero.clip,
+            hero.anim_time,
+            hero.health,
+            hero.coins,
+            hero.damage_timer,
+            hero.damage_cooldown,
+        ),
+    ]
+    _, state, gauss = session.rng.getstate()
+    parts.append(SNAPSHOT_RANDOM.pack(*state, gauss is not None, gauss or 0.0))
+    generator = enemies.rng.bit_generator.state
+    parts.append(
+        SNAPSHOT_GENERATOR.pack(
+            generator["state"]["state"].to_bytes(16, "little"),
+            generator["state"]["inc"].to_bytes(16, "little"),
+            bool(generator["has_uint32"]),
+            generator["uinteger"],
+        )
+    )
+    parts.append(SNAPSHOT_SWARM.pack(enemies.count, enemies.clock, enemies.max_radius))
+    if isinstance(grid, ChunkedGrid):
+        world = (WORLD_CHUNKED, grid.columns, grid.rows, grid.seed, grid.density)
+    else:
+        world = (WORLD_STORED, grid.columns, grid.rows, 0, 0.0)
+    parts.append(SNAPSHOT_WORLD.pack(*world))
+    packed = session.packed_grid
+    if packed is None or packed[0] is not grid or packed[1] != grid.version:
+        packed = (grid, grid.version) + pack_world(grid)
+        session.packed_grid = packed
+    records = np.empty(enemies.count, ENEMY_RECORD)
+    for name in EnemySwarm.FIELDS:
+        records[name] = getattr(enemies, name)[: enemies.count]
+    schedule = np.array(enemies.schedule, SCHEDULE_RECORD)
+    free_cells = session.free_cells
+    cells = None
+    if (
+        isinstance(free_cells, FreeCellIndex)
+        and free_cells.grid_version == grid.version
+    ):
+        cells = free_cells.cells.tobytes()
+    for array_bytes in (
+        packed[2],
+        packed[3],
+        records.tobytes(),
+        enemies.awake_rows.astype(np.int64).tobytes(),
+        schedule.tobytes(),
+        np.array(enemies.hero_cells, np.int32).tobytes(),
+        cells,
+    ):
+        if array_bytes is None:
+            parts.append(SNAPSHOT_LENGTH.pack(-1))
+        else:
+            parts.append(SNAPSHOT_LENGTH.pack(len(array_bytes)))
+            parts.append(array_bytes)
+    return b"".join(parts)
+
+
+def unpack_snapshot(session, data):
+    """Restore session to the state packed in data (bytes or a buffer).
+
+    Everything is copied out of data, so it can be a memory-mapped file
+    closed afterwards. Raises ValueError if data isn't a snapshot of this
+    format.
+
+    Restoring a snapshot of the session's current grid and enemies (a
+    rollback) keeps them and their indexes, only moving the entities whose
+    cell changed; otherwise the grid, hero, enemies and indexes are rebuilt.
+    """
+    data = memoryview(data)
+    magic, version = SNAPSHOT_HEADER.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_FORMAT:
+        raise ValueError(f"not a format {SNAPSHOT_FORMAT} snapshot")
+    offset = SNAPSHOT_HEADER.size
+    values = {}
+    for name, layout in (
+        ("session", SNAPSHOT_SESSION),
+        ("hero", SNAPSHOT_HERO),
+        ("random", SNAPSHOT_RANDOM),
+        ("generator", SNAPSHOT_GENERATOR),
+        ("swarm", SNAPSHOT_SWARM),
+        ("world", SNAPSHOT_WORLD),
+    ):
+        values[name] = layout.unpack_from(data, offset)
+        offset += layout.size
+    arrays = []
+    for _ in range(SNAPSHOT_ARRAYS):
+        (length,) = SNAPSHOT_LENGTH.unpack_from(data, offset)
+        offset += SNAPSHOT_LENGTH.size
+        if length < 0:
+            arrays.append(None)
+        else:
+            arrays.append(data[offset : offset + length])
+            offset += length
+    bits, chunks, records, awake_rows, schedule, hero_cells, free_cells = arrays
+
+    (
+        state,
+        has_coin,
+        coin_x,
+        coin_y,
+        seed,
+        session.accumulator,
+        session.damage_taken,
+        session.enemy_damage,
+        session.enemy_radius,
+        session.damage_cooldown,
+        session.obstacle_density,
+    ) = values["session"]
+    session.state = state
+    session.coin = (coin_x, coin_y) if has_coin else None
+    session.seed = seed
+    *state, has_gauss, gauss = values["random"]
+    session.rng.setstate((3, tuple(state), gauss if has_gauss else None))
+    session.recorder = None
+
+    grid = session.grid
+    packed = session.packed_grid
+    count = values["swarm"][0]
+    keep = (
+        packed is not None
+        and packed[0] is grid
+        and packed[1] == grid.version
+        and packed[2] == bits
+        and packed[3] == chunks
+    )
+    if not keep:
+        grid = unpack_world(values["world"], bits, chunks)
+        session.grid = grid
+        session.packed_grid = (
+            grid,
+            grid.version,
+            bytes(bits),
+            None if chunks is None else bytes(chunks),
+        )
+    # Same grid and number of enemies: update the entities in place
+    keep = keep and session.hero is not None and session.enemies.count == count
+
+    hero = session.hero if keep else Hero(*values["hero"][:2])
+    old_x, old_y = hero.grid_x, hero.grid_y
+    (
+        hero.grid_x,
+        hero.grid_y,
+        hero.x,
+        hero.y,
+        hero.prev_x,
+        hero.prev_y,
+        hero.target_x,
+        hero.target_y,
+        hero.speed,
+        hero.is_moving,
+        hero.direction,
+        hero.clip,
+        hero.anim_time,
+        hero.health,
+        hero.coins,
+        hero.damage_timer,
+        hero.damage_cooldown,
+    ) = values["hero"]
+
+    state_bytes, inc_bytes, has_uint32, uinteger = values["generator"]
+    generator_state = {
+        "bit_generator": "PCG64",
+        "state": {
+            "state": int.from_bytes(state_bytes, "little"),
+            "inc": int.from_bytes(inc_bytes, "little"),
+        },
+        "has_uint32": int(has_uint32),
+        "uinteger": uinteger,
+    }
+    if keep:
+        enemies = session.enemies
+        old_xs = enemies.grid_x[:count].copy()
+        old_ys = enemies.grid_y[:count].copy()
+        old_asleep = ~enemies.awake[:count]
+    else:
+        enemies = EnemySwarm(max(count, 16), rng=np.random.default_rng())
+    enemies.rng.bit_generator.state = generator_state
+    records = np.frombuffer(records, ENEMY_RECORD)
+    for name in EnemySwarm.FIELDS:
+        getattr(enemies, name)[:count] = records[name]
+    _, enemies.clock, enemies.max_radius = values["swarm"]
+    enemies.count = count
+    enemies.hero_cells = tuple(
+        map(tuple, np.frombuffer(hero_cells, np.int32).reshape(-1, 2).tolist())
+    )
+    enemies.awake_rows = np.frombuffer(awake_rows, np.int64).astype(np.intp)
+    enemies.schedule = [
+        (deadline, row)
+        for deadline, row in np.frombuffer(schedule, SCHEDULE_RECORD).tolist()
+    ]
+    if keep:
+        enemies.restored(old_xs, old_ys, old_asleep)
+    else:
+        enemies.restored()
+
+    if keep:
+        occupancy = session.occupancy
+        if (hero.grid_x, hero.grid_y) != (old_x, old_y):
+            occupancy.move(hero, old_x, old_y, hero.grid_x, hero.grid_y)
+        xs = enemies.grid_x[:count]
+        ys = enemies.grid_y[:count]
+        moved = (xs != old_xs) | (ys != old_ys)
+        occupancy.move_enemies(
+            old_ys[moved].astype(np.int64) * grid.columns + old_xs[moved],
+            ys[moved].astype(np.int64) * grid.columns + xs[moved],
+        )
+    else:
+        session.hero = hero
+        session.enemies = enemies
+        session.sight = FieldOfView(grid)
+        session.occupancy = occupancy = OccupancyIndex(grid)
+        hero.cell_listener = session
+        occupancy.add(hero, hero.grid_x, hero.grid_y)
+        occupancy.add_enemies(
+            enemies.grid_y[:count].astype(np.int64) * grid.columns
+            + enemies.grid_x[:count]
+        )
+        enemies.cell_listener = session
+        enemies.occupancy = occupancy
+        enemies.sight = session.sight
+        if isinstance(grid, ChunkedGrid):
+            session.free_cells = NearbyCellSampler(
+                grid, occupancy, hero, rng=session.rng
+            )
+        else:
+            session.free_cells = FreeCellIndex(grid, occupancy, session.rng)
+    max_distance = flow_field_range(enemies.max_radius)
+    if not keep or session.flow_field.max_distance != max_distance:
+        session.flow_field = FlowField(grid, max_distance)
+    if free_cells is not None:
+        session.free_cells.restore(np.frombuffer(free_cells, np.int32))
+    elif isinstance(session.free_cells, FreeCellIndex):
+        # Wasn't built for this grid yet: rebuild it when first needed
+        session.free_cells.grid_version = None
+
+
+def save_snapshot(session, path):
+    """Write a snapshot of session to path."""
+    with open(path, "wb") as snapshot_file:
+        snapshot_file.write(session.snapshot())
+
+
+def load_snapshot(path, session=None):
+    """Restore session (default: a new one) from the snapshot file at path.
+
+    The file is memory-mapped, so big maps are read straight into the
+    restored arrays without an intermediate copy of the whole file.
+    """
+    if session is None:
+        session = GameSession()
+    with open(path, "rb") as snapshot_file:
+        with mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            session.restore(data)
+    return session
+
+
+def start_game():
+    """Start a new game (its grid is only created now, not at startup)."""
+    global game_state, game_session
+    game_state = STATE_PLAYING
+    game_session = GameSession(audio=play_sound)
+    game_session.profiler = frame_profiler
+    game_session.start(record=True)
+    if grid_layer is not None:
+        grid_layer.invalidate()
+    # Play music if enabled
+    if music_enabled:
+        play_music("background")
+
+
+def read_keyboard():
+    """Translate the PgZero keyboard state into INPUT_* flags."""
+    inputs = 0
+    if keyboard.up or keyboard.w:
+        inputs |= INPUT_UP
+    if keyboard.down or keyboard.s:
+        inputs |= INPUT_DOWN
+    if keyboard.left or keyboard.a:
+        inputs |= INPUT_LEFT
+    if keyboard.right or keyboard.d:
+        inputs |= INPUT_RIGHT
+    return inputs
+
+
+def update(dt):
+    """PgZero update function called each frame."""
+    global game_state, render_alpha
+    if frame_profiler is not None:
+        frame_profiler.begin_frame(game_session and game_session.enemies)
+    finish_loading_assets()
+    if game_state == STATE_MENU:
+        return
+    if game_state == STATE_PLAYING:
+        render_alpha = game_session.advance(dt, read_keyboard())
+        if game_session.state == STATE_GAME_OVER:
+            game_state = STATE_GAME_OVER
+            save_recording(game_session)
+    elif game_state == STATE_GAME_OVER:
+        # Return to menu with space key
+        if keyboard.space:
+            game_state = STATE_MENU
+            stop_music()
+
+
+def draw():
+    """PgZero draw function called each frame."""
+    global dirty_renderer
+    if dirty_renderer is None:
+        dirty_renderer = DirtyRenderer()
+    if frame_profiler is not None:
+        frame_profiler.mark()
+    if game_state == STATE_PLAYING and dirty_rendering:
+        draw_game(dirty_renderer)
+        return
+    dirty_renderer.invalidate()
+    screen.fill(BACKGROUND_COLOR)
+    if game_state == STATE_MENU:
+        draw_menu()
+    elif game_state == STATE_PLAYING:
+        draw_game()
+    else:
+        draw_game()
+        draw_game_over()
+    if frame_profiler is not None and game_state != STATE_PLAYING:
+        draw_profiler_overlay(frame_profiler.overlay())
+
+
+def draw_grid(camera):
+    """Draw the part of the grid seen by the camera from the cached layer."""
+    global grid_layer
+    if grid_layer is None:
+        grid_layer = GridLayer()
+    grid_layer.draw(screen.surface, game_session.grid, camera.left, camera.top)
+
+
+def draw_coin(px, py):
+    """Draw the coin centered at screen pixel (px, py)."""
+    if not load_sprites().draw(screen.surface, SPRITE_COIN, px, py):
+        # fallback: simple yellow circle
+        screen.draw.filled_circle((px, py), CELL_SIZE // 4, (220, 200, 40))
+
+
+def draw_hud(health, coins):
+    """Draw the HUD line at the top left of the screen."""
+    text = f"HEALTH: {health}  COINS: {coins}"
+    draw_text(screen.surface, text, 28, "white", topleft=(10, 10))
+
+
+def game_sprites(camera):
+    """Coin, hero, enemies and fog drawn over the grid, in drawing order.
+
+    Items are (key, signature, rect, paint, args), see DirtyRenderer.
+    """
+    sprites = []
+    hero = game_session.hero
+    if game_session.coin:
+        cx, cy = game_session.coin
+        px = cx * CELL_SIZE + CELL_SIZE // 2
+        py = cy * CELL_SIZE + CELL_SIZE // 2
+        if camera.is_visible(px, py):
+            position = (px - camera.left, py - camera.top)
+            sprites.append(
+                ("coin", position, sprite_rect(*position), draw_coin, position)
+            )
+    if hero:
+        position = hero.screen_position(render_alpha, camera)
+        if position is not None:
+            clip, index = hero.current_animation()
+            signature = (position, hero.animation_slot(), index)
+            sprites.append(
+                ("hero", signature, sprite_rect(*position), hero.draw_at, position)
+            )
+    enemies = game_session.enemies
+    for i, x, y, slot, frame_idx in zip(*enemies.visible(render_alpha, camera)):
+        sprites.append(
+            (
+                i,
+                (x, y, slot, frame_idx),
+                sprite_rect(x, y),
+                enemies.draw_sprite,
+                (i, x, y, slot, frame_idx),
+            )
+        )
+    if fog_of_war and hero:
+        cell = (hero.grid_x, hero.grid_y)
+        signature = (cell, camera.left, camera.top, game_session.grid.version)
+        sprites.append(("fog", signature, SCREEN_RECT, draw_fog, (cell, camera)))
+    return sprites
+
+
+def draw_fog(cell, camera):
+    """Draw the fog over what the hero at cell can't see."""
+    global fog_layer
+    if fog_layer is None:
+        fog_layer = FogLayer()
+    x, y = cell
+    fog_layer.draw(screen.surface, game_session.sight, x, y, HERO_SIGHT_RADIUS, camera)
+
+
+def hud_sprites():
+    """HUD (and profiler overlay) items drawn last, like game_sprites()."""
+    sprites = []
+    hero = game_session.hero
+    if hero:
+        values = (hero.health, hero.coins)
+        sprites.append(("hud", values, HUD_RECT, draw_hud, values))
+    if frame_profiler is not None:
+        lines = frame_profiler.overlay()
+        sprites.append(
+            ("profiler", lines, PROFILER_RECT, draw_profiler_overlay, (lines,))
+        )
+    return sprites
+
+
+def draw_profiler_overlay(lines):
+    """Draw the profiler summary lines over a dark box at PROFILER_RECT."""
+    surface = screen.surface
+    pygame_draw.rect(surface, (0, 0, 0), PROFILER_RECT)
+    left = PROFILER_RECT.left + 8
+    for number, line in enumerate(lines):
+        top = PROFILER_RECT.top + 6 + number * 17
+        draw_text(surface, line, 18, "white", topleft=(left, top))
+
+
+def draw_game(renderer=None):
+    """Draw the game screen (only its changed areas, given a DirtyRenderer)."""
+    global game_camera
+    hero = game_session.hero
+    if game_camera is None:
+        game_camera = Camera()
+    camera = game_camera
+    if hero:
+        camera.follow(
+            hero.prev_x + (hero.x - hero.prev_x) * render_alpha,
+            hero.prev_y + (hero.y - hero.prev_y) * render_alpha,
+            game_session.grid,
+        )
+    profiler = frame_profiler
+    # Coin, characters and HUD
+    sprites = game_sprites(camera)
+    hud = hud_sprites()
+    if renderer is not None:
+        grid = game_session.grid
+        view = (grid, grid.version, camera.left, camera.top)
+        renderer.draw(screen.surface, view, lambda: draw_grid(camera), sprites + hud)
+        # Grid and HUD repaints are interleaved with the sprites here
+        if profiler is not None:
+            profiler.lap("entities")
+        return
+    # Draw grid
+    draw_grid(camera)
+    if profiler is not None:
+        profiler.lap("grid")
+    for *_, paint, args in sprites:
+        paint(*args)
+    if profiler is not None:
+        profiler.lap("entities")
+    for *_, paint, args in hud:
+        paint(*args)
+    if profiler is not None:
+        profiler.lap("hud")
+
+
+def compose_menu(music_on):
+    """Render the whole menu screen to a new surface."""
+    layer = Surface((WIDTH, HEIGHT))
+    layer.fill(BACKGROUND_COLOR)
+    draw_text(layer, "SIMPLE ROGUELIKE", 56, "white", center=(WIDTH / 2, 120))
+    # Buttons: start, music/sounds, exit
+    top = 240
+    width = 260
+    height = 56
+    left = WIDTH // 2 - width // 2
+
+    # Start button
+    btn_start = Rect(left, top, width, height)
+    pygame_draw.rect(layer, (70, 130, 70), btn_start)
+    draw_text(layer, "START GAME", 34, "white", center=btn_start.center)
+
+    # Music/Sounds toggle button
+    btn_music = Rect(left, top + 90, width, height)
+    music_color = (120, 100, 60) if music_on else (80, 80, 80)
+    pygame_draw.rect(layer, music_color, btn_music)
+    music_text = "MUSIC/SOUNDS: ON" if music_on else "MUSIC/SOUNDS: OFF"
+    draw_text(layer, music_text, 24, "white", center=btn_music.center)
+
+    # Exit button
+    btn_exit = Rect(left, top + 180, width, height)
+    pygame_draw.rect(layer, (150, 50, 50), btn_exit)
+    draw_text(layer, "EXIT", 34, "white", center=btn_exit.center)
+    return layer
+
+
+def compose_game_over():
+    """Render the game over overlay to a new surface."""
+    # Dark overlay
+    layer = Surface((WIDTH, HEIGHT))
+    layer.fill((0, 0, 0))
+    draw_text(layer, "GAME OVER", 56, "red", center=(WIDTH / 2, HEIGHT // 2 - 30))
+    draw_text(
+        layer,
+        "Press SPACE to return to menu",
+        22,
+        "white",
+        center=(WIDTH / 2, HEIGHT // 2 + 30),
+    )
+    return layer
+
+
+def draw_menu():
+    """Draw the main menu (composed once per music setting)."""
+    key = ("menu", music_enabled)
+    if key not in screen_layers:
+        screen_layers[key] = compose_menu(music_enabled)
+    screen.blit(screen_layers[key], (0, 0))
+    if asset_loader is not None and not asset_loader.ready():
+        draw_loading_bar(asset_loader.progress())
+
+
+def draw_loading_bar(progress):
+    """Progress of the background asset loading, under the menu buttons."""
+    bar = Rect(WIDTH // 2 - 130, HEIGHT - 70, 260, 8)
+    pygame_draw.rect(screen.surface, FLOOR_BORDER_COLOR, bar)
+    pygame_draw.rect(
+        screen.surface, (120, 160, 120), Rect(bar.x, bar.y, bar.w * progress, bar.h)
+    )
+    draw_text(
+        screen.surface,
+        f"Loading... {progress:.0%}",
+        20,
+        "gray",
+        center=(WIDTH / 2, bar.y - 14),
+    )
+
+
+def draw_game_over():
+    """Draw the game over screen (composed once)."""
+    key = ("game_over",)
+    if key not in screen_layers:
+        screen_layers[key] = compose_game_over()
+    screen.blit(screen_layers[key], (0, 0))
+
+
+def on_key_down(key):
+    """F3 toggles the frame profiler; F4 writes its frames to a CSV file."""
+    global frame_profiler
+    if key == keys.F3:
+        frame_profiler = FrameProfiler() if frame_profiler is None else None
+        if game_session is not None:
+            game_session.profiler = frame_profiler
+    elif key == keys.F4 and frame_profiler is not None:
+        try:
+            frame_profiler.write_csv()
+        except OSError:
+            pass
+
+
+def on_mouse_down(pos):
+    """Handle mouse clicks on menu."""
+    global music_enabled, sounds_enabled
+    if game_state != STATE_MENU:
+        return
+    top = 240
+    width = 260
+    height = 56
+    left = WIDTH // 2 - width // 2
+    # Start button
+    if Rect(left, top, width, height).collidepoint(pos):
+        play_sound("button_click")
+        start_game()
+    # Music/Sounds toggle button
+    elif Rect(left, top + 90, width, height).collidepoint(pos):
+        music_enabled = not music_enabled
+        sounds_enabled = music_enabled
+        if music_enabled:
+            play_music("background")
+        else:
+            stop_music()
         play_sound("button_click")
     # Exit button
     elif Rect(left, top + 180, width, height).collidepoint(pos):
@@ -678,5 +4104,95 @@ def on_mouse_down(pos):
         exit()
 
 
-# Initialize game grid
-game_grid = create_grid()
+# Under pgzrun (a window already exists), load assets behind the menu
+if pygame_display.get_surface() is not None:
+    start_loading_assets()
+
+
+def main(argv=None):
+    """Command line tools (the game itself runs with pgzrun game.py)."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+    replay_parser = commands.add_parser(
+        "replay", help="re-run a recorded game headless and check its result"
+    )
+    replay_parser.add_argument("path", nargs="?", default=REPLAY_PATH)
+    startup_parser = commands.add_parser(
+        "startup",
+        help="time to the first frame (the menu), which must be within "
+        f"{STARTUP_FRAME_BUDGET * 1000:.0f} ms, and to the loaded assets",
+    )
+    # Set in the process "startup" starts and times
+    startup_parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.command == "startup":
+        if args.child:
+            draw_first_frame()
+            return 0
+        return check_startup()
+    if args.command == "replay":
+        try:
+            recorder = InputRecorder.load(args.path)
+        except (OSError, ValueError, struct.error) as error:
+            parser.error(str(error))
+        started = time.perf_counter()
+        _, matched = replay(recorder)
+        elapsed = time.perf_counter() - started
+        steps = recorder.steps()
+        played = sum(dt * count for dt, _, count in recorder.runs)
+        print(
+            f"{steps} steps ({played:.1f} s of play) in {elapsed:.3f} s, "
+            f"{steps / max(elapsed, 1e-9):.0f} steps/s"
+        )
+        print("final state matches" if matched else "final state DIFFERS")
+        return 0 if matched else 1
+    return 0
+
+
+def draw_first_frame():
+    """Draw the first frame as pgzrun would, then wait for the assets.
+
+    Prints FIRST_FRAME_LINE and ASSETS_LOADED_LINE as each is done.
+    """
+    global screen
+    screen = Screen(pygame_display.set_mode((WIDTH, HEIGHT)))
+    start_loading_assets()
+    draw()
+    pygame_display.flip()
+    print(FIRST_FRAME_LINE, flush=True)
+    asset_loader.thread.join()
+    finish_loading_assets()
+    print(ASSETS_LOADED_LINE, flush=True)
+
+
+def check_startup():
+    """Start the game in a new process and time its first frame and assets.
+
+    Times count from launching the process, so starting Python and the
+    imports are included. Returns 1 (failure) if the first frame came later
+    than STARTUP_FRAME_BUDGET seconds.
+    """
+    started = time.perf_counter()
+    child = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "startup", "--child"],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    # Milestone line -> seconds after the launch
+    times = {}
+    for line in child.stdout:
+        times.setdefault(line.strip(), time.perf_counter() - started)
+    if child.wait() != 0 or ASSETS_LOADED_LINE not in times:
+        print("the game didn't start")
+        return 1
+    first_frame = times[FIRST_FRAME_LINE]
+    print(
+        f"first frame after {first_frame * 1000:.0f} ms "
+        f"(budget {STARTUP_FRAME_BUDGET * 1000:.0f} ms), "
+        f"assets loaded after {times[ASSETS_LOADED_LINE] * 1000:.0f} ms"
+    )
+    return 0 if first_frame <= STARTUP_FRAME_BUDGET else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,170 @@
+"""
+Monte Carlo balancing: play thousands of seeded headless games on every core.
+
+Each game runs a GameSession with the given balance settings and a scripted
+hero policy until the hero dies or max ticks pass. Results stream back from
+the worker processes as games finish, are written one row per game to a CSV
+file, and are summarized at the end.
+
+    python montecarlo.py --games 5000 --policy coins --enemy-radius 6
+"""
+
+import os
+
+# Workers never open a window or a sound device
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import argparse
+import json
+import multiprocessing
+import random
+import time
+
+import numpy as np
+
+import game
+
+# Per-game results and where they go by default
+RESULT_FIELDS = ("seed", "ticks", "coins", "damage_taken", "died")
+RESULTS_PATH = os.path.join(game.GAME_DIR, "montecarlo.csv")
+# Games handed to a worker at a time (fewer round trips, still streaming)
+CHUNK_SIZE = 8
+
+DIRECTION_INPUTS = (game.INPUT_UP, game.INPUT_DOWN, game.INPUT_LEFT, game.INPUT_RIGHT)
+
+
+def idle_policy(session, rng):
+    """Never move."""
+    return 0
+
+
+def random_policy(session, rng):
+    """Press a random direction every tick (a random walk)."""
+    return rng.choice(DIRECTION_INPUTS)
+
+
+def coins_policy(session, rng):
+    """Walk towards the coin, the longer axis first, around obstacles."""
+    hero = session.hero
+    if session.coin is None:
+        return random_policy(session, rng)
+    coin_x, coin_y = session.coin
+    dx = coin_x - hero.grid_x
+    dy = coin_y - hero.grid_y
+    horizontal = (
+        game.INPUT_RIGHT if dx > 0 else game.INPUT_LEFT,
+        (1 if dx > 0 else -1, 0),
+    )
+    vertical = (game.INPUT_DOWN if dy > 0 else game.INPUT_UP, (0, 1 if dy > 0 else -1))
+    moves = [horizontal, vertical] if abs(dx) >= abs(dy) else [vertical, horizontal]
+    if dx == 0:
+        moves.remove(horizontal)
+    if dy == 0:
+        moves.remove(vertical)
+    for inputs, (step_x, step_y) in moves:
+        x = hero.grid_x + step_x
+        y = hero.grid_y + step_y
+        if session.grid.in_bounds(x, y) and not session.grid.is_blocked(x, y):
+            return inputs
+    return random_policy(session, rng)
+
+
+POLICIES = {"idle": idle_policy, "random": random_policy, "coins": coins_policy}
+
+
+def play_game(job):
+    """Play one seeded game; returns its RESULT_FIELDS values."""
+    seed, settings = job
+    session = game.GameSession()
+    session.enemy_damage = settings["enemy_damage"]
+    session.enemy_radius = settings["enemy_radius"]
+    session.damage_cooldown = settings["damage_cooldown"]
+    session.obstacle_density = settings["obstacle_density"]
+    session.start(enemy_count=settings["enemies"], seed=seed)
+    policy = POLICIES[settings["policy"]]
+    # Policy randomness is seeded too, so a game can be played again
+    rng = random.Random(seed ^ 0x5EED)
+    step = session.step
+    ticks = 0
+    for ticks in range(1, settings["max_ticks"] + 1):
+        step(game.TICK, policy(session, rng))
+        if session.state != game.STATE_PLAYING:
+            break
+    died = session.state == game.STATE_GAME_OVER
+    return (seed, ticks, session.hero.coins, session.damage_taken, died)
+
+
+def summarize(results):
+    """Mean, deviation and percentiles of every result field."""
+    values = np.array([row[1:] for row in results], dtype=np.float64)
+    summary = {"games": len(results)}
+    for column, name in enumerate(RESULT_FIELDS[1:]):
+        data = values[:, column]
+        p5, p50, p95 = np.percentile(data, (5, 50, 95))
+        summary[name] = {
+            "mean": float(data.mean()),
+            "std": float(data.std()),
+            "p5": float(p5),
+            "p50": float(p50),
+            "p95": float(p95),
+        }
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--games", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first game")
+    parser.add_argument("--policy", choices=sorted(POLICIES), default="random")
+    parser.add_argument("--max-ticks", type=int, default=60 * game.SIMULATION_RATE)
+    parser.add_argument("--enemies", type=int, default=4)
+    parser.add_argument("--enemy-radius", type=int, default=game.ENEMY_RADIUS)
+    parser.add_argument("--enemy-damage", type=int, default=game.ENEMY_DAMAGE)
+    parser.add_argument(
+        "--damage-cooldown", type=float, default=game.HERO_DAMAGE_COOLDOWN
+    )
+    parser.add_argument("--obstacle-density", type=float, default=game.OBSTACLE_DENSITY)
+    parser.add_argument("--output", default=RESULTS_PATH, help="per-game CSV")
+    parser.add_argument("--summary", help="also write the summary to this JSON file")
+    args = parser.parse_args(argv)
+
+    settings = {
+        "policy": args.policy,
+        "max_ticks": args.max_ticks,
+        "enemies": args.enemies,
+        "enemy_radius": args.enemy_radius,
+        "enemy_damage": args.enemy_damage,
+        "damage_cooldown": args.damage_cooldown,
+        "obstacle_density": args.obstacle_density,
+    }
+    jobs = ((seed, settings) for seed in range(args.seed, args.seed + args.games))
+    results = []
+    started = time.perf_counter()
+    with open(args.output, "w") as output, multiprocessing.Pool(args.workers) as pool:
+        output.write(",".join(RESULT_FIELDS) + "\n")
+        for row in pool.imap_unordered(play_game, jobs, CHUNK_SIZE):
+            results.append(row)
+            output.write(",".join(str(int(value)) for value in row) + "\n")
+            if len(results) % 100 == 0:
+                print(f"\r{len(results)}/{args.games} games", end="", flush=True)
+    elapsed = time.perf_counter() - started
+    print(f"\r{len(results)} games in {elapsed:.1f} s ({len(results) / elapsed:.1f}/s)")
+
+    summary = summarize(results)
+    summary["settings"] = settings
+    for name in RESULT_FIELDS[1:]:
+        stats = summary[name]
+        print(
+            f"{name:<13} mean {stats['mean']:9.2f}  std {stats['std']:9.2f}  "
+            f"p5 {stats['p5']:8.1f}  p50 {stats['p50']:8.1f}  p95 {stats['p95']:8.1f}"
+        )
+    if args.summary:
+        with open(args.summary, "w") as summary_file:
+            json.dump(summary, summary_file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
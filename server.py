@@ -0,0 +1,853 @@
+"""
+Authoritative multiplayer server: several heroes on one grid and enemy set.
+
+The server alone runs the simulation, at SIMULATION_RATE ticks per second.
+Clients connect over TCP or UDP, get a WELCOME with their player id and the
+grid, then send the keys they hold (INPUT_* flags) with the last state tick
+they received. Every tick each client gets a STATE message: the heroes in
+full and only the enemies that changed since the state the client last
+acknowledged (all of them if it has none the server still keeps).
+
+    python server.py serve --port 7777 --enemies 300
+    python server.py load --clients 40 --seconds 10         # over TCP
+    python server.py load --clients 40 --seconds 10 --udp
+
+Messages start with their kind byte and are little-endian. Over TCP each
+one follows its length (FRAME); over UDP each is one datagram.
+"""
+
+import os
+
+# The server never opens a window or a sound device
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import argparse
+import asyncio
+import multiprocessing
+import random
+import struct
+import time
+from collections import OrderedDict, deque
+
+import numpy as np
+
+import game
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 7777
+
+# Message kinds (first byte of every message)
+MSG_HELLO = 1  # client -> server (UDP): join, or resend the WELCOME
+MSG_INPUT = 2  # client -> server: held keys and last state tick received
+MSG_BYE = 3  # client -> server (UDP): leave
+MSG_WELCOME = 4  # server -> client: player id, then the grid
+MSG_STATE = 5  # server -> client: the state of one tick
+
+# kind, INPUT_* flags, acknowledged tick (NO_BASE: none yet)
+INPUT = struct.Struct("<BBI")
+# kind, player, tick, columns, rows; followed by the grid as a bitset
+WELCOME = struct.Struct("<BHIII")
+# kind, tick, base tick (NO_BASE: full state), heroes, enemies, coin x and y
+# (-1 if none); followed by HERO_STATE records, unless full a bitmask of the
+# enemies changed since the base, and the ENEMY_STATE records of those
+STATE = struct.Struct("<BIIHIii")
+# Length of each TCP message
+FRAME = struct.Struct("<I")
+NO_BASE = 0xFFFFFFFF
+
+# What clients see of each hero and enemy
+HERO_STATE = np.dtype(
+    [
+        ("player", "<u2"),
+        ("grid_x", "<i4"),
+        ("grid_y", "<i4"),
+        ("x", "<f4"),
+        ("y", "<f4"),
+        ("direction", "u1"),
+        ("is_moving", "u1"),
+        ("health", "<i2"),
+        ("coins", "<u2"),
+    ]
+)
+ENEMY_STATE = np.dtype(
+    [
+        ("grid_x", "<i4"),
+        ("grid_y", "<i4"),
+        ("x", "<f4"),
+        ("y", "<f4"),
+        ("direction", "u1"),
+        ("is_moving", "u1"),
+    ]
+)
+
+# States kept to diff against (a client acknowledging an older one gets a
+# full state), about a second's worth
+HISTORY_TICKS = 64
+MAX_PLAYERS = 256
+# Longest message a client may send, and the largest UDP payload
+MAX_CLIENT_MESSAGE = 64
+MAX_DATAGRAM = 65507
+# A TCP client whose unsent data passes this skips ticks until it drains
+TCP_BUFFER_LIMIT = 256 * 1024
+# Seconds without a datagram before a UDP client is dropped
+CLIENT_TIMEOUT = 5.0
+# Seconds between the stats lines printed by "serve"
+STATS_INTERVAL = 5.0
+# Tick times kept for the percentiles (a minute's worth; cleared after each
+# stats line)
+TICK_TIME_WINDOW = 60 * game.SIMULATION_RATE
+# Share of ticks that may finish late while the load test still keeps up
+LATE_TICK_ALLOWANCE = 0.01
+# Default world of the server
+DEFAULT_COLUMNS = 100
+DEFAULT_ROWS = 100
+DEFAULT_ENEMIES = 300
+
+
+class SharedSession(game.GameSession):
+    """GameSession where several heroes share the grid, enemies and coin.
+
+    Heroes join and leave at any time by player id, and step() takes the
+    INPUT_* flags of each. Enemies chase the closest hero they notice. A
+    hero killed by enemies respawns on a free cell with full health and no
+    coins, so the game never ends. Needs a Grid (not a ChunkedGrid).
+    """
+
+    def __init__(self, seed=None):
+        super().__init__(seed=seed)
+        # Player id -> Hero, and the FlowField enemies follow to reach it
+        self.heroes = {}
+        self.flow_fields = {}
+        self.deaths = 0
+
+    def start(self, grid=None, enemy_count=4, seed=None):
+        """New world without heroes (see GameSession.start())."""
+        super().start(grid, enemy_count, seed)
+        # Heroes come with join(): the local player's isn't used
+        self.remove_character(self.hero)
+        self.hero = None
+        self.heroes.clear()
+        self.flow_fields.clear()
+
+    def join(self, player):
+        """Spawn the hero of player on a free cell and return it."""
+        cell = self.free_cells.sample()
+        if cell is None:
+            raise ValueError("no free cell left for a hero")
+        hero = game.Hero(*cell)
+        hero.damage_cooldown = self.damage_cooldown
+        self.add_character(hero)
+        self.heroes[player] = hero
+        # Enemies only chase within their radius: paths twice as long will do
+        self.flow_fields[player] = game.FlowField(
+            self.grid, 2 * self.enemies.max_radius
+        )
+        return hero
+
+    def leave(self, player):
+        """Remove the hero of player."""
+        self.remove_character(self.heroes.pop(player))
+        del self.flow_fields[player]
+
+    def enemy_at(self, x, y):
+        """True if an enemy stands on (x, y)."""
+        return self.occupancy.enemy_count(x, y) > 0
+
+    def step(self, dt, inputs=None):
+        """Advance every hero (inputs: player -> INPUT_* flags) and the enemies."""
+        inputs = inputs or {}
+        grid = self.grid
+        for player, hero in self.heroes.items():
+            hero.prev_x = hero.x
+            hero.prev_y = hero.y
+            if hero.damage_timer > 0.0:
+                hero.damage_timer = max(0.0, hero.damage_timer - dt)
+            hero.process_input(grid, inputs.get(player, 0))
+            hero.update_position(dt)
+            if self.coin and (hero.grid_x, hero.grid_y) == self.coin:
+                hero.coins += 1
+                self.respawn_coin()
+        heroes = list(self.heroes.values())
+        flow_fields = list(self.flow_fields.values())
+        awake = self.enemies.think(dt, grid, heroes, flow_fields)
+        self.enemies.move(awake, dt, heroes)
+        for player, hero in list(self.heroes.items()):
+            if hero.damage_timer > 0.0 or not self.enemy_at(hero.grid_x, hero.grid_y):
+                continue
+            hero.health -= self.enemy_damage
+            self.damage_taken += self.enemy_damage
+            hero.damage_timer = hero.damage_cooldown
+            if hero.health <= 0:
+                self.deaths += 1
+                self.leave(player)
+                self.join(player)
+
+
+def hero_states(heroes):
+    """HERO_STATE records of a {player: Hero} dict."""
+    records = np.empty(len(heroes), HERO_STATE)
+    for i, (player, hero) in enumerate(heroes.items()):
+        records[i] = (
+            player,
+            hero.grid_x,
+            hero.grid_y,
+            hero.x,
+            hero.y,
+            hero.direction,
+            hero.is_moving,
+            hero.health,
+            hero.coins,
+        )
+    return records
+
+
+def enemy_states(enemies):
+    """ENEMY_STATE records of every enemy of an EnemySwarm."""
+    records = np.empty(enemies.count, ENEMY_STATE)
+    for name in ENEMY_STATE.names:
+        records[name] = getattr(enemies, name)[: enemies.count]
+    return records
+
+
+def encode_state(tick, heroes, enemies, coin, base_tick=NO_BASE, base=None):
+    """STATE message of tick, its enemies diffed against base (if given).
+
+    base is the ENEMY_STATE records of base_tick; without it, or if the
+    number of enemies changed, the state is sent in full.
+    """
+    coin_x, coin_y = coin or (-1, -1)
+    if base is None or len(base) != len(enemies):
+        header = STATE.pack(
+            MSG_STATE, tick, NO_BASE, len(heroes), len(enemies), coin_x, coin_y
+        )
+        return b"".join((header, heroes.tobytes(), enemies.tobytes()))
+    width = ENEMY_STATE.itemsize
+    changed = (
+        enemies.view(np.uint8).reshape(-1, width)
+        != base.view(np.uint8).reshape(-1, width)
+    ).any(axis=1)
+    header = STATE.pack(
+        MSG_STATE, tick, base_tick, len(heroes), len(enemies), coin_x, coin_y
+    )
+    return b"".join(
+        (
+            header,
+            heroes.tobytes(),
+            np.packbits(changed).tobytes(),
+            enemies[changed].tobytes(),
+        )
+    )
+
+
+class StateDecoder:
+    """Client side of encode_state(): rebuilds the state of every tick.
+
+    The last history decoded states are kept as bases for the next diffs;
+    tick is the newest one, to acknowledge in INPUT messages.
+    """
+
+    def __init__(self, history=HISTORY_TICKS):
+        self.history_size = history
+        # Tick -> ENEMY_STATE records
+        self.history = OrderedDict()
+        self.tick = NO_BASE
+
+    def decode(self, message):
+        """(tick, heroes, enemies, coin) of a STATE message.
+
+        Raises ValueError if it is a diff against a state not received.
+        """
+        _, tick, base_tick, hero_count, enemy_count, coin_x, coin_y = STATE.unpack_from(
+            message
+        )
+        offset = STATE.size
+        heroes = np.frombuffer(message, HERO_STATE, hero_count, offset)
+        offset += heroes.nbytes
+        if base_tick == NO_BASE:
+            enemies = np.frombuffer(message, ENEMY_STATE, enemy_count, offset).copy()
+        else:
+            base = self.history.get(base_tick)
+            if base is None:
+                raise ValueError(f"state {tick} is a diff of unknown state {base_tick}")
+            mask_size = (enemy_count + 7) // 8
+            mask = np.frombuffer(message, np.uint8, mask_size, offset)
+            changed = np.unpackbits(mask, count=enemy_count).view(np.bool_)
+            offset += mask_size
+            enemies = base.copy()
+            enemies[changed] = np.frombuffer(
+                message, ENEMY_STATE, int(changed.sum()), offset
+            )
+        self.history[tick] = enemies
+        if len(self.history) > self.history_size:
+            self.history.popitem(last=False)
+        # Datagrams may arrive out of order: acknowledge the newest
+        if self.tick == NO_BASE or tick > self.tick:
+            self.tick = tick
+        coin = None if coin_x < 0 else (coin_x, coin_y)
+        return tick, heroes, enemies, coin
+
+
+class Client:
+    """A connected player: where its messages go, its keys and last ack."""
+
+    def __init__(self, player, transport, address=None):
+        self.player = player
+        # TCP transport, or the UDP endpoint and the client's address
+        self.transport = transport
+        self.address = address
+        self.inputs = 0
+        self.ack = NO_BASE
+        self.last_seen = time.monotonic()
+
+    def send(self, message):
+        """Send message; False if skipped because the client is backed up."""
+        if self.address is not None:
+            self.transport.sendto(message, self.address)
+            return True
+        if self.transport.get_write_buffer_size() > TCP_BUFFER_LIMIT:
+            return False
+        self.transport.write(FRAME.pack(len(message)) + message)
+        return True
+
+
+class GameServer:
+    """Runs a SharedSession at SIMULATION_RATE and syncs it to its clients.
+
+    Every tick's enemy states are kept for HISTORY_TICKS ticks. Clients
+    that acknowledged the same tick share one encoded message, so the cost
+    of a tick grows with the number of distinct acks, not of clients.
+    """
+
+    def __init__(self, session, history=HISTORY_TICKS):
+        self.session = session
+        self.history_size = history
+        # Tick -> ENEMY_STATE records
+        self.history = OrderedDict()
+        self.tick = 0
+        # Player id -> Client, and UDP address -> Client
+        self.clients = {}
+        self.udp_clients = {}
+        self.next_player = 1
+        grid = session.grid
+        cells = np.frombuffer(grid.cells, np.uint8)
+        self.welcome_grid = np.packbits(cells).tobytes()
+        # Stats: seconds taken by the last ticks, ticks that finished after
+        # their slot and ticks dropped for running late, messages and bytes
+        # sent, full states among them
+        self.tick_times = deque(maxlen=TICK_TIME_WINDOW)
+        self.late_ticks = 0
+        self.dropped_ticks = 0
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.full_states = 0
+        self.skipped_sends = 0
+
+    def join(self, transport, address=None):
+        """New Client (and hero) for a connection; None if the server is full."""
+        if len(self.clients) >= MAX_PLAYERS:
+            return None
+        player = self.next_player
+        while player in self.clients:
+            player = player % 65535 + 1
+        self.next_player = player % 65535 + 1
+        self.session.join(player)
+        client = Client(player, transport, address)
+        self.clients[player] = client
+        if address is not None:
+            self.udp_clients[address] = client
+        self.welcome(client)
+        return client
+
+    def welcome(self, client):
+        """Send client its player id and the grid."""
+        grid = self.session.grid
+        header = WELCOME.pack(
+            MSG_WELCOME, client.player, self.tick, grid.columns, grid.rows
+        )
+        client.send(header + self.welcome_grid)
+
+    def leave(self, client):
+        """Forget client and remove its hero."""
+        if self.clients.pop(client.player, None) is not None:
+            self.session.leave(client.player)
+        if client.address is not None:
+            self.udp_clients.pop(client.address, None)
+
+    def receive(self, client, message):
+        """Handle an INPUT message from client (anything else is ignored)."""
+        client.last_seen = time.monotonic()
+        if len(message) != INPUT.size or message[0] != MSG_INPUT:
+            return
+        _, inputs, ack = INPUT.unpack(message)
+        client.inputs = inputs
+        if ack != NO_BASE and ack <= self.tick:
+            if client.ack == NO_BASE or ack > client.ack:
+                client.ack = ack
+
+    def step(self):
+        """Simulate one tick and send its state to every client."""
+        started = time.perf_counter()
+        session = self.session
+        clients = self.clients
+        session.step(
+            game.TICK, {player: client.inputs for player, client in clients.items()}
+        )
+        self.tick += 1
+        heroes = hero_states(session.heroes)
+        enemies = enemy_states(session.enemies)
+        history = self.history
+        history[self.tick] = enemies
+        if len(history) > self.history_size:
+            history.popitem(last=False)
+        # Base tick -> message, shared by the clients that acknowledged it
+        messages = {}
+        for client in list(clients.values()):
+            base_tick = client.ack if client.ack in history else NO_BASE
+            message = messages.get(base_tick)
+            if message is None:
+                message = encode_state(
+                    self.tick,
+                    heroes,
+                    enemies,
+                    session.coin,
+                    base_tick,
+                    history.get(base_tick),
+                )
+                messages[base_tick] = message
+            if client.send(message):
+                self.messages_sent += 1
+                self.bytes_sent += len(message)
+                self.full_states += base_tick == NO_BASE
+            else:
+                self.skipped_sends += 1
+        self.tick_times.append(time.perf_counter() - started)
+
+    def drop_silent_clients(self):
+        """Drop the UDP clients not heard from for CLIENT_TIMEOUT seconds."""
+        deadline = time.monotonic() - CLIENT_TIMEOUT
+        for client in list(self.udp_clients.values()):
+            if client.last_seen < deadline:
+                self.leave(client)
+
+    async def run(self, stop=None, report=None):
+        """Tick at SIMULATION_RATE until stop() is true (default: forever).
+
+        A tick that finishes after the next one was due counts in
+        late_ticks, and the next one is run right away; when more than
+        MAX_TICKS_PER_FRAME ticks behind, the backlog is dropped (counted in
+        dropped_ticks) instead of snowballing. report() is called every
+        STATS_INTERVAL seconds, and the tick times are cleared after it.
+        """
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        next_report = next_tick + STATS_INTERVAL
+        while stop is None or not stop():
+            self.step()
+            if self.tick % game.SIMULATION_RATE == 0:
+                self.drop_silent_clients()
+            next_tick += game.TICK
+            now = loop.time()
+            if now > next_tick:
+                self.late_ticks += 1
+                if now - next_tick > game.MAX_TICKS_PER_FRAME * game.TICK:
+                    self.dropped_ticks += int((now - next_tick) / game.TICK)
+                    next_tick = now
+            if report is not None and now >= next_report:
+                report(self)
+                self.tick_times.clear()
+                next_report += STATS_INTERVAL
+            await asyncio.sleep(max(0.0, next_tick - now))
+
+    def stats(self):
+        """Tick times (ms) since the last report, traffic and counts so far."""
+        times = np.array(self.tick_times or [0.0]) * 1000.0
+        p50, p99 = np.percentile(times, (50, 99))
+        messages = max(self.messages_sent, 1)
+        return {
+            "ticks": self.tick,
+            "clients": len(self.clients),
+            "tick_p50_ms": float(p50),
+            "tick_p99_ms": float(p99),
+            "tick_max_ms": float(times.max()),
+            "tick_budget_ms": game.TICK * 1000.0,
+            "late_ticks": self.late_ticks,
+            "dropped_ticks": self.dropped_ticks,
+            "messages": self.messages_sent,
+            "bytes": self.bytes_sent,
+            "mean_message_bytes": self.bytes_sent / messages,
+            "full_states": self.full_states,
+            "skipped_sends": self.skipped_sends,
+            "deaths": self.session.deaths,
+        }
+
+
+class TCPConnection(asyncio.Protocol):
+    """One TCP client of a GameServer (a message after each FRAME)."""
+
+    def __init__(self, server):
+        self.server = server
+        self.buffer = bytearray()
+        self.client = None
+
+    def connection_made(self, transport):
+        self.client = self.server.join(transport)
+        if self.client is None:
+            transport.close()
+
+    def data_received(self, data):
+        # Turned away (server full): the connection is closing
+        if self.client is None:
+            return
+        buffer = self.buffer
+        buffer += data
+        while len(buffer) >= FRAME.size:
+            (length,) = FRAME.unpack_from(buffer)
+            if length > MAX_CLIENT_MESSAGE:
+                self.client.transport.close()
+                return
+            end = FRAME.size + length
+            if len(buffer) < end:
+                break
+            self.server.receive(self.client, bytes(buffer[FRAME.size : end]))
+            del buffer[:end]
+
+    def connection_lost(self, exc):
+        if self.client is not None:
+            self.server.leave(self.client)
+
+
+class UDPEndpoint(asyncio.DatagramProtocol):
+    """UDP side of a GameServer: a HELLO datagram joins, a BYE leaves."""
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        if not data or len(data) > MAX_CLIENT_MESSAGE:
+            return
+        server = self.server
+        client = server.udp_clients.get(address)
+        if data[0] == MSG_HELLO:
+            if client is None:
+                server.join(self.transport, address)
+            else:
+                # Its WELCOME was lost
+                server.welcome(client)
+        elif client is not None:
+            if data[0] == MSG_BYE:
+                server.leave(client)
+            else:
+                server.receive(client, data)
+
+
+def create_session(columns, rows, enemy_count, seed):
+    """Started SharedSession on a new columns x rows grid."""
+    session = SharedSession(seed)
+    grid = game.create_grid(random.Random(seed), columns, rows)
+    session.start(grid, enemy_count, seed)
+    return session
+
+
+def max_state_size(enemy_count):
+    """Bytes of a full STATE message with MAX_PLAYERS heroes."""
+    return (
+        STATE.size
+        + MAX_PLAYERS * HERO_STATE.itemsize
+        + enemy_count * ENEMY_STATE.itemsize
+    )
+
+
+async def serve(settings, stop=None, ready=None, report=None):
+    """Run a GameServer with the given settings; returns it once stopped.
+
+    UDP is only offered when full states fit in one datagram. ready() is
+    called once the server listens.
+    """
+    session = create_session(
+        settings["columns"], settings["rows"], settings["enemies"], settings["seed"]
+    )
+    server = GameServer(session)
+    loop = asyncio.get_running_loop()
+    host = settings["host"]
+    port = settings["port"]
+    tcp = await loop.create_server(lambda: TCPConnection(server), host, port)
+    udp = None
+    welcome_size = WELCOME.size + len(server.welcome_grid)
+    if max(max_state_size(settings["enemies"]), welcome_size) <= MAX_DATAGRAM:
+        udp, _ = await loop.create_datagram_endpoint(
+            lambda: UDPEndpoint(server), local_addr=(host, port)
+        )
+    else:
+        print("UDP disabled: full states don't fit in a datagram")
+    if ready is not None:
+        ready()
+    try:
+        await server.run(stop, report)
+    finally:
+        tcp.close()
+        if udp is not None:
+            udp.close()
+    return server
+
+
+def print_stats(server):
+    stats = server.stats()
+    print(
+        f"tick {stats['ticks']}: {stats['clients']} clients, tick p50 "
+        f"{stats['tick_p50_ms']:.2f} ms p99 {stats['tick_p99_ms']:.2f} ms "
+        f"(budget {stats['tick_budget_ms']:.1f} ms), {stats['late_ticks']} late, "
+        f"{stats['dropped_ticks']} dropped, "
+        f"{stats['mean_message_bytes']:.0f} B/state",
+        flush=True,
+    )
+
+
+class LoadClient:
+    """One simulated player of the load generator.
+
+    It wanders with random keys (held for a while, like a player) and
+    decodes every state it gets, acknowledging the newest.
+    """
+
+    def __init__(self, rng, udp=False):
+        self.rng = rng
+        self.udp = udp
+        self.transport = None
+        self.buffer = bytearray()
+        self.decoder = StateDecoder()
+        self.player = None
+        self.inputs = 0
+        # Stats: states decoded, bytes received, seconds between states,
+        # diffs that couldn't be decoded
+        self.states = 0
+        self.bytes = 0
+        self.intervals = []
+        self.last_state = None
+        self.errors = 0
+
+    def received(self, message):
+        """Handle a message from the server."""
+        self.bytes += len(message)
+        if message[0] == MSG_WELCOME:
+            self.player = WELCOME.unpack_from(message)[1]
+        elif message[0] == MSG_STATE:
+            try:
+                self.decoder.decode(message)
+            except ValueError:
+                self.errors += 1
+                return
+            now = time.perf_counter()
+            if self.last_state is not None:
+                self.intervals.append(now - self.last_state)
+            self.last_state = now
+            self.states += 1
+
+    def send_input(self):
+        """Send the held keys, changing them now and then."""
+        if self.rng.random() < 0.05:
+            self.inputs = self.rng.choice(
+                (0, game.INPUT_UP, game.INPUT_DOWN, game.INPUT_LEFT, game.INPUT_RIGHT)
+            )
+        message = INPUT.pack(MSG_INPUT, self.inputs, self.decoder.tick)
+        if self.udp:
+            if self.player is None:
+                message = bytes([MSG_HELLO])
+            self.transport.sendto(message)
+        else:
+            self.transport.write(FRAME.pack(len(message)) + message)
+
+
+class LoadTCPProtocol(asyncio.Protocol):
+    """TCP connection of a LoadClient."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def connection_made(self, transport):
+        self.client.transport = transport
+
+    def data_received(self, data):
+        buffer = self.client.buffer
+        buffer += data
+        while len(buffer) >= FRAME.size:
+            (length,) = FRAME.unpack_from(buffer)
+            end = FRAME.size + length
+            if len(buffer) < end:
+                break
+            self.client.received(bytes(buffer[FRAME.size : end]))
+            del buffer[:end]
+
+
+class LoadUDPProtocol(asyncio.DatagramProtocol):
+    """UDP endpoint of a LoadClient."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def connection_made(self, transport):
+        self.client.transport = transport
+        transport.sendto(bytes([MSG_HELLO]))
+
+    def datagram_received(self, data, address):
+        self.client.received(data)
+
+
+async def generate_load(host, port, client_count, seconds, udp=False, seed=0):
+    """Play client_count clients for seconds; returns the LoadClients.
+
+    Inputs of every client go out together once per tick.
+    """
+    loop = asyncio.get_running_loop()
+    clients = []
+    for i in range(client_count):
+        client = LoadClient(random.Random(seed + i), udp)
+        if udp:
+            await loop.create_datagram_endpoint(
+                lambda client=client: LoadUDPProtocol(client),
+                remote_addr=(host, port),
+            )
+        else:
+            await loop.create_connection(
+                lambda client=client: LoadTCPProtocol(client), host, port
+            )
+        clients.append(client)
+    started = loop.time()
+    next_tick = started
+    while loop.time() - started < seconds:
+        for client in clients:
+            client.send_input()
+        next_tick += game.TICK
+        await asyncio.sleep(max(0.0, next_tick - loop.time()))
+    for client in clients:
+        if udp:
+            client.transport.sendto(bytes([MSG_BYE]))
+        client.transport.close()
+    return clients
+
+
+def run_server(settings, stop, ready, results):
+    """Process target of the load command: serve until stop is set."""
+    server = asyncio.run(serve(settings, stop.is_set, ready.set))
+    results.put(server.stats())
+
+
+def load_report(clients, seconds, server_stats):
+    """Print what clients got and the server's stats; True if it kept up.
+
+    Keeping up means every client got at least 95% of the states of a
+    SIMULATION_RATE server, without undecodable diffs, and the server's
+    tick p99 stayed within TICK, at most LATE_TICK_ALLOWANCE of its ticks
+    finished late and none were dropped.
+    """
+    rates = np.array([client.states / seconds for client in clients])
+    intervals = np.concatenate([client.intervals or [0.0] for client in clients])
+    p99_interval = np.percentile(intervals, 99) * 1000.0
+    received = sum(client.bytes for client in clients) / seconds / len(clients)
+    errors = sum(client.errors for client in clients)
+    print(
+        f"{len(clients)} clients: {rates.mean():.1f} states/s each "
+        f"(min {rates.min():.1f}), p99 interval {p99_interval:.1f} ms, "
+        f"{received / 1024:.1f} KiB/s each, {errors} undecodable"
+    )
+    if server_stats is not None:
+        print(
+            f"server: {server_stats['ticks']} ticks, tick p50 "
+            f"{server_stats['tick_p50_ms']:.2f} ms p99 "
+            f"{server_stats['tick_p99_ms']:.2f} ms max "
+            f"{server_stats['tick_max_ms']:.2f} ms "
+            f"(budget {server_stats['tick_budget_ms']:.1f} ms), "
+            f"{server_stats['late_ticks']} late ticks, "
+            f"{server_stats['dropped_ticks']} dropped, "
+            f"{server_stats['mean_message_bytes']:.0f} B/state, "
+            f"{server_stats['full_states']} full states, "
+            f"{server_stats['skipped_sends']} skipped sends"
+        )
+    kept_up = rates.min() >= 0.95 * game.SIMULATION_RATE and errors == 0
+    if server_stats is not None:
+        kept_up = (
+            kept_up
+            and server_stats["tick_p99_ms"] <= server_stats["tick_budget_ms"]
+            and server_stats["late_ticks"]
+            <= LATE_TICK_ALLOWANCE * server_stats["ticks"]
+            and server_stats["dropped_ticks"] == 0
+        )
+    print("kept up" if kept_up else "FELL BEHIND")
+    return kept_up
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    world = argparse.ArgumentParser(add_help=False)
+    world.add_argument("--host", default=DEFAULT_HOST)
+    world.add_argument("--port", type=int, default=DEFAULT_PORT)
+    world.add_argument("--columns", type=int, default=DEFAULT_COLUMNS)
+    world.add_argument("--rows", type=int, default=DEFAULT_ROWS)
+    world.add_argument("--enemies", type=int, default=DEFAULT_ENEMIES)
+    world.add_argument("--seed", type=int, default=0)
+    commands.add_parser("serve", parents=[world], help="run the server")
+    load_parser = commands.add_parser(
+        "load", parents=[world], help="localhost load generator"
+    )
+    load_parser.add_argument("--clients", type=int, default=40)
+    load_parser.add_argument("--seconds", type=float, default=10.0)
+    load_parser.add_argument("--udp", action="store_true", help="instead of TCP")
+    load_parser.add_argument(
+        "--external",
+        action="store_true",
+        help="load a server already running at --host/--port",
+    )
+    args = parser.parse_args(argv)
+    settings = {
+        "host": args.host,
+        "port": args.port,
+        "columns": args.columns,
+        "rows": args.rows,
+        "enemies": args.enemies,
+        "seed": args.seed,
+    }
+
+    if args.command == "serve":
+        print(f"serving on {args.host}:{args.port}", flush=True)
+        try:
+            asyncio.run(serve(settings, report=print_stats))
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    server = None
+    if not args.external:
+        # The server gets its own process (and core), like a real one
+        stop = multiprocessing.Event()
+        ready = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        server = multiprocessing.Process(
+            target=run_server, args=(settings, stop, ready, results)
+        )
+        server.start()
+        while not ready.wait(0.1):
+            if not server.is_alive():
+                parser.error("the server didn't start")
+    try:
+        clients = asyncio.run(
+            generate_load(
+                args.host, args.port, args.clients, args.seconds, args.udp, args.seed
+            )
+        )
+    finally:
+        if server is not None:
+            stop.set()
+    server_stats = None
+    if server is not None:
+        server_stats = results.get(timeout=30)
+        server.join()
+    return 0 if load_report(clients, args.seconds, server_stats) else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
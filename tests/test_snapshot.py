@@ -0,0 +1,34 @@
+"""Snapshot files written by save_snapshot() load back into the same state."""
+
+import os
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pytest
+
+import game
+
+
+def played_session(grid):
+    session = game.GameSession(seed=3)
+    session.start(grid, 50, seed=3)
+    for _ in range(10):
+        session.step(game.TICK, game.INPUT_RIGHT)
+    return session
+
+
+@pytest.mark.parametrize("edited", (False, True))
+def test_chunked_grid_file_round_trip(tmp_path, edited):
+    grid = game.ChunkedGrid(500, 500, seed=3)
+    if edited:
+        grid.fill_rect(10, 10, 5, 5)
+    session = played_session(grid)
+    path = tmp_path / "chunked.snapshot"
+    game.save_snapshot(session, path)
+
+    loaded = game.load_snapshot(path)
+
+    assert isinstance(loaded.grid, game.ChunkedGrid)
+    assert loaded.state_digest() == session.state_digest()
+    assert loaded.grid.is_blocked(12, 12) == session.grid.is_blocked(12, 12)